@@ -0,0 +1,77 @@
+"""Measure the per-call overhead a reused YoutubeDL instance removes
+
+Usage: python -m benchmarks.extractor_reuse [youtube-url] [calls]
+
+Without a URL this runs offline and times what every call used to pay
+before extracting anything: building a YoutubeDL from its options and
+looking up the YouTube extractor. With a URL it also times real metadata
+extractions with a fresh instance per call against the reused one, which
+adds the cost of new HTTP connections.
+"""
+
+import sys
+from statistics import median
+from time import perf_counter
+
+import yt_dlp
+
+from musicboy.sources.youtube.youtube import (
+    EXTRACTOR_PARAMS,
+    _extractor,
+    warm_extractors,
+)
+
+
+def timings(fn, calls: int) -> list[float]:
+    results = []
+    for _ in range(calls):
+        start = perf_counter()
+        fn()
+        results.append(perf_counter() - start)
+
+    return results
+
+
+def report(name: str, results: list[float]):
+    results = sorted(results)
+    p99 = results[min(len(results) - 1, int(len(results) * 0.99))]
+    print(f"{name:<28} p50 {median(results) * 1000:8.2f}ms  p99 {p99 * 1000:8.2f}ms")
+
+
+def fresh_setup(kind: str):
+    with yt_dlp.YoutubeDL(params=dict(EXTRACTOR_PARAMS[kind])) as ydl:
+        ydl.get_info_extractor("Youtube")
+
+
+def main():
+    url = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] else None
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    # Built once up front, as the download workers do at startup
+    warm_extractors()
+    for kind in EXTRACTOR_PARAMS:
+        report(f"fresh {kind} setup", timings(lambda: fresh_setup(kind), calls))
+        report(
+            f"reused {kind} setup",
+            timings(lambda: _extractor(kind).get_info_extractor("Youtube"), calls),
+        )
+
+    if url is None:
+        return
+
+    def fresh_extract():
+        with yt_dlp.YoutubeDL(params=dict(EXTRACTOR_PARAMS["metadata"])) as ydl:
+            ydl.extract_info(url, download=False, process=False)
+
+    def reused_extract():
+        _extractor().extract_info(url, download=False, process=False)
+
+    # One untimed call each so both sides start with warm caches
+    fresh_extract()
+    reused_extract()
+    report("fresh metadata extraction", timings(fresh_extract, calls))
+    report("reused metadata extraction", timings(reused_extract, calls))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""Offline stand-ins for Discord's voice client and for YouTube
+
+None of these talk to the network or need FFmpeg. Songs are raw PCM fixture
+files, read a 20 ms frame at a time the way discord.py's player reads
+FFmpeg's output, so the bot's own sources, volume scaling and gapless
+handoffs all run for real.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+from collections.abc import Callable
+from pathlib import Path
+from time import perf_counter, sleep
+from typing import Any
+
+import discord
+from discord.ext.commands.view import StringView
+
+from musicboy.audio import FRAME_SECONDS, MusicSource
+from musicboy.bot import Context, MusicBoy
+from musicboy.downloads import IMMEDIATE, DownloadProgress
+from musicboy.sources.youtube.youtube import SongMetadata
+
+# 48 kHz, 16-bit stereo, like FFmpegPCMAudio's output
+FRAME_BYTES = 3840
+
+
+def write_fixture(path: Path, seconds: float):
+    """Write a song's worth of quiet PCM noise"""
+    frame = bytes(range(256)) * (FRAME_BYTES // 256)
+    path.write_bytes(frame * int(seconds / FRAME_SECONDS))
+
+
+def song_url(n: int) -> str:
+    return f"https://www.youtube.com/watch?v={n:011d}"
+
+
+class PCMFileAudio(discord.AudioSource):
+    """Reads raw PCM from a file, in place of an FFmpeg process"""
+
+    def __init__(self, path: str, offset: float = 0.0):
+        self.file = open(path, "rb")
+        self.file.seek(int(offset / FRAME_SECONDS) * FRAME_BYTES)
+
+    def read(self) -> bytes:
+        data = self.file.read(FRAME_BYTES)
+        return data if len(data) == FRAME_BYTES else b""
+
+    def cleanup(self):
+        self.file.close()
+
+
+def make_source(
+    path: str,
+    volume: float = 0.05,
+    requested_at: float | None = None,
+    stream: bool = False,
+    gain: float = 1.0,
+    offset: float = 0.0,
+) -> MusicSource:
+    """Same as musicboy.audio.make_source, reading fixtures instead of FFmpeg"""
+    source = MusicSource(
+        PCMFileAudio(path, offset),  # type: ignore
+        volume,
+        requested_at=requested_at,
+        streamed=stream,
+        gain=gain,
+    )
+    source.offset = offset
+    return source
+
+
+class StubExtractor:
+    """Answers metadata lookups for fixture URLs after a simulated delay"""
+
+    def __init__(self, duration: int, latency: float = 0.05):
+        self.duration = duration
+        self.latency = latency
+        self.calls = 0
+
+    async def __call__(self, url: str) -> list[SongMetadata]:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        song_id = url.rsplit("=", 1)[-1]
+        return [
+            SongMetadata(
+                id=song_id, title=f"Song {song_id}", duration=self.duration, url=url
+            )
+        ]
+
+
+async def analyze_loudness(path: str | Path) -> float | None:
+    return -14.0
+
+
+class StubDownloads:
+    """Stands in for DownloadService, linking in the fixture after a delay"""
+
+    def __init__(self, data_dir: Path, fixture: Path, latency: float = 0.2):
+        self.data_dir = data_dir
+        self.fixture = fixture
+        self.latency = latency
+        self.progress: dict[str, DownloadProgress] = {}
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def download(
+        self,
+        song: SongMetadata,
+        on_progress: Callable[[DownloadProgress], None] | None = None,
+        priority: float = IMMEDIATE,
+    ) -> tuple[Path, float | None]:
+        await asyncio.sleep(self.latency)
+        # The cache indexes by suffix; the fake source reads raw PCM anyway
+        path = self.data_dir / f"{song['id']}.m4a"
+        if not path.exists():
+            os.link(self.fixture, path)
+        return path, -14.0
+
+    def promote(self, song_id: str, priority: float):
+        pass
+
+    async def resolve_stream(self, song: SongMetadata) -> str:
+        return str(self.fixture)
+
+
+class FakePlayer(threading.Thread):
+    """Reads a source every frame, like discord.py's AudioPlayer
+
+    ``speed`` scales how fast frames are read; at 1 it's real time."""
+
+    def __init__(
+        self,
+        source: discord.AudioSource,
+        after: Callable[[Exception | None], Any] | None,
+        name: str,
+        speed: float,
+    ):
+        super().__init__(name=name, daemon=True)
+        self.source = source
+        self.after = after
+        self.speed = speed
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+
+    def run(self):
+        interval = FRAME_SECONDS / self.speed
+        next_frame = perf_counter()
+        while not self._end.is_set():
+            if not self._resumed.is_set():
+                self._resumed.wait()
+                next_frame = perf_counter()
+                continue
+
+            if not self.source.read():
+                self.stop()
+                break
+
+            next_frame += interval
+            delay = next_frame - perf_counter()
+            if delay > 0:
+                sleep(delay)
+
+        if self.after is not None:
+            self.after(None)
+        self.source.cleanup()
+
+    def stop(self):
+        self._end.set()
+        self._resumed.set()
+
+    def is_playing(self) -> bool:
+        return self._resumed.is_set() and not self._end.is_set()
+
+    def is_paused(self) -> bool:
+        return not self._end.is_set() and not self._resumed.is_set()
+
+
+class FakeVoiceClient:
+    """Plays sources on a thread the way discord.py's VoiceClient does"""
+
+    def __init__(self, bot: MusicBoy, guild: FakeGuild, speed: float = 1.0):
+        self.bot = bot
+        self.guild = guild
+        self.speed = speed
+        self._player: FakePlayer | None = None
+        self._connected = True
+        guild.voice_client = self
+        bot._connection._add_voice_client(guild.id, self)  # type: ignore
+
+    @property
+    def source(self) -> discord.AudioSource | None:
+        return self._player.source if self._player else None
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def is_playing(self) -> bool:
+        return self._player is not None and self._player.is_playing()
+
+    def is_paused(self) -> bool:
+        return self._player is not None and self._player.is_paused()
+
+    def play(self, source: discord.AudioSource, *, after=None, **kwargs: Any):
+        if self.is_playing():
+            raise discord.ClientException("Already playing audio.")
+
+        self._player = FakePlayer(source, after, f"voice-{self.guild.id}", self.speed)
+        self._player.start()
+
+    def pause(self):
+        if self._player:
+            self._player._resumed.clear()
+
+    def resume(self):
+        if self._player:
+            self._player._resumed.set()
+
+    def stop(self):
+        if self._player:
+            self._player.stop()
+            self._player = None
+
+    async def disconnect(self, *, force: bool = False):
+        self.stop()
+        self._connected = False
+        self.guild.voice_client = None
+        self.bot._connection._remove_voice_client(self.guild.id)  # type: ignore
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.channels: list = []
+        self.voice_client: FakeVoiceClient | None = None
+
+
+class FakeMessage:
+    def __init__(self, guild: FakeGuild, state: Any = None):
+        self.guild = guild
+        self._state = state
+        self.author = None
+        self.channel = None
+
+    async def add_reaction(self, emoji: str):
+        pass
+
+    async def edit(self, **kwargs: Any):
+        pass
+
+
+class FakeContext(Context):
+    """A command context for a guild, whose replies go nowhere"""
+
+    def __init__(self, bot: MusicBoy, guild: FakeGuild):
+        super().__init__(
+            message=FakeMessage(guild, bot._connection),  # type: ignore
+            bot=bot,
+            view=StringView(""),
+            prefix="!!",
+        )
+
+    async def send(self, *args: Any, **kwargs: Any):  # type: ignore
+        return FakeMessage(self.guild)  # type: ignore
+
+    async def reply(self, *args: Any, **kwargs: Any):  # type: ignore
+        return FakeMessage(self.guild)  # type: ignore
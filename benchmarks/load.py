@@ -0,0 +1,310 @@
+"""Run the bot against many synthetic guilds, offline
+
+Usage: python -m benchmarks.load [--guilds 50] [--songs 100] [--seconds 20]
+       [--speed 2] [--think 0.2] [--record] [--tolerance 0.25]
+
+Each guild connects a fake voice client, queues ``songs`` songs from a shared
+library with !!add and starts playing. The guilds then send a random mix of
+commands for ``seconds`` seconds, each pausing ``think`` seconds on average
+between commands. Meanwhile, songs play out ``speed`` times faster than real
+time, so the play_song/after_song_finished lifecycle and gapless handoffs
+keep running. See benchmarks/fakes.py for what stands in for Discord and
+YouTube.
+
+Reports command throughput, p50/p99 latency per command, memory per guild
+(traced while the guilds are set up) and playback timings. With --record the
+results become the baseline for this scenario in benchmarks/baselines.json;
+otherwise they're compared against it, and the run exits non-zero if any of
+them is more than ``tolerance`` worse.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+
+import discord
+
+import musicboy.loudness
+import musicboy.metadata
+from benchmarks import fakes
+from musicboy import metrics
+from musicboy.bot import MusicBoy
+from musicboy.database import Database
+
+BASELINES = Path(__file__).with_name("baselines.json")
+SONG_SECONDS = 12
+LIBRARY_SIZE = 500
+
+# Commands that start a song, and so may wait on a download
+STARTS_SONG = {"next", "seek", "prev"}
+
+# Relative frequency of each command in the mix
+COMMAND_MIX = {
+    "queue": 20,
+    "np": 20,
+    "add": 15,
+    "vol": 10,
+    "mv": 10,
+    "next": 8,
+    "seek": 7,
+    "rm": 5,
+    "shuffle": 3,
+    "prev": 2,
+}
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def command_args(name: str, rng: random.Random, songs: int) -> tuple[list, dict] | None:
+    """Arguments for a command, with positions within a queue of ``songs``
+
+    None if the command makes no sense for the queue as it is."""
+    if name in ("mv", "rm") and songs < 2:
+        return None
+    if name == "queue":
+        return [rng.randint(1, 3)], {}
+    if name == "add":
+        return [], {"urls": fakes.song_url(rng.randrange(LIBRARY_SIZE))}
+    if name == "vol":
+        return [rng.randint(1, 100)], {}
+    if name == "mv":
+        return [rng.randint(2, songs), rng.randint(2, songs)], {}
+    if name == "seek":
+        return [rng.choice(["+5", "-5", "0:10"])], {}
+    if name == "rm":
+        return [rng.randint(2, songs)], {}
+
+    return [], {}
+
+
+class Load:
+    def __init__(self, args: argparse.Namespace, data_dir: Path):
+        self.args = args
+        self.data_dir = data_dir
+        fixture = data_dir / "fixture.pcm"
+        fakes.write_fixture(fixture, SONG_SECONDS)
+
+        self.extractor = fakes.StubExtractor(SONG_SECONDS)
+        musicboy.metadata.fetch_metadata_entries = self.extractor
+        # Fixtures aren't real audio files, so there's nothing for FFmpeg to measure
+        musicboy.loudness.analyze_loudness = fakes.analyze_loudness
+        self.bot = MusicBoy(
+            command_prefix="!!",
+            intents=discord.Intents.none(),
+            db=Database(str(data_dir / "database.sqlite")),
+            data_dir=data_dir,
+        )
+        self.bot.downloads = self.bot.prefetch.downloads = fakes.StubDownloads(  # type: ignore
+            data_dir, fixture
+        )
+        self.latencies: dict[str, list[float]] = {name: [] for name in COMMAND_MIX}
+        self.errors: dict[str, int] = {}
+
+    async def setup(self) -> list[fakes.FakeContext]:
+        await self.bot.setup_hook()
+        playback = sys.modules["musicboy.commands.playback"]
+        playback.make_source = fakes.make_source  # type: ignore
+
+        rng = random.Random(0)
+        add = self.bot.get_command("add")
+        play = self.bot.get_command("play")
+        assert add is not None and play is not None
+
+        contexts = []
+        for n in range(self.args.guilds):
+            # Snowflake-shaped, so they spread across shards like real ids
+            guild = fakes.FakeGuild((n + 1) << 22)
+            fakes.FakeVoiceClient(self.bot, guild, speed=self.args.speed)
+            ctx = fakes.FakeContext(self.bot, guild)
+            urls = [
+                fakes.song_url(rng.randrange(LIBRARY_SIZE))
+                for _ in range(self.args.songs)
+            ]
+            await add(ctx, urls=" ".join(urls))
+            await play(ctx, url_or_urls=None)
+            contexts.append(ctx)
+
+        return contexts
+
+    async def run_guild(self, ctx: fakes.FakeContext, seed: int, until: float):
+        rng = random.Random(seed)
+        names = list(COMMAND_MIX)
+        weights = list(COMMAND_MIX.values())
+        while perf_counter() < until:
+            if self.args.think:
+                await asyncio.sleep(rng.expovariate(1 / self.args.think))
+
+            name = rng.choices(names, weights)[0]
+            command = self.bot.get_command(name)
+            assert command is not None
+            playlist = ctx.playlist
+            queued = len(playlist.playlist) - playlist.idx if playlist else 0
+            command_input = command_args(name, rng, queued)
+            if command_input is None:
+                continue
+
+            args, kwargs = command_input
+            start = perf_counter()
+            try:
+                await command(ctx, *args, **kwargs)
+            except Exception as e:
+                self.errors[f"{name}: {type(e).__name__}"] = (
+                    self.errors.get(f"{name}: {type(e).__name__}", 0) + 1
+                )
+            else:
+                self.latencies[name].append(perf_counter() - start)
+
+    async def run(self) -> dict:
+        async with self.bot:
+            tracemalloc.start()
+            before, _ = tracemalloc.get_traced_memory()
+            contexts = await self.setup()
+            after, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            start = perf_counter()
+            until = start + self.args.seconds
+            await asyncio.gather(
+                *(self.run_guild(ctx, seed, until) for seed, ctx in enumerate(contexts))
+            )
+            elapsed = perf_counter() - start
+
+            for client in list(self.bot.voice_clients):
+                await client.disconnect(force=True)
+
+        every = [t for times in self.latencies.values() for t in times]
+        # Waits on downloads make p99 of everything jump between two modes
+        queue_only = [
+            t
+            for name, times in self.latencies.items()
+            if name not in STARTS_SONG
+            for t in times
+        ]
+        started = metrics.histograms.get(("play_song_seconds", ()))
+        gaps = {
+            mode: metrics.histograms.get(("transition_gap_seconds", (("mode", mode),)))
+            for mode in ("cold", "gapless")
+        }
+        return {
+            "commands_per_second": round(len(every) / elapsed, 1),
+            "p50_ms": round(percentile(every, 0.5) * 1000, 2),
+            "p99_ms": round(percentile(every, 0.99) * 1000, 2),
+            "queue_p99_ms": round(percentile(queue_only, 0.99) * 1000, 2),
+            "memory_per_guild_kib": round(
+                (after - before) / self.args.guilds / 1024, 1
+            ),
+            "commands": {
+                name: {
+                    "count": len(times),
+                    "p50_ms": round(percentile(times, 0.5) * 1000, 2),
+                    "p99_ms": round(percentile(times, 0.99) * 1000, 2),
+                }
+                for name, times in self.latencies.items()
+            },
+            "songs_started": started.count if started else 0,
+            "gapless_transitions": gaps["gapless"].count if gaps["gapless"] else 0,
+            "cold_transitions": gaps["cold"].count if gaps["cold"] else 0,
+            "metadata_fetches": self.extractor.calls,
+            "errors": self.errors,
+        }
+
+
+# Whether a bigger number is worse, and the change that's always noise
+COMPARED = {
+    "commands_per_second": (False, 0.0),
+    "p50_ms": (True, 0.1),
+    "queue_p99_ms": (True, 1.0),
+    "memory_per_guild_kib": (True, 1.0),
+}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for key, (bigger_is_worse, slack) in COMPARED.items():
+        old, new = baseline.get(key), results[key]
+        if not old:
+            continue
+
+        worse = new - old if bigger_is_worse else old - new
+        change = worse / old
+        marker = ""
+        if change > tolerance and worse > slack:
+            marker = "  <-- regression"
+            regressions.append(key)
+        print(f"{key:>22} {old:>10} -> {new:<10} ({change:+.0%} worse){marker}")
+
+    return regressions
+
+
+def report(results: dict):
+    print(
+        f"{results['commands_per_second']} commands/s,"
+        f" p50 {results['p50_ms']}ms, p99 {results['p99_ms']}ms"
+        f" ({results['queue_p99_ms']}ms without song starts),"
+        f" {results['memory_per_guild_kib']} KiB per guild"
+    )
+    print(f"{'command':>10} {'count':>7} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, c in results["commands"].items():
+        print(f"{name:>10} {c['count']:>7} {c['p50_ms']:>8} {c['p99_ms']:>8}")
+    print(
+        f"{results['songs_started']} songs started,"
+        f" {results['gapless_transitions']} gapless and"
+        f" {results['cold_transitions']} cold transitions,"
+        f" {results['metadata_fetches']} metadata fetches"
+    )
+    for error, count in results["errors"].items():
+        print(f"{count}x {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test")
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--songs", type=int, default=100)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--speed", type=float, default=2)
+    parser.add_argument("--think", type=float, default=0.2)
+    parser.add_argument("--record", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = asyncio.run(Load(args, Path(tmp)).run())
+    report(results)
+
+    scenario = (
+        f"guilds={args.guilds} songs={args.songs} seconds={args.seconds:g}"
+        f" speed={args.speed:g} think={args.think:g}"
+    )
+    baselines = json.loads(BASELINES.read_text()) if BASELINES.exists() else {}
+    if args.record:
+        baselines[scenario] = {
+            **{key: results[key] for key in COMPARED},
+            "python": platform.python_version(),
+            "machine": f"{platform.machine()}, {os.cpu_count()} CPUs",
+        }
+        BASELINES.write_text(json.dumps(baselines, indent=2) + "\n")
+        print(f"Recorded baseline for {scenario}")
+    elif scenario in baselines:
+        print(f"Against the baseline for {scenario}:")
+        if compare(results, baselines[scenario], args.tolerance):
+            sys.exit(1)
+    else:
+        print(f"No baseline for {scenario}; record one with --record")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Compare CPU cost per stream of the PCM and pre-transcoded Opus paths
+
+Usage: python -m benchmarks.opus_cpu path/to/song.m4a
+
+Reads every frame the voice client would send, as fast as possible, and
+reports CPU seconds (this process plus FFmpeg) per minute of audio. Needs
+FFmpeg on PATH and libopus loadable by discord.py.
+"""
+
+import resource
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+import discord
+import discord.opus
+
+from musicboy.audio import OPUS_BASE_VOLUME, OpusSource, make_source, transcode_to_opus
+
+FRAME_SECONDS = 0.02
+
+
+def cpu_seconds() -> float:
+    usage = [
+        resource.getrusage(who)
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    ]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def drain(source: discord.AudioSource) -> tuple[int, float, float]:
+    """Read a source to the end like the voice client's send loop would"""
+    encoder = None if source.is_opus() else discord.opus.Encoder()
+    frames = 0
+    cpu_start, wall_start = cpu_seconds(), perf_counter()
+    while data := source.read():
+        if encoder is not None:
+            encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+        frames += 1
+
+    source.cleanup()
+    return frames, cpu_seconds() - cpu_start, perf_counter() - wall_start
+
+
+def report(name: str, frames: int, cpu: float, wall: float):
+    minutes = frames * FRAME_SECONDS / 60
+    print(
+        f"{name:>14}: {cpu / minutes:6.3f} CPU s per audio minute"
+        f" ({cpu:.2f}s CPU, {wall:.2f}s wall, {frames} frames)"
+    )
+
+
+def main(path: str):
+    if not discord.opus.is_loaded() and not discord.opus._load_default():
+        sys.exit("libopus is required for the PCM path's encoder")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = Path(tmp) / Path(path).name
+        shutil.copy(path, src)
+
+        report("pcm + volume", *drain(make_source(str(src), OPUS_BASE_VOLUME)))
+
+        start = cpu_seconds()
+        opus_path = transcode_to_opus(src)
+        print(f"{'transcode':>14}: {cpu_seconds() - start:.2f}s CPU, once per song")
+
+        report("opus copy", *drain(OpusSource(str(opus_path), OPUS_BASE_VOLUME)))
+        report("opus + gain", *drain(OpusSource(str(opus_path), 0.1)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
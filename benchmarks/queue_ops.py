@@ -0,0 +1,81 @@
+"""Compare playlist queue operations on a plain list and on SongQueue
+
+Usage: python -m benchmarks.queue_ops [entries]
+
+Times the edits Playlist makes (prepend after the current song, move, pop,
+remove every copy of a URL, find a URL) on a queue of ``entries`` songs, and
+the memory each representation takes for 10 guilds queueing the same songs.
+"""
+
+import random
+import sys
+import tracemalloc
+from collections.abc import Callable, MutableSequence
+from time import perf_counter
+
+from musicboy.songqueue import SongQueue
+
+OPS = 2000
+
+
+def make_urls(n: int) -> list[str]:
+    # Fresh strings per guild, like rows loaded from the database
+    return [f"https://www.youtube.com/watch?v={i % (n // 2):011d}" for i in range(n)]
+
+
+def prepend(q, rng, n):
+    q.insert(rng.randrange(len(q)), "https://www.youtube.com/watch?v=prepended00")
+
+
+def move(q, rng, n):
+    q.insert(rng.randrange(len(q)), q.pop(rng.randrange(len(q))))
+
+
+def pop(q, rng, n):
+    q.pop(rng.randrange(len(q)))
+    q.append("https://www.youtube.com/watch?v=appended000")
+
+
+def find(q, rng, n):
+    q.index(f"https://www.youtube.com/watch?v={rng.randrange(n // 2):011d}")
+
+
+def remove_all(q, rng, n):
+    url = f"https://www.youtube.com/watch?v={rng.randrange(n // 2):011d}"
+    if isinstance(q, SongQueue):
+        q.remove_all(url)
+    else:
+        q[:] = [u for u in q if u != url]
+
+
+def memory(build: Callable[[list[str]], MutableSequence[str]], n: int) -> int:
+    tracemalloc.start()
+    queues = [build(make_urls(n)) for _ in range(10)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del queues
+    return size
+
+
+def main(n: int):
+    print(f"{n} entries, mean of {OPS} ops (µs)")
+    print(f"{'op':>12} {'list':>10} {'SongQueue':>10}")
+    for op in (prepend, move, pop, find, remove_all):
+        ops = OPS if op is not remove_all else 50
+        results = []
+        for build in (list, SongQueue):
+            queue = build(make_urls(n))
+            rng = random.Random(0)
+            start = perf_counter()
+            for _ in range(ops):
+                op(queue, rng, n)
+            results.append((perf_counter() - start) / ops * 1e6)
+        print(f"{op.__name__:>12} {results[0]:10.1f} {results[1]:10.1f}")
+
+    print("memory for 10 guilds (MiB)")
+    for build in (list, SongQueue):
+        print(f"{build.__name__:>12} {memory(build, n) / 2**20:10.1f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
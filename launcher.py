@@ -1,19 +1,69 @@
 import os
+import signal
 import sys
+from pathlib import Path
 
 import discord
 from dotenv import load_dotenv
 
-from musicboy.bot import MusicBoy
+from musicboy.bot import MusicBoy, ShardedMusicBoy
+from musicboy.database import Database
+from musicboy.store import PlaylistStore, migrate_json_playlists
+from musicboy.supervisor import Supervisor
 
 load_dotenv()
 
 
+def bot_options() -> dict:
+    return dict(
+        command_prefix="!!",
+        intents=discord.Intents.all(),
+        cache_max_bytes=int(os.getenv("CACHE_MAX_BYTES", 10 * 1024**3)),
+        index_watch_interval=float(os.getenv("INDEX_WATCH_INTERVAL", 0)) or None,
+        stream_first=os.getenv("STREAM_FIRST", "").lower() in ("1", "true", "yes"),
+        warmup=os.getenv("WARMUP", "lazy"),
+        playlist_ttl_seconds=int(os.getenv("PLAYLIST_TTL_SECONDS", 60 * 60)),
+        opus_cache=os.getenv("OPUS_CACHE", "").lower() in ("1", "true", "yes"),
+        metrics_enabled=os.getenv("METRICS", "1").lower() not in ("0", "false", "no"),
+        metrics_port=int(os.getenv("METRICS_PORT", 0)) or None,
+    )
+
+
 def initialize_bot(bot_token: str):
-    intents = discord.Intents.all()
-    bot = MusicBoy(command_prefix="!!", intents=intents)
+    bot = MusicBoy(**bot_options())
     bot.run(bot_token)
 
 
+def run_shards(shard_ids: list[int], shard_count: int):
+    # Shut down cleanly (saving playback positions) when the supervisor stops us
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    load_dotenv()
+    options = bot_options()
+    if options["metrics_port"]:
+        # Each worker serves its own metrics, on the port after the last's
+        options["metrics_port"] += shard_ids[0]
+    bot = ShardedMusicBoy(shard_ids=shard_ids, shard_count=shard_count, **options)
+    bot.run(os.environ["BOT_TOKEN"])
+
+
+def run_supervisor(bot_token: str, workers: int):
+    os.environ["BOT_TOKEN"] = bot_token
+
+    # Done once up front, so workers don't race to migrate the same files
+    db = Database()
+    db.initialize_db()
+    migrate_json_playlists(Path("musicboy/data"), PlaylistStore(db))
+    db.close()
+
+    shard_count = int(os.getenv("SHARDS", 0)) or None
+    Supervisor(run_shards, workers, shard_count).run()
+
+
 if __name__ == "__main__":
-    initialize_bot(os.getenv("BOT_TOKEN") or sys.argv[1])
+    token = os.getenv("BOT_TOKEN") or sys.argv[1]
+    workers = int(os.getenv("WORKERS", 1))
+    if workers > 1:
+        run_supervisor(token, workers)
+    else:
+        initialize_bot(token)
@@ -0,0 +1,326 @@
+import os
+import subprocess
+import threading
+from collections.abc import Callable
+from math import isclose
+from pathlib import Path
+from time import perf_counter
+
+import discord
+
+from musicboy import metrics
+from musicboy.metrics import histogram
+
+# Let FFmpeg ride out dropped connections when reading a remote stream
+STREAM_BEFORE_OPTIONS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+
+# Each frame discord.py reads is 20 ms of audio
+FRAME_SECONDS = 0.02
+
+# Reads further apart than this are pauses, not jitter
+MAX_JITTER_SECONDS = 0.5
+JITTER_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5)
+
+# Pre-transcoded Opus files have the default volume and loudness normalization
+# baked in, so guilds that never touch !!vol get pure passthrough
+OPUS_BASE_VOLUME = 0.05
+# PCMVolumeTransformer never scales samples by more than this
+MAX_PCM_SCALE = 2.0
+
+
+def opus_volume_gain(volume: float, gain: float = 1.0) -> float:
+    """Gain for FFmpeg to apply on top of an Opus file's baked-in volume
+
+    The file was transcoded at ``OPUS_BASE_VOLUME * gain``, so this makes the
+    overall scale what MusicSource would use for the same song, cap included."""
+    return min(volume * gain, MAX_PCM_SCALE) / (OPUS_BASE_VOLUME * gain)
+
+
+class TrackedSource:
+    """Counts the frames read, and records time to first audio
+
+    Can also read the first frame ahead of time with :meth:`prime`, so FFmpeg
+    has already started by the time the source is played."""
+
+    # Where in the song FFmpeg started, in seconds
+    offset = 0.0
+    frames = 0
+    requested_at: float | None = None
+    # When the previous song ran out, if this one replaced it
+    transition_from: float | None = None
+    kind = "cache"
+    _primed: bytes | None = None
+
+    def prime(self):
+        self._primed = super().read()  # type: ignore
+
+    def read(self) -> bytes:
+        if self._primed is not None:
+            frame, self._primed = self._primed, None
+        else:
+            frame = super().read()  # type: ignore
+
+        if frame:
+            self.frames += 1
+
+        if self.requested_at is not None:
+            histogram("time_to_first_audio_seconds", source=self.kind).observe(
+                perf_counter() - self.requested_at
+            )
+            self.requested_at = None
+
+        if self.transition_from is not None:
+            histogram("transition_gap_seconds", mode="cold").observe(
+                perf_counter() - self.transition_from
+            )
+            self.transition_from = None
+
+        return frame
+
+    @property
+    def position(self) -> float:
+        """Seconds into the song of the last frame read"""
+        return self.offset + self.frames * FRAME_SECONDS
+
+
+class MusicSource(TrackedSource, discord.PCMVolumeTransformer):
+    """Volume-adjustable FFmpeg source, decoded to PCM and scaled in Python
+
+    ``gain`` is the song's precomputed loudness correction. It's folded into
+    the scale factor, so ``volume`` stays the guild's own setting."""
+
+    def __init__(
+        self,
+        original: discord.FFmpegPCMAudio,
+        volume: float = 0.05,
+        requested_at: float | None = None,
+        streamed: bool = False,
+        gain: float = 1.0,
+    ):
+        self.gain = gain
+        super().__init__(original, volume=volume)
+        self.requested_at = requested_at
+        self.kind = "stream" if streamed else "cache"
+
+    @property
+    def volume(self) -> float:
+        return self._user_volume
+
+    @volume.setter
+    def volume(self, value: float):
+        self._user_volume = value
+        self._volume = max(value * self.gain, 0.0)
+
+
+class OpusSource(TrackedSource, discord.FFmpegOpusAudio):
+    """Sends pre-encoded Opus packets without decoding them
+
+    At the baked-in volume FFmpeg only remuxes. Any other volume becomes an
+    FFmpeg gain filter with a native re-encode, which still skips the Python
+    PCM scaling and discord.py's encoder. Volume changes apply from the next
+    song, since packets can't be rescaled in flight."""
+
+    kind = "opus"
+
+    def __init__(
+        self,
+        path: str,
+        volume: float = 0.05,
+        requested_at: float | None = None,
+        offset: float = 0.0,
+        gain: float = 1.0,
+    ):
+        before_options = f"-ss {offset:.3f}" if offset else None
+        gain = opus_volume_gain(volume, gain)
+        if isclose(gain, 1, abs_tol=1e-3):
+            super().__init__(path, codec="copy", before_options=before_options)
+        else:
+            super().__init__(
+                path,
+                options=f"-filter:a volume={gain:.4f}",
+                before_options=before_options,
+            )
+
+        self._volume = volume
+        self.requested_at = requested_at
+        self.offset = offset
+
+    @property
+    def volume(self) -> float:
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        self._volume = value
+
+
+class GaplessSource(discord.AudioSource):
+    """Plays songs back to back without a gap between them
+
+    The next song's source is opened and primed ahead of time with
+    :meth:`queue`. When the current one runs dry, the first frame of the next
+    is returned from the same read, so the voice thread never misses a beat.
+    The queued song is dropped if ``still_next`` says the queue has changed
+    since, and playback then ends as usual.
+
+    discord.py only sets up an encoder when playback starts, if the first
+    source isn't Opus, so only songs of the same kind are played back to back."""
+
+    def __init__(self, source: discord.AudioSource):
+        self.current = source
+        self._opus = source.is_opus()
+        # Set when playback was stopped to start another song instead
+        self.stopped = False
+        self._lock = threading.Lock()
+        self._last_read = 0.0
+        self._next: (
+            tuple[discord.AudioSource, Callable[[], bool], Callable[[], None]] | None
+        ) = None
+
+    def queue(
+        self,
+        source: discord.AudioSource,
+        still_next: Callable[[], bool],
+        on_start: Callable[[], None],
+    ) -> bool:
+        """Queue a primed source. ``on_start`` is called from the voice thread
+
+        Returns False, closing the source, if it's a different kind than this
+        one plays; the current song then ends as usual."""
+        if source.is_opus() != self._opus:
+            source.cleanup()
+            return False
+
+        with self._lock:
+            replaced, self._next = self._next, (source, still_next, on_start)
+
+        if replaced is not None:
+            replaced[0].cleanup()
+        return True
+
+    def read(self) -> bytes:
+        if metrics.enabled:
+            self._observe_jitter()
+
+        data = self.current.read()
+        if data:
+            return data
+
+        ended_at = perf_counter()
+        with self._lock:
+            upcoming, self._next = self._next, None
+
+        if upcoming is None:
+            return b""
+
+        source, still_next, on_start = upcoming
+        try:
+            # The loop may be editing the queue while the voice thread checks it
+            valid = still_next()
+        except (IndexError, KeyError):
+            valid = False
+
+        if not valid:
+            source.cleanup()
+            return b""
+
+        previous, self.current = self.current, source
+        data = source.read()
+        histogram("transition_gap_seconds", mode="gapless").observe(
+            perf_counter() - ended_at
+        )
+        previous.cleanup()
+        on_start()
+        return data
+
+    def _observe_jitter(self):
+        """How far the voice thread strays from reading a frame every 20 ms"""
+        now = perf_counter()
+        interval, self._last_read = now - self._last_read, now
+        if interval < MAX_JITTER_SECONDS:
+            histogram("frame_jitter_seconds", buckets=JITTER_BUCKETS).observe(
+                abs(interval - FRAME_SECONDS)
+            )
+
+    def is_opus(self) -> bool:
+        return self._opus
+
+    @property
+    def volume(self) -> float:
+        return getattr(self.current, "volume", 1.0)
+
+    @volume.setter
+    def volume(self, value: float):
+        with self._lock:
+            sources = [self.current, *(self._next[:1] if self._next else [])]
+
+        for source in sources:
+            if hasattr(source, "volume"):
+                source.volume = value  # type: ignore
+
+    def cleanup(self):
+        with self._lock:
+            upcoming, self._next = self._next, None
+
+        if upcoming is not None:
+            upcoming[0].cleanup()
+        self.current.cleanup()
+
+
+def make_source(
+    path: str,
+    volume: float = 0.05,
+    requested_at: float | None = None,
+    stream: bool = False,
+    gain: float = 1.0,
+    offset: float = 0.0,
+) -> MusicSource | OpusSource:
+    """Open a song, starting ``offset`` seconds in
+
+    The seek is on FFmpeg's input side, so it jumps straight there in a
+    cached file rather than decoding everything before it."""
+    if not stream and path.endswith(".opus"):
+        # Normalization is already baked into the file
+        return OpusSource(path, volume, requested_at, offset=offset, gain=gain)
+
+    before_options = [STREAM_BEFORE_OPTIONS] if stream else []
+    if offset:
+        before_options.append(f"-ss {offset:.3f}")
+
+    source = MusicSource(
+        discord.FFmpegPCMAudio(path, before_options=" ".join(before_options) or None),
+        volume=volume,
+        requested_at=requested_at,
+        streamed=stream,
+        gain=gain,
+    )
+    source.offset = offset
+    return source
+
+
+def transcode_to_opus(path: Path, gain: float = 1.0) -> Path:
+    """Re-encode a downloaded file as Ogg/Opus ready for passthrough playback
+
+    Returns the new path, or the original one if FFmpeg fails."""
+    out = path.with_suffix(".opus")
+    tmp = out.with_name(out.name + ".tmp")
+    # fmt: off
+    result = subprocess.run(
+        [
+            "ffmpeg", "-nostdin", "-y", "-loglevel", "error",
+            "-i", str(path), "-vn",
+            "-filter:a", f"volume={OPUS_BASE_VOLUME * gain:.6f}",
+            "-c:a", "libopus", "-b:a", "128k", "-ar", "48000", "-ac", "2",
+            "-f", "ogg", str(tmp),
+        ],
+        capture_output=True,
+    )
+    # fmt: on
+    if result.returncode != 0:
+        print("Opus transcode failed for", path, result.stderr.decode().strip())
+        tmp.unlink(missing_ok=True)
+        return path
+
+    os.replace(tmp, out)
+    path.unlink(missing_ok=True)
+    return out
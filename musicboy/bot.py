@@ -1,17 +1,23 @@
-import json
-from collections.abc import MutableMapping, Sequence
+from collections.abc import Sequence
 from pathlib import Path
-from time import time
-from typing import cast
+from typing import Literal, cast
 
 import discord
 from discord.ext import commands, tasks
 from discord.voice_client import VoiceClient
 
+from musicboy import metrics
+from musicboy.cache import AudioCache
 from musicboy.database import Database
-from musicboy.metadata import find_missing_metadata
-from musicboy.playlist import Playlist, PlaylistState, cache_next_songs
+from musicboy.downloads import DownloadService
+from musicboy.guilds import GuildRegistry
+from musicboy.idle import IdleScheduler
+from musicboy.playlist import Playlist
+from musicboy.prefetch import PrefetchScheduler
 from musicboy.progress import ProgressTracker
+from musicboy.queueview import QueuePages
+from musicboy.store import PlaylistStore, migrate_json_playlists
+from musicboy.warmup import Warmup
 
 
 class Context(commands.Context):
@@ -21,12 +27,16 @@ class Context(commands.Context):
         if not self.guild:
             return
 
-        self.bot.voice_activity[self.guild.id] = int(time())
+        self.bot.idle.touch(self.guild.id)
 
     @property
     def db(self) -> Database:
         return self.bot.db
 
+    @property
+    def cache(self) -> AudioCache:
+        return self.bot.cache
+
     @property
     def voice_client(self) -> VoiceClient | None:
         g = self.guild
@@ -51,15 +61,19 @@ class Context(commands.Context):
         if not self.guild:
             return None
 
-        pl = self.bot.playlists.get(self.guild.id)
-        if pl is None:
-            pl = Playlist(self.guild.id)
-            self.bot.playlists[self.guild.id] = pl
+        return self.bot.guild_states.playlist(self.guild.id)
 
-        return pl
+    async def load_playlist(self, create: bool = False) -> Playlist | None:
+        """The guild's playlist, loading it if it's saved
 
+        Commands that queue songs create it if the guild doesn't have one."""
+        if not self.guild:
+            return None
 
-def get_music_channel(guild: discord.Guild) -> discord.TextChannel | None:
+        return await self.bot.guild_states.load(self.guild.id, create=create)
+
+
+def find_music_channel(guild: discord.Guild) -> discord.TextChannel | None:
     music_channel = [
         c for c in guild.channels if c.name.lower() in ("music", "musicboy")
     ]
@@ -68,49 +82,153 @@ def get_music_channel(guild: discord.Guild) -> discord.TextChannel | None:
 
 
 class MusicBoy(commands.Bot):
-    enabled_extensions = ["playback"]
+    enabled_extensions = ["playback", "admin"]
 
     def __init__(
         self,
         *args,
         db: Database | None = None,
         max_idle_seconds: int = 60 * 15,
+        playlist_ttl_seconds: int = 60 * 60,
         data_dir="musicboy/data",
+        cache_max_bytes: int = 10 * 1024**3,
+        cache_policy: Literal["lru", "lfu"] = "lru",
+        opus_cache: bool = False,
+        index_watch_interval: float | None = None,
+        prefetch_workers: int = 2,
+        stream_first: bool = False,
+        warmup: Literal["lazy", "eager"] = "lazy",
+        metrics_enabled: bool = True,
+        metrics_port: int | None = None,
         **kwargs,
     ):
         super().__init__(*args, **kwargs)
+        metrics.set_enabled(metrics_enabled)
+        self.metrics_server = (
+            metrics.MetricsServer(metrics_port)
+            if metrics_enabled and metrics_port
+            else None
+        )
         self.db = db or Database()
-        self.playlists: MutableMapping[int, Playlist] = {}
-        self.progress: MutableMapping[int, ProgressTracker] = {}
-        self.voice_activity: MutableMapping[int, int] = {}
-        self.max_idle_seconds = max_idle_seconds
+        self.playlist_store = PlaylistStore(self.db)
+        self.guild_states = GuildRegistry(self.playlist_store)
+        self.playlists = self.guild_states.playlists
+        self.progress = self.guild_states.progress
+        self.preloads = self.guild_states.preloads
+        self.playlist_ttl_seconds = playlist_ttl_seconds
+        self.idle = IdleScheduler(max_idle_seconds, self.disconnect_idle)
+        # Guild -> id of its music channel, if it has one
+        self.music_channels: dict[int, int | None] = {}
         self.data_dir = Path(data_dir)
+        self.cache = AudioCache(
+            self.data_dir,
+            max_bytes=cache_max_bytes,
+            policy=cache_policy,
+            opus=opus_cache,
+            db=self.db,
+        )
+        self.index_watch_interval = index_watch_interval
+        self.stream_first = stream_first
+        # One process more than prefetch workers, kept for songs someone is
+        # waiting on
+        self.downloads = DownloadService(
+            self.data_dir, opus=opus_cache, processes=prefetch_workers + 1
+        )
+        self.prefetch = PrefetchScheduler(
+            self.cache, self.db, self.downloads, workers=prefetch_workers
+        )
+        self.warmup_mode = warmup
+        self.warmup = Warmup(self.guild_states.load, self.db, self.prefetch)
+        self.queue_pages = QueuePages(self.db)
+
+    def music_channel(self, guild: discord.Guild) -> discord.TextChannel | None:
+        if guild.id not in self.music_channels:
+            channel = find_music_channel(guild)
+            self.music_channels[guild.id] = channel.id if channel else None
+
+        channel_id = self.music_channels[guild.id]
+        channel = guild.get_channel(channel_id) if channel_id else None
+        return channel if isinstance(channel, discord.TextChannel) else None
+
+    async def on_guild_channel_create(self, channel: discord.abc.GuildChannel):
+        self.music_channels.pop(channel.guild.id, None)
+
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        self.music_channels.pop(channel.guild.id, None)
+
+    async def on_guild_channel_update(
+        self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel
+    ):
+        if before.name != after.name:
+            self.music_channels.pop(after.guild.id, None)
 
-    @tasks.loop(seconds=60)
-    async def prune_voice_clients(self):
-        inactive_guilds = [c.guild for c in self.voice_clients if not c.is_playing()]
-        for guild in inactive_guilds:
-            if guild.voice_client is None:
-                continue
-
-            now = int(time())
-            idle_time = now - self.voice_activity.get(guild.id, now)
-            if idle_time >= self.max_idle_seconds:
-                await guild.voice_client.disconnect(force=True)
+    async def on_guild_remove(self, guild: discord.Guild):
+        self.music_channels.pop(guild.id, None)
 
-                chan = get_music_channel(guild)
-                if chan is not None:
-                    await chan.send(
-                        f"Inactive for {idle_time // 60} minutes. Leaving voice 👋",
-                        delete_after=60,
-                    )
+    async def on_voice_state_update(
+        self,
+        member: discord.Member,
+        before: discord.VoiceState,
+        after: discord.VoiceState,
+    ):
+        if self.user is not None and member.id == self.user.id:
+            if after.channel is None:
+                self.voice_disconnected(member.guild.id)
+
+    def voice_disconnected(self, guild_id: int):
+        """Drop a guild's playback state once the bot has left its voice channel"""
+        self.idle.forget(guild_id)
+        self.progress.pop(guild_id, None)
+        if (task := self.preloads.pop(guild_id, None)) is not None:
+            task.cancel()
+        self.prefetch.cancel(guild_id)
+
+    async def disconnect_idle(self, guild_id: int, idle_seconds: float):
+        guild = self.get_guild(guild_id)
+        if guild is None or guild.voice_client is None:
+            self.voice_disconnected(guild_id)
+            return
 
-                playlist = self.playlists.get(guild.id)
-                if playlist is not None:
-                    playlist.clear()
+        if cast(VoiceClient, guild.voice_client).is_playing():
+            # A long song counts as activity
+            self.idle.touch(guild_id)
+            return
 
-                self.progress.pop(guild.id)
-                self.voice_activity.pop(guild.id)
+        await guild.voice_client.disconnect(force=True)
+
+        chan = self.music_channel(guild)
+        if chan is not None:
+            await chan.send(
+                f"Inactive for {int(idle_seconds) // 60} minutes. Leaving voice 👋",
+                delete_after=60,
+            )
+
+        playlist = self.playlists.get(guild_id)
+        if playlist is not None:
+            playlist.clear()
+        self.voice_disconnected(guild_id)
+
+    @tasks.loop(seconds=10)
+    async def save_positions(self):
+        """Persist how far each guild is into its song, to resume after a restart"""
+        for client in self.voice_clients:
+            playlist = self.playlists.get(client.guild.id)
+            progress = self.progress.get(client.guild.id)
+            if playlist is not None and progress is not None and client.is_playing():
+                playlist.save_elapsed(progress.position)
+
+    @tasks.loop(minutes=5)
+    async def evict_playlists(self):
+        """Unload playlists nobody has used for a while; they're already saved"""
+        keep = {c.guild.id for c in self.voice_clients}
+        for guild_id in self.guild_states.evict(self.playlist_ttl_seconds, keep):
+            self.queue_pages.forget(guild_id)
+            # Releases the songs warm-up pinned for it
+            self.prefetch.cancel(guild_id)
+
+    @tasks.loop(seconds=30)
+    async def watch_data_dir(self):
+        self.cache.sync()
 
     @property
     def voice_clients(self):  # type: ignore
@@ -120,21 +238,100 @@ class MusicBoy(commands.Bot):
         return await super().get_context(message, cls=cls)
 
     def load_playlists(self):
-        for playlist in self.data_dir.glob("state_*.json"):
-            with playlist.open() as f:
-                state: PlaylistState = json.load(f)
-                self.playlists[state["guild_id"]] = Playlist.from_state(state)
+        shard_ids = getattr(self, "shard_ids", None)
+        if shard_ids is None:
+            # Sharded workers leave this to the supervisor, which runs it once
+            migrate_json_playlists(self.data_dir, self.playlist_store)
+
+        # Only ids for now; each playlist is loaded when it's first needed
+        guild_ids = self.playlist_store.guild_ids(shard_ids, self.shard_count or 1)
+        self.guild_states.stored.update(dict.fromkeys(guild_ids))
+
+    async def warm_playlists(self):
+        await self.wait_until_ready()
+
+        # Guilds already in voice are the likeliest to need their queue soon
+        voice_guilds = [c.guild.id for c in self.voice_clients]
+        self.warmup.start(g for g in voice_guilds if self.guild_states.has_playlist(g))
+        if self.warmup_mode == "eager":
+            self.warmup.start(self.guild_states.known())
+
+    def collect_metrics(self):
+        """Report state the bot already keeps, read only when scraped"""
+        metrics.collect("guilds", lambda: len(self.guilds))
+        metrics.collect("voice_clients", lambda: len(self.voice_clients))
+        metrics.collect(
+            "voice_clients_playing",
+            lambda: sum(c.is_playing() for c in self.voice_clients),
+        )
+        metrics.collect("playlists_loaded", lambda: len(self.guild_states.loaded()))
+        metrics.collect("playlists_stored", lambda: len(self.guild_states.stored))
+        metrics.collect(
+            "playlist_loads_total", lambda: self.guild_states.loads, "counter"
+        )
+        metrics.collect(
+            "playlist_evictions_total", lambda: self.guild_states.evictions, "counter"
+        )
+        metrics.collect(
+            "guild_state_bytes", lambda: sum(self.guild_states.memory_usage().values())
+        )
+        metrics.collect("prefetch_jobs", lambda: len(self.prefetch.jobs))
+        metrics.collect("audio_cache_bytes", lambda: self.cache.total_bytes)
+        metrics.collect("audio_cache_files", lambda: len(self.cache.entries))
+        for result in ("hits", "misses"):
+            metrics.collect(
+                "audio_cache_lookups_total",
+                lambda r=result: getattr(self.cache, r),
+                "counter",
+                result=result,
+            )
+            metrics.collect(
+                "metadata_cache_lookups_total",
+                lambda r=result: getattr(self.db.cache, r),
+                "counter",
+                result=result,
+            )
+        metrics.collect("db_write_queue", lambda: self.db.writer.queue.qsize())
+
+    async def close(self):
+        self.save_positions.cancel()
+        await self.save_positions()
+        self.evict_playlists.cancel()
+        self.warmup.cancel()
+        self.idle.close()
+        self.prefetch.close()
+        self.downloads.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        await super().close()
+        self.db.close()
 
     async def setup_hook(self) -> None:
         self.db.initialize_db()
+        self.cache.rebuild()
 
         for cmd in self.enabled_extensions:
             await self.load_extension(f"musicboy.commands.{cmd}")
 
         self.load_playlists()
-
-        for pl in self.playlists.values():
-            await find_missing_metadata(pl, self.db)
-            await cache_next_songs(pl, self.db)
-
-        self.prune_voice_clients.start()
+        self.downloads.start()
+        self.prefetch.start()
+        self.loop.create_task(self.warm_playlists())
+
+        self.idle.start()
+        self.save_positions.start()
+        self.evict_playlists.start()
+        if metrics.enabled:
+            self.collect_metrics()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        if self.index_watch_interval:
+            self.watch_data_dir.change_interval(seconds=self.index_watch_interval)
+            self.watch_data_dir.start()
+
+
+class ShardedMusicBoy(MusicBoy, commands.AutoShardedBot):
+    """MusicBoy running some of the bot's shards, as one of several processes
+
+    Workers share the data dir and database. Downloads are coordinated with
+    file locks, so a song is only fetched once whichever worker wants it."""
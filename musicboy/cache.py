@@ -0,0 +1,417 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import zlib
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+from time import monotonic, perf_counter, time
+from typing import TYPE_CHECKING, Literal, TypedDict
+
+if TYPE_CHECKING:
+    from musicboy.database import Database
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows, where only one process may use a data dir
+    fcntl = None
+
+AUDIO_SUFFIXES = {".m4a", ".webm", ".opus", ".ogg", ".mp3"}
+# Download locks are striped over this many files rather than one per song
+LOCK_STRIPES = 64
+# Audio files are hard links to a file here named by a hash of its contents
+OBJECTS_DIR = ".objects"
+# Shared pins outlive a worker that died without releasing them by this long.
+# Live ones are renewed whenever a guild's song changes.
+PIN_TTL = 6 * 3600
+# Other processes' downloads only count against the budget once the data dir
+# is rescanned, which adding a song does at most this often
+SHARED_SYNC_SECONDS = 30
+
+
+def find_audio(data_dir: Path, song_id: str) -> Path | None:
+    for suffix in AUDIO_SUFFIXES:
+        path = data_dir / f"{song_id}{suffix}"
+        if path.exists():
+            return path
+
+    return None
+
+
+@contextmanager
+def file_lock(path: Path) -> Iterator[None]:
+    """Exclusive lock on ``path``, shared with other processes"""
+    if fcntl is None:
+        yield
+        return
+
+    path.parent.mkdir(exist_ok=True)
+    with path.open("a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def download_lock(data_dir: Path, song_id: str) -> Iterator[None]:
+    """Held while downloading a song, so processes sharing the data dir wait
+    for each other rather than fetching the same song twice"""
+    stripe = zlib.crc32(song_id.encode()) % LOCK_STRIPES
+    with file_lock(data_dir / ".locks" / f"{stripe}.lock"):
+        yield
+
+
+def content_digest(path: Path) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with path.open("rb") as f:
+        while chunk := f.read(1024**2):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def store_content(data_dir: Path, path: Path) -> Path:
+    """Collapse a downloaded file onto an identical one already stored
+
+    The file is linked to ``.objects/<hash>``, or replaced by a link to it if
+    that exists, so songs with the same audio share one copy on disk. Left
+    alone where the filesystem can't hard link."""
+    objects = data_dir / OBJECTS_DIR
+    try:
+        objects.mkdir(exist_ok=True)
+        stored = objects / f"{content_digest(path)}{path.suffix}"
+        for _ in range(3):
+            try:
+                os.link(path, stored)
+                return path
+            except FileExistsError:
+                pass
+
+            tmp = path.with_name(f"{path.name}.dedup")
+            tmp.unlink(missing_ok=True)
+            try:
+                os.link(stored, tmp)
+            except FileNotFoundError:
+                # Collected since; store this copy instead
+                continue
+            os.replace(tmp, path)
+            return path
+    except OSError as e:
+        print("Could not deduplicate", path, e)
+
+    return path
+
+
+@dataclass
+class CacheEntry:
+    path: Path
+    size: int
+    last_played: float = 0
+    plays: int = 0
+    # Entries linked to the same stored audio share an inode
+    inode: int = 0
+
+
+class CacheStats(TypedDict):
+    entries: int
+    bytes: int
+    max_bytes: int
+    pinned: int
+    shared: int
+    hits: int
+    misses: int
+    evictions: int
+    index_builds: int
+    last_build_ms: float
+
+
+class AudioCache:
+    """Size-bounded store of downloaded audio keyed by song id
+
+    Songs whose audio is identical are hard links to one file (see
+    ``store_content``), whose size is only counted once.
+
+    Processes sharing the data dir take turns to evict, rescanning it first,
+    so the budget covers everyone's files. With a database, pins are shared
+    through it too, and no process evicts a song another is about to play."""
+
+    def __init__(
+        self,
+        data_dir: str | Path = "musicboy/data",
+        max_bytes: int = 10 * 1024**3,
+        policy: Literal["lru", "lfu"] = "lru",
+        opus: bool = False,
+        db: Database | None = None,
+    ):
+        self.data_dir = Path(data_dir)
+        self.opus = opus
+        self.db = db
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.entries: dict[str, CacheEntry] = {}
+        self.total_bytes = 0
+        # Inode -> number of entries linked to it
+        self._links: dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.index_builds = 0
+        self.last_build_ms = 0.0
+        self._dir_mtime = 0.0
+        self._scanned_at = 0.0
+        self._pins: dict[int, set[str]] = {}
+        self._lock = Lock()
+        self._evicting: asyncio.Future | None = None
+
+    def _count(self, entry: CacheEntry):
+        links = self._links.get(entry.inode, 0)
+        self._links[entry.inode] = links + 1
+        if links == 0:
+            self.total_bytes += entry.size
+
+    def _uncount(self, entry: CacheEntry) -> bool:
+        """Stop counting an entry, returning whether that freed its bytes"""
+        links = self._links.pop(entry.inode, 1) - 1
+        if links:
+            self._links[entry.inode] = links
+            return False
+
+        self.total_bytes -= entry.size
+        return True
+
+    def collect_objects(self) -> int:
+        """Delete stored audio no song links to any more"""
+        objects = self.data_dir / OBJECTS_DIR
+        if not objects.is_dir():
+            return 0
+
+        removed = 0
+        for path in objects.iterdir():
+            try:
+                if path.stat().st_nlink == 1:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                pass
+
+        return removed
+
+    def _scan(self) -> dict[str, Path]:
+        self._dir_mtime = self.data_dir.stat().st_mtime
+        self._scanned_at = monotonic()
+        return {
+            p.stem: p for p in self.data_dir.iterdir() if p.suffix in AUDIO_SUFFIXES
+        }
+
+    def rebuild(self):
+        """Index the data dir from scratch"""
+        start = perf_counter()
+        with self._lock:
+            self.entries.clear()
+            self._links.clear()
+            self.total_bytes = 0
+            for path in self._scan().values():
+                self._register(path)
+
+        self.index_builds += 1
+        self.last_build_ms = (perf_counter() - start) * 1000
+        self.evict()
+        self.collect_objects()
+
+    def sync(self) -> bool:
+        """Pick up files added or removed behind our back
+
+        Only rescans when the data dir's mtime changed since the last scan"""
+        if not self._sync():
+            return False
+
+        self._evict_soon()
+        return True
+
+    def _sync(self) -> bool:
+        if self.data_dir.stat().st_mtime == self._dir_mtime:
+            return False
+
+        # Scanned without the lock, which add() takes on the event loop
+        on_disk = self._scan()
+        with self._lock:
+            for song_id in self.entries.keys() - on_disk.keys():
+                # Unless it was added since the scan
+                if not self.entries[song_id].path.exists():
+                    self._uncount(self.entries.pop(song_id))
+            for song_id in on_disk.keys() - self.entries.keys():
+                self._register(on_disk[song_id])
+
+        return True
+
+    def _register(self, path: Path) -> CacheEntry:
+        st = path.stat()
+        old = self.entries.get(path.stem)
+        if old is not None:
+            self._uncount(old)
+
+        # File mtime doubles as the persisted "last played" time across
+        # restarts. Play counts are kept in the database, if there is one.
+        entry = CacheEntry(
+            path=path,
+            size=st.st_size,
+            last_played=old.last_played if old else st.st_mtime,
+            plays=old.plays if old else 0,
+            inode=st.st_ino,
+        )
+        self.entries[path.stem] = entry
+        self._count(entry)
+
+        return entry
+
+    def get(self, song_id: str) -> Path | None:
+        entry = self.entries.get(song_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry.path
+
+    def __contains__(self, song_id: str) -> bool:
+        return song_id in self.entries
+
+    def find(self, song_id: str) -> Path | None:
+        """Look on disk for a song, which another process may have downloaded"""
+        path = find_audio(self.data_dir, song_id)
+        return self.add(path) if path is not None else None
+
+    def add(self, path: str | Path) -> Path | None:
+        """Register a freshly downloaded song and make room for it"""
+        path = Path(path)
+        if not path.exists():
+            return None
+
+        with self._lock:
+            self._register(path)
+
+        self._evict_soon()
+        return path
+
+    def touch(self, song_id: str):
+        entry = self.entries.get(song_id)
+        if entry is None:
+            return
+
+        entry.last_played = time()
+        entry.plays += 1
+        if self.db is not None:
+            self.db.write_play(song_id)
+        try:
+            os.utime(entry.path)
+        except FileNotFoundError:
+            self.discard(song_id)
+
+    def discard(self, song_id: str):
+        with self._lock:
+            entry = self.entries.pop(song_id, None)
+            if entry is not None:
+                self._uncount(entry)
+
+    def pin(self, guild_id: int, song_ids: Iterable[str]):
+        pins = self._pins[guild_id] = set(song_ids)
+        if self.db is not None:
+            self.db.write_pins(guild_id, pins, time() + PIN_TTL)
+
+    def unpin(self, guild_id: int):
+        if self._pins.pop(guild_id, None) is not None and self.db is not None:
+            self.db.write_pins(guild_id, (), 0)
+
+    @property
+    def pinned(self) -> set[str]:
+        """Songs this process has pinned"""
+        return set().union(*self._pins.values())
+
+    def _pinned_anywhere(self) -> set[str]:
+        pinned = self.pinned
+        if self.db is not None:
+            pinned |= self.db.pinned_song_ids()
+
+        return pinned
+
+    def _eviction_key(self, entry: CacheEntry):
+        if self.policy == "lfu":
+            return (entry.plays, entry.last_played)
+
+        return entry.last_played
+
+    def _evict_soon(self):
+        """Evict off the event loop if there's one running, or right away"""
+        if (
+            self.total_bytes <= self.max_bytes
+            and monotonic() - self._scanned_at < SHARED_SYNC_SECONDS
+        ):
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.evict()
+            return
+
+        if self._evicting is None or self._evicting.done():
+            self._evicting = loop.run_in_executor(None, self.evict)
+            self._evicting.add_done_callback(self._evicted)
+
+    @staticmethod
+    def _evicted(future: asyncio.Future):
+        if not future.cancelled() and (e := future.exception()) is not None:
+            print("Cache eviction failed", e)
+
+    def evict(self):
+        with file_lock(self.data_dir / ".locks" / "evict.lock"):
+            # Other processes' files count against the budget too
+            self._sync()
+            if self.total_bytes <= self.max_bytes:
+                return
+
+            pinned = self._pinned_anywhere()
+            if self.policy == "lfu" and self.db is not None:
+                # Counted by every process, and kept across restarts
+                for song_id, plays in self.db.play_counts().items():
+                    if (entry := self.entries.get(song_id)) is not None:
+                        entry.plays = plays
+
+            freed = False
+            with self._lock:
+                candidates = sorted(
+                    (e for k, e in self.entries.items() if k not in pinned),
+                    key=self._eviction_key,
+                )
+                for entry in candidates:
+                    if self.total_bytes <= self.max_bytes:
+                        break
+
+                    entry.path.unlink(missing_ok=True)
+                    del self.entries[entry.path.stem]
+                    freed |= self._uncount(entry)
+                    self.evictions += 1
+
+            if freed:
+                self.collect_objects()
+
+    @property
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            entries=len(self.entries),
+            bytes=self.total_bytes,
+            max_bytes=self.max_bytes,
+            pinned=len(self.pinned),
+            shared=len(self.entries) - len(self._links),
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            index_builds=self.index_builds,
+            last_build_ms=self.last_build_ms,
+        )
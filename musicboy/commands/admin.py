@@ -0,0 +1,135 @@
+from discord.ext import commands
+
+from musicboy import metrics
+from musicboy.bot import Context
+
+
+class Admin(commands.Cog):
+    @commands.command(name="reindex")
+    @commands.is_owner()
+    async def reindex(self, ctx: Context):
+        """Rebuilds the audio file index from the data directory"""
+        ctx.cache.rebuild()
+        await ctx.send(
+            f"Indexed {len(ctx.cache.entries)} files in {ctx.cache.last_build_ms:.0f}ms"
+        )
+
+    @commands.command(name="cachestats", aliases=["cache"])
+    @commands.is_owner()
+    async def cache_stats(self, ctx: Context):
+        """Displays audio cache statistics"""
+        stats = ctx.cache.stats
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = 100 * stats["hits"] / lookups if lookups else 0
+        await ctx.send(
+            f"{stats['entries']} files, "
+            f"{stats['bytes'] / 1024**2:.0f}/{stats['max_bytes'] / 1024**2:.0f} MiB, "
+            f"{stats['pinned']} pinned, {stats['shared']} sharing another's audio\n"
+            f"Hit rate {hit_rate:.1f}% ({stats['hits']}/{lookups}), "
+            f"{stats['evictions']} evictions\n"
+            f"Index built {stats['index_builds']}x, last took {stats['last_build_ms']:.0f}ms"
+        )
+
+    @commands.command(name="dbstats")
+    @commands.is_owner()
+    async def db_stats(self, ctx: Context):
+        """Displays metadata cache statistics"""
+        stats = ctx.db.cache.stats
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = 100 * stats["hits"] / lookups if lookups else 0
+        await ctx.send(
+            f"{stats['entries']} cached rows, {stats['negative_entries']} known missing\n"
+            f"Hit rate {hit_rate:.1f}% ({stats['hits']}/{lookups})"
+        )
+
+    @commands.command(name="warmup")
+    @commands.is_owner()
+    async def warmup(self, ctx: Context):
+        """Displays startup warm-up progress"""
+        progress = ctx.bot.warmup.progress
+        await ctx.send(
+            f"Warm: {progress['warmed']}, failed: {progress['failed']},"
+            f" in progress: {progress['running']}, queued at startup: {progress['queued']}"
+            f" ({ctx.bot.warmup_mode} mode)"
+        )
+
+    @commands.command(name="downloads", aliases=["dl"])
+    @commands.is_owner()
+    async def downloads(self, ctx: Context):
+        """Displays downloads in progress and queued"""
+        lines = []
+        for job in ctx.bot.prefetch.jobs.values():
+            status = "queued"
+            if job.progress is not None:
+                done, total = (
+                    job.progress["downloaded_bytes"],
+                    job.progress["total_bytes"],
+                )
+                status = (
+                    f"{100 * done / total:.0f}%"
+                    if total
+                    else f"{done / 1024**2:.1f} MiB"
+                )
+            elif job.running:
+                status = "starting"
+            lines.append(f"{job.song['title'][:60]}: {status}")
+
+        await ctx.send("\n".join(lines[:20]) or "Nothing downloading")
+
+    @commands.command(name="memory", aliases=["mem"])
+    @commands.is_owner()
+    async def memory(self, ctx: Context):
+        """Displays memory held per guild and the guilds holding the most"""
+        states = ctx.bot.guild_states
+        usage = states.memory_usage()
+        top = sorted(usage.items(), key=lambda item: item[1], reverse=True)[:10]
+        lines = [
+            f"{len(states.loaded())} playlists loaded, {len(states.stored)} unloaded,"
+            f" {sum(usage.values()) / 1024:.1f} KiB across {len(usage)} guilds",
+            f"{states.loads} loads, {states.evictions} evictions",
+        ]
+        for guild_id, size in top:
+            guild = ctx.bot.get_guild(guild_id)
+            lines.append(f"{guild.name if guild else guild_id}: {size / 1024:.1f} KiB")
+
+        await ctx.send("\n".join(lines))
+
+    @commands.command(name="stats", aliases=["metrics"])
+    @commands.is_owner()
+    async def stats(self, ctx: Context):
+        """Displays counters, gauges and latency metrics"""
+        if not metrics.enabled:
+            return await ctx.send("Metrics are disabled")
+
+        def labelled(name: str, labels: tuple[tuple[str, str], ...]) -> str:
+            label_str = ",".join(f"{k}={v}" for k, v in labels)
+            return f"{name}{{{label_str}}}" if labels else name
+
+        lines = [
+            f"{labelled(name, labels)} {c.value:g}"
+            for (name, labels), c in sorted(metrics.counters.items())
+        ]
+        lines += [
+            f"{labelled(name, labels)} {value:g}"
+            for (name, labels), (_, value) in sorted(metrics.collected().items())
+        ]
+        for (name, labels), h in sorted(metrics.histograms.items()):
+            lines.append(
+                f"{labelled(name, labels)} n={h.count}"
+                f" avg={h.sum / h.count if h.count else 0:.3f}"
+                f" p50<={h.quantile(0.5)} p99<={h.quantile(0.99)}"
+            )
+
+        # Stay inside Discord's message length limit
+        text = ""
+        for line in lines:
+            if len(text) + len(line) > 1900:
+                await ctx.send(f"```\n{text}```")
+                text = ""
+            text += line + "\n"
+
+        await ctx.send(f"```\n{text}```" if text else "No metrics recorded yet")
+
+
+async def setup(bot):
+    await bot.add_cog(Admin(bot))
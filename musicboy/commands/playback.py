@@ -1,20 +1,45 @@
-from pathlib import Path
+import asyncio
+from time import perf_counter
 
 import discord
+from asyncer import asyncify
 from discord.ext import commands
 
+from musicboy.audio import GaplessSource, TrackedSource, make_source
 from musicboy.bot import Context
-from musicboy.playlist import (
-    PlaylistExhausted,
-    cache_next_songs,
-    cache_song_async,
-    get_song_path,
-)
-from musicboy.progress import ProgressTracker, seconds_to_duration
-from musicboy.sources.youtube.youtube import fetch_metadata
+from musicboy.loudness import backfill_loudness, gain_for
+from musicboy.metadata import resolve_metadata
+from musicboy.metrics import histogram
+from musicboy.playlist import PlaylistExhausted
+from musicboy.prefetch import IMMEDIATE
+from musicboy.progress import ProgressTracker, duration_to_seconds, seconds_to_duration
+from musicboy.queueview import QueueView
+from musicboy.sources.youtube.urls import canonical_url
+from musicboy.sources.youtube.youtube import SongMetadata
+
+# Open the next song's source this long before the current one ends
+PRELOAD_SECONDS = 5
+# Commands that can start a song, so are worth warming the guild's queue for
+STARTS_PLAYBACK = {"play", "next", "prev", "seek"}
+
+
+async def report_failures(ctx: Context, errors: dict[str, Exception]):
+    if not errors:
+        return
+
+    lines = [f"<{url}>: {e}"[:200] for url, e in errors.items()]
+    if len(lines) > 10:
+        lines = [*lines[:10], f"...and {len(lines) - 10} more"]
+
+    await ctx.reply("Couldn't add:\n" + "\n".join(lines))
 
 
-def after_song_finished(ctx: Context, error=None):
+def after_song_finished(ctx: Context, source: GaplessSource, error=None):
+    ended_at = perf_counter()
+    if source.stopped:
+        # Replaced by a skip or seek, which starts the next song itself
+        return
+
     if ctx.voice_client is None or not ctx.voice_client.is_connected():
         return
 
@@ -29,78 +54,189 @@ def after_song_finished(ctx: Context, error=None):
     except PlaylistExhausted:
         return
 
-    ctx.bot.loop.create_task(play_song(ctx))
-    ctx.bot.loop.create_task(cache_next_songs(playlist, ctx.db))
+    ctx.bot.loop.create_task(play_song(ctx, transition_from=ended_at))
+
 
-    guild_ids = [v.guild.id for v in ctx.bot.voice_clients]
+def song_advanced(ctx: Context, source: GaplessSource, song: SongMetadata):
+    """Catch up after the voice thread moved on to a preloaded song"""
+    playlist = ctx.playlist
+    if playlist is None:
+        return
 
-    for k in ctx.bot.progress:
-        if k not in guild_ids:
-            del ctx.bot.progress[k]
+    try:
+        playlist.next()
+    except PlaylistExhausted:
+        return
 
+    ctx.update_last_active()
+    ctx.bot.loop.create_task(song_started(ctx, source, song))
 
-def source_from_id(song_id: str):
-    return make_source(str(get_song_path(song_id)))
 
+async def open_source(
+    ctx: Context,
+    song: SongMetadata,
+    requested_at: float | None = None,
+    offset: float = 0.0,
+) -> TrackedSource:
+    if ctx.guild is None:
+        raise ValueError("Bot must be in a guild (not DM or group DM)")
 
-def make_source(path: str, volume: float = 0.05):
-    return discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(path), volume=volume)
+    gain = gain_for(song.get("loudness"))
+    playlist = ctx.playlist
+    volume = playlist.volume if playlist is not None else 0.05
+    path = ctx.cache.get(song["id"])
+    if path is not None and not path.exists():
+        # Evicted by another process sharing the data dir
+        ctx.cache.discard(song["id"])
+        path = None
+    if path is None:
+        # ...which may also have downloaded it since we last looked
+        path = ctx.cache.find(song["id"])
+    if path is None and ctx.bot.stream_first:
+        # Play straight from YouTube while the download lands in the cache
+        stream_url = await ctx.bot.downloads.resolve_stream(song)
+        ctx.bot.prefetch.submit(song, ctx.guild.id, IMMEDIATE)
+        return make_source(
+            stream_url,
+            volume,
+            requested_at=requested_at,
+            stream=True,
+            gain=gain,
+            offset=offset,
+        )
 
+    if path is None:
+        path = await ctx.bot.prefetch.fetch(song, ctx.guild.id)
 
-async def play_song(ctx: Context):
-    if ctx.voice_client is None or not ctx.voice_client.is_connected():
-        return
+    if path is None:
+        raise ValueError("Can't play song. Audio not downloaded")
 
+    ctx.cache.touch(song["id"])
+    if song.get("loudness") is None and path.suffix != ".opus":
+        ctx.bot.loop.create_task(backfill_loudness(ctx.db, song["id"], path))
+
+    return make_source(
+        str(path), volume, requested_at=requested_at, gain=gain, offset=offset
+    )
+
+
+async def preload_next(ctx: Context, source: GaplessSource, song: SongMetadata):
+    """Open and prime the next song shortly before the current one ends"""
+    progress = ctx.progress
     playlist = ctx.playlist
-    if playlist is None:
+    if progress is None or playlist is None:
         return
 
-    if ctx.guild is None:
-        raise ValueError("Bot must be in a guild (not DM or group DM)")
+    while True:
+        remaining = song["duration"] - progress.elapsed_seconds
+        if remaining > PRELOAD_SECONDS:
+            await asyncio.sleep(remaining - PRELOAD_SECONDS)
+        elif (url := playlist.next_song) is None:
+            # Nothing queued yet, but something may be added in time
+            await asyncio.sleep(1)
+        else:
+            break
 
-    song = ctx.db.get_metadata(playlist.current)
-    path = get_song_path(song["id"])
-    if path is None:
-        await cache_song_async(song, Path(playlist.data_dir) / song["id"])
-        path = get_song_path(song["id"])
+        if ctx.voice_client is None or ctx.voice_client.source is not source:
+            return
 
-    if path is None:
-        raise ValueError("Can't play song. Audio not downloaded")
+    next_song = await ctx.db.aget_metadata(url)
+    next_source = await open_source(ctx, next_song)
+    await asyncify(next_source.prime)()
+    if ctx.voice_client is None or ctx.voice_client.source is not source:
+        return next_source.cleanup()
 
-    if ctx.voice_client.is_playing():
-        ctx.voice_client.source = source_from_id(song["id"])
-        ctx.voice_client.source.volume = ctx.playlist.volume
-    else:
-        ctx.voice_client.play(
-            make_source(str(path), ctx.playlist.volume),
-            after=lambda error: after_song_finished(ctx, error),
-            bitrate=256,
-            signal_type="music",
-        )
+    source.queue(
+        next_source,
+        still_next=lambda: playlist.next_song == url,
+        on_start=lambda: ctx.bot.loop.call_soon_threadsafe(
+            song_advanced, ctx, source, next_song
+        ),
+    )
+
+
+async def song_started(ctx: Context, source: GaplessSource, song: SongMetadata):
+    if ctx.guild is None or (playlist := ctx.playlist) is None:
+        return
 
     guild_id = ctx.guild.id
-    progress = ProgressTracker()
-    progress.start()
-    ctx.bot.progress[guild_id] = progress
+    current = source.current
+    ctx.bot.progress[guild_id] = ProgressTracker(
+        current if isinstance(current, TrackedSource) else None
+    )
     ctx.update_last_active()
 
+    if (task := ctx.bot.preloads.pop(guild_id, None)) is not None:
+        task.cancel()
+    ctx.bot.preloads[guild_id] = ctx.bot.loop.create_task(
+        preload_next(ctx, source, song)
+    )
+
+    await ctx.bot.prefetch.schedule(
+        playlist, remaining=max(song["duration"] - playlist.elapsed, 0)
+    )
+
+
+async def play_song(ctx: Context, transition_from: float | None = None):
+    requested_at = perf_counter()
+    if ctx.voice_client is None or not ctx.voice_client.is_connected():
+        return
+
+    playlist = ctx.playlist
+    if playlist is None:
+        return
+
+    song = await ctx.db.aget_metadata(playlist.current)
+    # Picks up where the song left off after a seek, reconnect or restart
+    offset = playlist.elapsed if 0 < playlist.elapsed < song["duration"] else 0.0
+    inner = await open_source(ctx, song, requested_at=requested_at, offset=offset)
+    inner.transition_from = transition_from
+    source = GaplessSource(inner)
+
+    previous = ctx.voice_client.source
+    if ctx.voice_client.is_playing() or ctx.voice_client.is_paused():
+        # A fresh player rather than swapping sources, since the new song may
+        # need an encoder the old one didn't. Stopping cleans up the old
+        # sources, and the mark keeps it from moving the queue on.
+        if isinstance(previous, GaplessSource):
+            previous.stopped = True
+        ctx.voice_client.stop()
+
+    ctx.voice_client.play(
+        source,
+        after=lambda error: after_song_finished(ctx, source, error),
+        bitrate=256,
+        signal_type="music",
+    )
+    histogram("play_song_seconds").observe(perf_counter() - requested_at)
+
+    await song_started(ctx, source, song)
+
 
 class Playback(commands.Cog):
+    async def cog_before_invoke(self, ctx: Context):
+        if ctx.guild is None:
+            return
+
+        await ctx.load_playlist()
+        # Warming fetches metadata and pins the next songs, which is wasted on
+        # a guild that only looked at its queue
+        if ctx.command is not None and ctx.command.name in STARTS_PLAYBACK:
+            await ctx.bot.warmup.ensure(ctx.guild.id)
+
     @commands.command(name="play", aliases=["p", "prepend"])
     async def play(self, ctx: Context, *, url_or_urls: str | None):
         """Play, resume, or queue a song next"""
         if ctx.voice_client is not None:
             if ctx.voice_client.is_paused():
-                ctx.progress.start()
                 return ctx.voice_client.resume()
 
-        if ctx.playlist is None:
-            return
-
         if url_or_urls is None:
-            if len(ctx.playlist.playlist) == 0:
+            if ctx.playlist is None or len(ctx.playlist.playlist) == 0:
                 await ctx.message.add_reaction("❌")
                 return
+        elif await ctx.load_playlist(create=True) is None:
+            return
 
         if ctx.voice_client is None:
             try:
@@ -111,14 +247,28 @@ class Playback(commands.Cog):
         if url_or_urls is None:
             return await play_song(ctx)
 
-        for url in url_or_urls.split():
-            url = url.split("&")[0]
-            meta = await fetch_metadata(url_or_urls)
-            ctx.db.write_metadata(meta)
-            ctx.playlist.prepend_song(url)
-            await cache_song_async(
-                meta,
-                Path(ctx.playlist.data_dir) / meta["id"],
+        songs, errors = await resolve_metadata(
+            map(canonical_url, url_or_urls.split()), ctx.db
+        )
+        await report_failures(ctx, errors)
+
+        playlist = ctx.playlist
+        playlist.prepend_songs([meta["url"] for meta in songs])
+
+        # Only the next few songs; the scheduler fetches the rest of a pasted
+        # playlist as they come up
+        upcoming = set(
+            playlist.playlist[
+                playlist.idx : playlist.idx + ctx.bot.prefetch.lookahead + 1
+            ]
+        )
+        soonest = [meta for meta in songs if meta["url"] in upcoming]
+        if ctx.bot.stream_first:
+            for meta in soonest:
+                ctx.bot.prefetch.submit(meta, playlist.guild_id, IMMEDIATE)
+        else:
+            await asyncio.gather(
+                *(ctx.bot.prefetch.fetch(meta, playlist.guild_id) for meta in soonest)
             )
 
         if ctx.voice_client.is_playing():
@@ -131,23 +281,15 @@ class Playback(commands.Cog):
     @commands.command(name="add", aliases=["append"])
     async def add_to_queue(self, ctx: Context, *, urls: str):
         """Adds a song to the end of the queue"""
-        if ctx.playlist is None:
+        if (playlist := await ctx.load_playlist(create=True)) is None:
             return
 
-        fail = False
-        for url in urls.split():
-            url = url.split("&")[0]
-            try:
-                meta = await fetch_metadata(url)
-            except Exception:
-                fail = True
-                continue
-
-            ctx.db.write_metadata(meta)
-            ctx.playlist.append_song(url)
+        songs, errors = await resolve_metadata(map(canonical_url, urls.split()), ctx.db)
+        playlist.extend_songs([meta["url"] for meta in songs])
 
-        if fail:
+        if errors:
             await ctx.message.add_reaction("❌")
+            await report_failures(ctx, errors)
 
         await ctx.message.add_reaction("✅")
 
@@ -157,6 +299,9 @@ class Playback(commands.Cog):
         if ctx.voice_client is not None:
             await ctx.voice_client.disconnect(force=True)
 
+        if ctx.guild is not None:
+            ctx.bot.voice_disconnected(ctx.guild.id)
+
     @commands.command(name="next", aliases=["skip"])
     async def next_song(self, ctx: Context):
         """Skips to the next song in queue"""
@@ -174,8 +319,6 @@ class Playback(commands.Cog):
         if ctx.voice_client and ctx.voice_client.is_connected():
             await play_song(ctx)
 
-        await cache_next_songs(playlist, ctx.db)
-
         await ctx.message.add_reaction("✅")
 
     @commands.command(name="prev", aliases=["previous", "back"])
@@ -196,8 +339,39 @@ class Playback(commands.Cog):
     async def pause(self, ctx: Context):
         """Pauses playback"""
         if ctx.voice_client and ctx.voice_client.is_playing():
-            ctx.progress.stop()
             ctx.voice_client.pause()
+            if ctx.playlist is not None and ctx.progress is not None:
+                ctx.playlist.save_elapsed(ctx.progress.position)
+
+    @commands.command(name="seek")
+    async def seek(self, ctx: Context, position: str):
+        """Jumps to a point in the current song
+
+        Takes a timestamp like 1:30 or 90, or +30/-10 to skip forward or back"""
+        playlist = ctx.playlist
+        if playlist is None or len(playlist.playlist) == 0:
+            return await ctx.message.add_reaction("❌")
+
+        try:
+            seconds = duration_to_seconds(position.lstrip("+-"))
+        except ValueError:
+            return await ctx.reply("Position must look like 1:30, 90, +30 or -10")
+
+        if position[0] in "+-":
+            current = ctx.progress.position if ctx.progress else playlist.elapsed
+            seconds = current + seconds if position[0] == "+" else current - seconds
+
+        song = await ctx.db.aget_metadata(playlist.current)
+        if not 0 <= seconds < song["duration"]:
+            return await ctx.reply(
+                f"Position must be within {seconds_to_duration(song['duration'])}"
+            )
+
+        playlist.save_elapsed(seconds)
+        if ctx.voice_client and ctx.voice_client.is_connected():
+            await play_song(ctx)
+
+        await ctx.message.add_reaction("✅")
 
     @commands.command(name="shuffle")
     async def shuffle(self, ctx: Context):
@@ -208,34 +382,14 @@ class Playback(commands.Cog):
         await ctx.message.add_reaction("✅")
 
     @commands.command(name="queue", aliases=["q", "list", "playlist"])
-    async def playlist(self, ctx: Context):
-        """Displays the playlist"""
+    async def playlist(self, ctx: Context, page: int = 1):
+        """Displays the playlist, a page at a time"""
         playlist = ctx.playlist
         if playlist is None or len(playlist.playlist) == 0:
             return await ctx.message.add_reaction("❌")
 
-        em = discord.Embed(color=discord.Color(0x000000))
-        next_up = playlist.playlist[playlist.idx + 1 :]
-        songs_remaining = len(next_up) + 1
-        em.title = f"Playlist ({songs_remaining})"
-        if next_up is not None:
-            next_songs = []
-            for idx, url in enumerate(next_up):
-                song = ctx.db.get_metadata(url)
-                duration = seconds_to_duration(song["duration"])
-                next_songs.append(
-                    f"**{idx+2}.** [{song['title']}]({song['url']}) ({duration})"
-                )
-            description = "\n".join(next_songs)
-        else:
-            description = "No more songs in the queue"
-
-        meta = ctx.db.get_metadata(playlist.current)
-        description = f"**1.** [{meta['title']}]({meta['url']}) ({seconds_to_duration(meta['duration'])}) {" (Now playing)" if ctx.voice_client and ctx.voice_client.is_playing() else ""}\n{description}"
-
-        em.description = description
-
-        await ctx.send(embed=em)
+        view = QueueView(ctx.bot.queue_pages, playlist, page - 1, ctx.voice_client)
+        view.message = await ctx.send(embed=await view.render(), view=view)
 
     @commands.command(name="np", aliases=["now", "playing", "progress", "prog"])
     async def now_playing(self, ctx: Context):
@@ -250,25 +404,32 @@ class Playback(commands.Cog):
         ):
             return
 
-        meta = ctx.db.get_metadata(playlist.current)
+        songs = await ctx.db.aget_many(
+            [playlist.current, *([playlist.next_song] if playlist.next_song else [])]
+        )
+        # Songs without stored metadata are shown by URL, as in !!queue
+        meta = songs.get(playlist.current)
         em = discord.Embed(color=discord.Color(0x000000))
-        em.title = f'{"⏸️" if ctx.voice_client.is_paused() else "▶️"} {meta["title"]}'
-        em.url = meta["url"]
+        title = meta["title"] if meta else playlist.current
+        em.title = f'{"⏸️" if ctx.voice_client.is_paused() else "▶️"} {title}'
+        em.url = meta["url"] if meta else playlist.current
         progress = ctx.progress
-        em.add_field(
-            name="Progress",
-            value=(
-                f"{progress.elapsed} / {seconds_to_duration(meta['duration'])}"
+        position = progress.elapsed
+        if meta and meta["duration"]:
+            position += (
+                f" / {seconds_to_duration(meta['duration'])}"
                 f" ({int(100 * progress.elapsed_seconds / meta['duration'])}%)"
-            ),
-        )
+            )
+        em.add_field(name="Progress", value=position)
 
         up_next = "*Nothing*"
         if playlist.next_song:
-            next_meta = ctx.db.get_metadata(playlist.next_song)
+            next_meta = songs.get(playlist.next_song)
             up_next = (
                 f"[{next_meta['title']}]({next_meta['url']})"
                 f" ({seconds_to_duration(next_meta['duration'])})"
+                if next_meta
+                else f"<{playlist.next_song}>"
             )
 
         em.add_field(
@@ -295,6 +456,7 @@ class Playback(commands.Cog):
             return
 
         ctx.playlist.clear()
+        ctx.bot.prefetch.cancel(ctx.playlist.guild_id)
         await ctx.message.add_reaction("✅")
 
     @commands.command(name="rm", aliases=["remove", "del", "delete"])
@@ -305,10 +467,13 @@ class Playback(commands.Cog):
         if ctx.playlist is None:
             return
 
-        if isinstance(index_or_url, int):
-            ctx.playlist.remove_index(index_or_url)
-        elif isinstance(index_or_url, str):
-            ctx.playlist.remove_song(index_or_url)
+        try:
+            if isinstance(index_or_url, int):
+                ctx.playlist.remove_index(index_or_url)
+            elif isinstance(index_or_url, str):
+                ctx.playlist.remove_song(index_or_url)
+        except ValueError:
+            return await ctx.message.add_reaction("❌")
 
         await ctx.message.add_reaction("✅")
 
@@ -324,7 +489,11 @@ class Playback(commands.Cog):
                 "Position must be greater than 1. Playing song next (position 2)"
             )
 
-        ctx.playlist.move_song(song_position, new_position)
+        try:
+            ctx.playlist.move_song(song_position, new_position)
+        except ValueError as e:
+            return await ctx.reply(str(e))
+
         await ctx.message.add_reaction("✅")
 
     @commands.command(name="vol", aliases=["volume"])
@@ -1,41 +1,441 @@
+import asyncio
+import queue
 import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic, perf_counter, time
+from typing import Any, TypedDict
 
+from musicboy.metrics import histogram
+from musicboy.sources.youtube.urls import canonical_url
 from musicboy.sources.youtube.youtube import SongMetadata
 
+# SQLite's default limit on host parameters in a single statement
+MAX_QUERY_PARAMS = 999
+
+METADATA_COLUMNS = "id, url, title, duration, loudness, fetched_at"
+SELECT_METADATA = f"SELECT {METADATA_COLUMNS} FROM metadata WHERE url = ?"
+# Upsert rather than REPLACE so refreshing metadata keeps the measured loudness
+REPLACE_METADATA = (
+    "INSERT INTO metadata(url, id, title, duration, fetched_at)"
+    " VALUES (?, ?, ?, ?, ?)"
+    " ON CONFLICT(url) DO UPDATE SET"
+    " id = excluded.id, title = excluded.title, duration = excluded.duration,"
+    " fetched_at = excluded.fetched_at"
+)
+
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+Write = Callable[[sqlite3.Connection], Any]
+
+
+@contextmanager
+def timed(op: str):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        histogram("db_query_seconds", op=op).observe(perf_counter() - start)
+
+
+def canonicalize_urls(connection: sqlite3.Connection):
+    """Rewrite URLs stored before they were canonicalised"""
+    for (url,) in connection.execute("SELECT url FROM metadata").fetchall():
+        canonical = canonical_url(url)
+        if canonical != url:
+            # Keeps the canonical row if both spellings were stored
+            connection.execute(
+                "UPDATE OR IGNORE metadata SET url = ? WHERE url = ?", (canonical, url)
+            )
+            connection.execute("DELETE FROM metadata WHERE url = ?", (url,))
+
+    urls = connection.execute("SELECT DISTINCT url FROM playlist_entries").fetchall()
+    connection.executemany(
+        "UPDATE playlist_entries SET url = ? WHERE url = ?",
+        [
+            (canonical, url)
+            for (url,) in urls
+            if (canonical := canonical_url(url)) != url
+        ],
+    )
+
+
+def _by_requested(
+    requested: dict[str, str], found: dict[str, SongMetadata]
+) -> dict[str, SongMetadata]:
+    """Results keyed by the URLs as the caller spelled them"""
+    return {url: found[key] for url, key in requested.items() if key in found}
+
+
+class MetadataCacheStats(TypedDict):
+    entries: int
+    negative_entries: int
+    hits: int
+    misses: int
+
+
+class MetadataCache:
+    """LRU of metadata rows, plus a short-lived record of URLs with no row"""
+
+    def __init__(self, size: int = 4096, negative_ttl: float = 60):
+        self.size = size
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, SongMetadata] = OrderedDict()
+        self._missing: dict[str, float] = {}
+        self._lock = Lock()
+
+    def get(self, url: str) -> tuple[bool, SongMetadata | None]:
+        """Returns whether the URL was cached, and its metadata if it exists"""
+        with self._lock:
+            meta = self._entries.get(url)
+            if meta is not None:
+                self._entries.move_to_end(url)
+                self.hits += 1
+                return True, meta
+
+            expires = self._missing.get(url)
+            if expires is not None:
+                if expires > monotonic():
+                    self.hits += 1
+                    return True, None
+
+                del self._missing[url]
+
+            self.misses += 1
+            return False, None
+
+    def put(self, meta: SongMetadata):
+        with self._lock:
+            old = self._entries.get(meta["url"])
+            if old is not None and "loudness" not in meta and "loudness" in old:
+                meta = SongMetadata(**meta, loudness=old["loudness"])
+
+            self._missing.pop(meta["url"], None)
+            self._entries[meta["url"]] = meta
+            self._entries.move_to_end(meta["url"])
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def update_loudness(self, song_id: str, loudness: float):
+        with self._lock:
+            for url, meta in self._entries.items():
+                if meta["id"] == song_id:
+                    self._entries[url] = {**meta, "loudness": loudness}
+
+    def put_missing(self, url: str):
+        with self._lock:
+            self._entries.pop(url, None)
+            now = monotonic()
+            if len(self._missing) >= self.size:
+                self._missing = {u: t for u, t in self._missing.items() if t > now}
+            self._missing[url] = now + self.negative_ttl
+
+    @property
+    def stats(self) -> MetadataCacheStats:
+        return MetadataCacheStats(
+            entries=len(self._entries),
+            negative_entries=len(self._missing),
+            hits=self.hits,
+            misses=self.misses,
+        )
+
+
+class DatabaseWriter(threading.Thread):
+    """Owns the only writing connection and commits queued writes in groups
+
+    Each batch runs in a single transaction, so a burst of writes costs one
+    commit instead of one per write."""
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection], batch_size=256):
+        super().__init__(name="musicboy-db-writer", daemon=True)
+        self.connect = connect
+        self.batch_size = batch_size
+        self.queue: queue.SimpleQueue[tuple[Write, Future] | None] = queue.SimpleQueue()
+
+    def submit(self, write: Write) -> Future:
+        future = Future()
+        self.queue.put((write, future))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        connection = self.connect()
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                running = False
+            jobs = [job for job in batch if job is not None]
+            if not jobs:
+                continue
+
+            with timed("commit"):
+                try:
+                    with connection:
+                        results = [write(connection) for write, _ in jobs]
+                except Exception:
+                    # Find the bad write(s) without failing the whole batch
+                    for job in jobs:
+                        self._run_alone(connection, *job)
+                    continue
+
+            histogram("db_commit_batch_size", buckets=BATCH_BUCKETS).observe(len(jobs))
+            for (_, future), result in zip(jobs, results):
+                future.set_result(result)
+
+        connection.close()
+
+    def _run_alone(self, connection: sqlite3.Connection, write: Write, future: Future):
+        try:
+            with connection:
+                future.set_result(write(connection))
+        except Exception as e:
+            print("Database write failed", e)
+            future.set_exception(e)
+
 
 class Database:
-    def __init__(self, path: str = "musicboy/data/database.sqlite"):
+    def __init__(
+        self,
+        path: str = "musicboy/data/database.sqlite",
+        cache_size: int = 4096,
+        readers: int = 4,
+    ):
         self.path = path
-        self.connection = sqlite3.connect(self.path, check_same_thread=False)
-        self.connection.row_factory = sqlite3.Row
+        self.cache = MetadataCache(cache_size)
+        self._local = threading.local()
+        self._readers = ThreadPoolExecutor(readers, thread_name_prefix="musicboy-db")
+        self.writer = DatabaseWriter(self._connect)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self.path, check_same_thread=False, cached_statements=256
+        )
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA busy_timeout = 5000")
+        return connection
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Read connection for the calling thread"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+
+        return connection
 
     def initialize_db(self):
-        cursor = self.connection.cursor()
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS metadata (url TEXT PRIMARY KEY, id TEXT, title TEXT, duration INTEGER)"
+        def init(connection: sqlite3.Connection):
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS metadata (url TEXT PRIMARY KEY, id TEXT, title TEXT, duration INTEGER)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS playlists (guild_id INTEGER PRIMARY KEY, idx INTEGER NOT NULL DEFAULT 0, volume REAL NOT NULL DEFAULT 0.05)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS playlist_entries (guild_id INTEGER NOT NULL, position REAL NOT NULL, url TEXT NOT NULL, PRIMARY KEY (guild_id, position)) WITHOUT ROWID"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_pins (guild_id INTEGER NOT NULL, song_id TEXT NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (guild_id, song_id)) WITHOUT ROWID"
+            )
+
+            columns = [
+                r["name"] for r in connection.execute("PRAGMA table_info(metadata)")
+            ]
+            if "loudness" not in columns:
+                connection.execute("ALTER TABLE metadata ADD COLUMN loudness REAL")
+            if "fetched_at" not in columns:
+                # Existing rows are left NULL, so they're refreshed on next use
+                connection.execute("ALTER TABLE metadata ADD COLUMN fetched_at REAL")
+            if "plays" not in columns:
+                connection.execute(
+                    "ALTER TABLE metadata ADD COLUMN plays INTEGER NOT NULL DEFAULT 0"
+                )
+
+            columns = [
+                r["name"] for r in connection.execute("PRAGMA table_info(playlists)")
+            ]
+            if "elapsed" not in columns:
+                connection.execute(
+                    "ALTER TABLE playlists ADD COLUMN elapsed REAL NOT NULL DEFAULT 0"
+                )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS metadata_id ON metadata (id)"
+            )
+            if connection.execute("PRAGMA user_version").fetchone()[0] < 1:
+                canonicalize_urls(connection)
+                connection.execute("PRAGMA user_version = 1")
+
+        self.writer.start()
+        self.writer.submit(init).result()
+
+    def close(self):
+        self.writer.close()
+        self._readers.shutdown()
+
+    async def _read(self, func: Callable[..., Any], *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._readers, func, *args
         )
-        self.connection.commit()
 
     def get_metadata(self, url: str) -> SongMetadata:
-        cursor = self.connection.cursor()
-        cursor.execute(
-            "SELECT id, url, title, duration FROM metadata WHERE url = ?", (url,)
-        )
-        res = cursor.fetchone()
-        if res is None:
+        url = canonical_url(url)
+        cached, meta = self.cache.get(url)
+        if not cached:
+            with timed("get_metadata"):
+                res = self.connection.execute(SELECT_METADATA, (url,)).fetchone()
+            if res is None:
+                self.cache.put_missing(url)
+            else:
+                meta = SongMetadata(**res)
+                self.cache.put(meta)
+
+        if meta is None:
             raise ValueError(f"Could not find metadata for {url}")
 
-        return SongMetadata(**res)
-
-    def write_metadata(self, metadata: SongMetadata):
-        cursor = self.connection.cursor()
-        cursor.execute(
-            "REPLACE INTO metadata(url, id, title, duration) VALUES (?, ?, ?, ?)",
-            (
-                metadata["url"],
-                metadata["id"],
-                metadata["title"],
-                metadata["duration"],
-            ),
+        return meta
+
+    async def aget_metadata(self, url: str) -> SongMetadata:
+        url = canonical_url(url)
+        cached, meta = self.cache.get(url)
+        if cached:
+            if meta is None:
+                raise ValueError(f"Could not find metadata for {url}")
+            return meta
+
+        return await self._read(self.get_metadata, url)
+
+    def _from_cache(
+        self, urls: Iterable[str]
+    ) -> tuple[dict[str, SongMetadata], list[str]]:
+        found: dict[str, SongMetadata] = {}
+        uncached: list[str] = []
+        for url in dict.fromkeys(urls):
+            cached, meta = self.cache.get(url)
+            if meta is not None:
+                found[url] = meta
+            elif not cached:
+                uncached.append(url)
+
+        return found, uncached
+
+    def get_many(self, urls: Iterable[str]) -> dict[str, SongMetadata]:
+        """Look up metadata for many URLs, skipping any that aren't stored"""
+        requested = {url: canonical_url(url) for url in urls}
+        found, uncached = self._from_cache(requested.values())
+        if uncached:
+            found.update(self._select_many(uncached))
+
+        return _by_requested(requested, found)
+
+    def _select_many(self, urls: list[str]) -> dict[str, SongMetadata]:
+        found: dict[str, SongMetadata] = {}
+        with timed("get_many"):
+            for i in range(0, len(urls), MAX_QUERY_PARAMS):
+                chunk = urls[i : i + MAX_QUERY_PARAMS]
+                rows = self.connection.execute(
+                    f"SELECT {METADATA_COLUMNS} FROM metadata"
+                    f" WHERE url IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                for row in rows:
+                    meta = SongMetadata(**row)
+                    found[meta["url"]] = meta
+                    self.cache.put(meta)
+
+        for url in urls:
+            if url not in found:
+                self.cache.put_missing(url)
+
+        return found
+
+    async def aget_many(self, urls: Iterable[str]) -> dict[str, SongMetadata]:
+        requested = {url: canonical_url(url) for url in urls}
+        found, uncached = self._from_cache(requested.values())
+        if uncached:
+            found.update(await self._read(self._select_many, uncached))
+
+        return _by_requested(requested, found)
+
+    def write_metadata(self, metadata: SongMetadata) -> Future:
+        """Queue a write of freshly fetched metadata
+
+        Readers see it right away through the cache."""
+        return self.write_metadata_many([metadata])
+
+    def write_metadata_many(self, metadata: Iterable[SongMetadata]) -> Future:
+        now = time()
+        rows = []
+        for meta in metadata:
+            meta = {**meta, "url": canonical_url(meta["url"]), "fetched_at": now}
+            self.cache.put(meta)
+            rows.append((meta["url"], meta["id"], meta["title"], meta["duration"], now))
+
+        return self.writer.submit(lambda c: c.executemany(REPLACE_METADATA, rows))
+
+    def write_play(self, song_id: str) -> Future:
+        row = (song_id,)
+        return self.writer.submit(
+            lambda c: c.execute(
+                "UPDATE metadata SET plays = plays + 1 WHERE id = ?", row
+            )
+        )
+
+    def play_counts(self) -> dict[str, int]:
+        """How often each song has been played, by song id"""
+        with timed("play_counts"):
+            rows = self.connection.execute(
+                "SELECT id, MAX(plays) AS plays FROM metadata"
+                " WHERE plays > 0 GROUP BY id"
+            ).fetchall()
+
+        return {r["id"]: r["plays"] for r in rows}
+
+    def write_pins(
+        self, guild_id: int, song_ids: Iterable[str], expires_at: float
+    ) -> Future:
+        """Replace the songs a guild has pinned in the audio cache"""
+        rows = [(guild_id, song_id, expires_at) for song_id in song_ids]
+
+        def write(c: sqlite3.Connection):
+            c.execute("DELETE FROM cache_pins WHERE guild_id = ?", (guild_id,))
+            c.executemany(
+                "INSERT INTO cache_pins(guild_id, song_id, expires_at) VALUES (?, ?, ?)",
+                rows,
+            )
+
+        return self.writer.submit(write)
+
+    def pinned_song_ids(self) -> set[str]:
+        """Songs pinned by any process sharing the database"""
+        with timed("pinned_song_ids"):
+            rows = self.connection.execute(
+                "SELECT DISTINCT song_id FROM cache_pins WHERE expires_at > ?",
+                (time(),),
+            ).fetchall()
+
+        return {r["song_id"] for r in rows}
+
+    def write_loudness(self, song_id: str, loudness: float) -> Future:
+        self.cache.update_loudness(song_id, loudness)
+        row = (loudness, song_id)
+        return self.writer.submit(
+            lambda c: c.execute("UPDATE metadata SET loudness = ? WHERE id = ?", row)
         )
-        self.connection.commit()
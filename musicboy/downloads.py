@@ -0,0 +1,353 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import multiprocessing
+import signal
+import threading
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import monotonic, perf_counter
+from typing import Any, TypedDict
+
+from musicboy.audio import transcode_to_opus
+from musicboy.cache import download_lock, find_audio, store_content
+from musicboy.loudness import gain_for, measure_loudness
+from musicboy.metrics import counter, histogram
+from musicboy.sources.youtube.youtube import (
+    SongMetadata,
+    download_audio,
+    resolve_stream_url,
+    warm_extractors,
+)
+
+# Report download progress at most this often per job
+PROGRESS_INTERVAL = 0.5
+DOWNLOAD_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+# Priority for work someone is waiting on right now. Lower runs first.
+IMMEDIATE = float("-inf")
+
+
+class DownloadProgress(TypedDict):
+    song_id: str
+    downloaded_bytes: int
+    total_bytes: int | None
+
+
+class DownloadFailed(Exception):
+    pass
+
+
+class DownloadTimeout(DownloadFailed):
+    pass
+
+
+def download_song(
+    song: SongMetadata,
+    data_dir: Path,
+    opus: bool = False,
+    progress_hooks: list[Callable[[dict[str, Any]], None]] | None = None,
+) -> tuple[Path, float | None]:
+    """Download a song into the data dir, returning its path and loudness
+
+    If another process sharing the data dir already has it, that file is
+    returned without a loudness, which is measured when it's first played."""
+    with download_lock(data_dir, song["id"]):
+        if (path := find_audio(data_dir, song["id"])) is not None:
+            return path, None
+
+        path = Path(
+            download_audio(song["url"], str(data_dir / song["id"]), progress_hooks)
+        )
+        loudness = measure_loudness(path)
+        if opus and path.suffix != ".opus":
+            path = transcode_to_opus(path, gain_for(loudness))
+
+        return store_content(data_dir, path), loudness
+
+
+# Set in each pool process by _init_worker
+_progress_queue: Any = None
+
+
+def _init_worker(progress_queue):
+    global _progress_queue
+    _progress_queue = progress_queue
+    # Ctrl+C is for the bot; it shuts the pool down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Jobs run on this thread, so its extractors are ready for the first one
+    warm_extractors()
+
+
+def _timed_out(signum, frame):
+    raise DownloadTimeout("Download took too long")
+
+
+def _run_job(
+    song: SongMetadata, data_dir: str, opus: bool, timeout: float
+) -> tuple[str, float | None]:
+    """Entry point in the pool process"""
+    last_report = 0.0
+
+    def report(status: dict[str, Any]):
+        nonlocal last_report
+        now = monotonic()
+        if (
+            status.get("status") != "downloading"
+            or now - last_report < PROGRESS_INTERVAL
+        ):
+            return
+
+        last_report = now
+        _progress_queue.put(
+            DownloadProgress(
+                song_id=song["id"],
+                downloaded_bytes=status.get("downloaded_bytes") or 0,
+                total_bytes=status.get("total_bytes")
+                or status.get("total_bytes_estimate"),
+            )
+        )
+
+    # Pool jobs run on the process' main thread, so an alarm can interrupt
+    # a stalled download. There's no SIGALRM on Windows; the bot's own
+    # deadline still applies there.
+    alarm = hasattr(signal, "SIGALRM")
+    if alarm:
+        signal.signal(signal.SIGALRM, _timed_out)
+        signal.alarm(max(1, int(timeout)))
+
+    try:
+        path, loudness = download_song(song, Path(data_dir), opus, [report])
+    except DownloadTimeout:
+        raise
+    except Exception as e:
+        # yt-dlp's errors carry tracebacks, which can't be sent back to the bot
+        raise DownloadFailed(f"{type(e).__name__}: {e}") from None
+    finally:
+        if alarm:
+            signal.alarm(0)
+
+    return str(path), loudness
+
+
+def _resolve_job(url: str) -> str:
+    """Entry point in the pool process for a stream URL"""
+    try:
+        return resolve_stream_url(url)
+    except Exception as e:
+        raise DownloadFailed(f"{type(e).__name__}: {e}") from None
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: float
+    seq: int
+    song_id: str = field(compare=False)
+    ready: asyncio.Future[None] = field(compare=False)
+
+
+class DownloadService:
+    """Downloads songs in a pool of separate processes
+
+    yt-dlp, FFmpeg's post-processing and loudness analysis all stay off the
+    bot's interpreter, so download bursts can't starve the gateway heartbeat
+    or the voice threads, and so does resolving stream URLs. Failed jobs are
+    retried with exponential backoff, and progress is reported back to any
+    callbacks registered for a song.
+
+    Jobs wait here for a free process, most urgent first, rather than in the
+    pool's own first-in, first-out queue. One process is kept for IMMEDIATE
+    jobs, so someone waiting on a song never queues behind prefetches."""
+
+    def __init__(
+        self,
+        data_dir: str | Path,
+        opus: bool = False,
+        processes: int = 2,
+        timeout: float = 300,
+        retries: int = 2,
+        backoff: float = 2.0,
+    ):
+        self.data_dir = Path(data_dir)
+        self.opus = opus
+        self.processes = processes
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.progress: dict[str, DownloadProgress] = {}
+        self._callbacks: dict[str, list[Callable[[DownloadProgress], None]]] = {}
+        self._mp = multiprocessing.get_context("spawn")
+        self._progress_queue = self._mp.Queue()
+        self._pool: ProcessPoolExecutor | None = None
+        self._reader: threading.Thread | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._running = 0
+        self._waiting: list[_Waiter] = []
+        self._seq = itertools.count()
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=self._mp,
+            initializer=_init_worker,
+            initargs=(self._progress_queue,),
+        )
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._pool = self._new_pool()
+        self._reader = threading.Thread(
+            target=self._read_progress, name="download-progress", daemon=True
+        )
+        self._reader.start()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        self._progress_queue.put(None)
+
+    def _read_progress(self):
+        while (progress := self._progress_queue.get()) is not None:
+            if self._loop is not None and not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._report, progress)
+
+    def _report(self, progress: DownloadProgress):
+        song_id = progress["song_id"]
+        if song_id not in self._callbacks:
+            return
+
+        self.progress[song_id] = progress
+        for callback in self._callbacks[song_id]:
+            callback(progress)
+
+    def _limit(self, priority: float) -> int:
+        return self.processes if priority == IMMEDIATE else max(self.processes - 1, 1)
+
+    def _dispatch(self):
+        while self._waiting:
+            waiter = self._waiting[0]
+            if waiter.ready.done():
+                # Cancelled, or a stale entry from before a promotion
+                heapq.heappop(self._waiting)
+                continue
+            if self._running >= self._limit(waiter.priority):
+                return
+
+            heapq.heappop(self._waiting)
+            self._running += 1
+            waiter.ready.set_result(None)
+
+    async def _acquire(self, song_id: str, priority: float):
+        waiter = _Waiter(
+            priority,
+            next(self._seq),
+            song_id,
+            asyncio.get_running_loop().create_future(),
+        )
+        heapq.heappush(self._waiting, waiter)
+        self._dispatch()
+        try:
+            await waiter.ready
+        except asyncio.CancelledError:
+            if waiter.ready.done() and not waiter.ready.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        self._running -= 1
+        self._dispatch()
+
+    def promote(self, song_id: str, priority: float):
+        """Move a song's waiting job up, now that something needs it sooner"""
+        for waiter in list(self._waiting):
+            if (
+                waiter.song_id == song_id
+                and priority < waiter.priority
+                and not waiter.ready.done()
+            ):
+                # The old entry shares the future, so it's skipped once set
+                heapq.heappush(
+                    self._waiting,
+                    _Waiter(priority, next(self._seq), song_id, waiter.ready),
+                )
+        self._dispatch()
+
+    async def _submit(self, song_id: str, priority: float, func: Callable, *args):
+        """Run ``func`` in the pool once a process is free for ``priority``"""
+        if self._pool is None:
+            raise RuntimeError("DownloadService hasn't been started")
+
+        await self._acquire(song_id, priority)
+        try:
+            pool = self._pool
+            job = asyncio.get_running_loop().run_in_executor(pool, func, *args)
+            try:
+                # A little slack over the in-process alarm
+                return await asyncio.wait_for(job, self.timeout + 30)
+            except BrokenProcessPool:
+                # A pool process died (OOM, segfault); start a fresh pool
+                if pool is self._pool:
+                    print("Download pool broke, restarting it")
+                    self._pool = self._new_pool()
+                raise
+        finally:
+            self._release()
+
+    async def resolve_stream(self, song: SongMetadata) -> str:
+        """A direct URL to a song's audio stream, resolved in the pool"""
+        return await self._submit(song["id"], IMMEDIATE, _resolve_job, song["url"])
+
+    async def download(
+        self,
+        song: SongMetadata,
+        on_progress: Callable[[DownloadProgress], None] | None = None,
+        priority: float = IMMEDIATE,
+    ) -> tuple[Path, float | None]:
+        """Download a song in the pool, returning its path and loudness"""
+        if self._pool is None:
+            raise RuntimeError("DownloadService hasn't been started")
+
+        callbacks = self._callbacks.setdefault(song["id"], [])
+        if on_progress is not None:
+            callbacks.append(on_progress)
+
+        started_at = perf_counter()
+        attempt = 0
+        try:
+            while True:
+                try:
+                    path, loudness = await self._submit(
+                        song["id"],
+                        priority,
+                        _run_job,
+                        song,
+                        str(self.data_dir),
+                        self.opus,
+                        self.timeout,
+                    )
+                except Exception as e:
+                    if attempt >= self.retries:
+                        counter("downloads_total", result="failed").inc()
+                        raise
+
+                    if not isinstance(e, BrokenProcessPool):
+                        delay = self.backoff * 2**attempt
+                        print(f"Retrying {song['url']} in {delay:.0f}s: {e}")
+                        await asyncio.sleep(delay)
+                else:
+                    counter("downloads_total", result="ok").inc()
+                    histogram("download_seconds", buckets=DOWNLOAD_BUCKETS).observe(
+                        perf_counter() - started_at
+                    )
+                    return Path(path), loudness
+
+                counter("download_retries_total").inc()
+                attempt += 1
+        finally:
+            self._callbacks.pop(song["id"], None)
+            self.progress.pop(song["id"], None)
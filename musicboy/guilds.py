@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+from collections.abc import Collection, Iterator, MutableMapping
+from concurrent.futures import Future
+from time import monotonic
+from typing import Generic, Literal, TypeVar
+
+from musicboy.playlist import Playlist
+from musicboy.progress import ProgressTracker
+from musicboy.store import PlaylistStore
+
+T = TypeVar("T")
+
+
+class GuildState:
+    """Everything the bot holds in memory for one guild"""
+
+    __slots__ = ("playlist", "progress", "preload", "last_used")
+
+    def __init__(self):
+        self.playlist: Playlist | None = None
+        self.progress: ProgressTracker | None = None
+        self.preload: asyncio.Task | None = None
+        self.last_used = monotonic()
+
+    def empty(self) -> bool:
+        return self.playlist is None and self.progress is None and self.preload is None
+
+
+class _SlotView(MutableMapping[int, T], Generic[T]):
+    """Dict-like view of one field across every guild's state"""
+
+    def __init__(self, registry: GuildRegistry, slot: Literal["progress", "preload"]):
+        self.registry = registry
+        self.slot = slot
+
+    def __getitem__(self, guild_id: int) -> T:
+        state = self.registry.states.get(guild_id)
+        value = getattr(state, self.slot) if state is not None else None
+        if value is None:
+            raise KeyError(guild_id)
+
+        return value
+
+    def __setitem__(self, guild_id: int, value: T):
+        setattr(self.registry.state(guild_id), self.slot, value)
+
+    def __delitem__(self, guild_id: int):
+        self[guild_id]
+        setattr(self.registry.states[guild_id], self.slot, None)
+        self.registry.prune(guild_id)
+
+    def __iter__(self) -> Iterator[int]:
+        return (
+            guild_id
+            for guild_id, state in list(self.registry.states.items())
+            if getattr(state, self.slot) is not None
+        )
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class _PlaylistView(MutableMapping[int, Playlist]):
+    """Every loaded playlist; saved ones are loaded with ``GuildRegistry.load``"""
+
+    def __init__(self, registry: GuildRegistry):
+        self.registry = registry
+
+    def __getitem__(self, guild_id: int) -> Playlist:
+        playlist = self.registry.playlist(guild_id)
+        if playlist is None:
+            raise KeyError(guild_id)
+
+        return playlist
+
+    def __setitem__(self, guild_id: int, playlist: Playlist):
+        self.registry.stored.pop(guild_id, None)
+        self.registry.state(guild_id).playlist = playlist
+
+    def __delitem__(self, guild_id: int):
+        state = self.registry.states.get(guild_id)
+        if state is None or state.playlist is None:
+            raise KeyError(guild_id)
+
+        state.playlist = None
+        self.registry.prune(guild_id)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.registry.loaded())
+
+    def __len__(self) -> int:
+        return len(self.registry.loaded())
+
+
+class GuildRegistry:
+    """Per-guild state, with playlists loaded on first use and evicted when cold
+
+    Guilds with a saved playlist are only known by id until something loads
+    it, which reads it off the event loop. Playlists are written through to the store as they change, so
+    evicting one just drops it from memory. ``playlists``, ``progress`` and
+    ``preloads`` are dict-like views for the rest of the bot."""
+
+    def __init__(self, store: PlaylistStore):
+        self.store = store
+        self.states: dict[int, GuildState] = {}
+        # Guilds with a saved playlist that isn't loaded, and the write that
+        # marks the end of its last changes, if it was evicted
+        self.stored: dict[int, Future | None] = {}
+        self._loading: dict[int, asyncio.Future] = {}
+        self.loads = 0
+        self.evictions = 0
+        self.playlists = _PlaylistView(self)
+        self.progress: _SlotView[ProgressTracker] = _SlotView(self, "progress")
+        self.preloads: _SlotView[asyncio.Task] = _SlotView(self, "preload")
+
+    def state(self, guild_id: int) -> GuildState:
+        state = self.states.get(guild_id)
+        if state is None:
+            state = self.states[guild_id] = GuildState()
+
+        return state
+
+    def prune(self, guild_id: int):
+        state = self.states.get(guild_id)
+        if state is not None and state.empty():
+            del self.states[guild_id]
+
+    def loaded(self) -> list[int]:
+        return [g for g, s in self.states.items() if s.playlist is not None]
+
+    def has_playlist(self, guild_id: int) -> bool:
+        state = self.states.get(guild_id)
+        return (
+            state is not None and state.playlist is not None
+        ) or guild_id in self.stored
+
+    def known(self) -> list[int]:
+        """Guilds with a playlist, loaded or not"""
+        return [*self.loaded(), *self.stored]
+
+    def playlist(self, guild_id: int) -> Playlist | None:
+        """A guild's playlist, if it's loaded"""
+        state = self.states.get(guild_id)
+        if state is None or state.playlist is None:
+            return None
+
+        state.last_used = monotonic()
+        return state.playlist
+
+    async def load(self, guild_id: int, create: bool = False) -> Playlist | None:
+        """A guild's playlist, loading it if it's saved, or creating it if asked"""
+        if (playlist := self.playlist(guild_id)) is not None:
+            return playlist
+
+        if guild_id in self.stored:
+            loading = self._loading.get(guild_id)
+            if loading is None:
+                loading = self._loading[guild_id] = asyncio.ensure_future(
+                    self._load(guild_id)
+                )
+            await asyncio.shield(loading)
+            return self.playlist(guild_id)
+
+        if not create:
+            return None
+
+        playlist = Playlist(guild_id, store=self.store)
+        self._set_playlist(guild_id, playlist)
+        return playlist
+
+    async def _load(self, guild_id: int):
+        try:
+            if (written := self.stored[guild_id]) is not None:
+                await asyncio.wrap_future(written)
+            saved = await self.store.aload(guild_id)
+            if saved is not None:
+                self.loads += 1
+                playlist = Playlist.from_state(saved, store=self.store)
+            else:
+                playlist = Playlist(guild_id, store=self.store)
+
+            del self.stored[guild_id]
+            self._set_playlist(guild_id, playlist)
+        finally:
+            del self._loading[guild_id]
+
+    def _set_playlist(self, guild_id: int, playlist: Playlist):
+        state = self.state(guild_id)
+        state.playlist = playlist
+        state.last_used = monotonic()
+
+    def evict(self, max_idle: float, keep: Collection[int] = ()) -> list[int]:
+        """Unload playlists unused for ``max_idle`` seconds, except ``keep``'s"""
+        cutoff = monotonic() - max_idle
+        evicted = []
+        for guild_id, state in list(self.states.items()):
+            if (
+                state.playlist is None
+                or state.last_used > cutoff
+                or state.progress is not None
+                or state.preload is not None
+                or guild_id in keep
+            ):
+                continue
+
+            state.playlist = None
+            self.store.forget(guild_id)
+            # Writes are committed in order, so once this one is the
+            # playlist's rows are up to date
+            self.stored[guild_id] = self.store.db.writer.submit(lambda c: None)
+            self.prune(guild_id)
+            evicted.append(guild_id)
+
+        self.evictions += len(evicted)
+        return evicted
+
+    def memory(self, guild_id: int) -> int:
+        """Approximate bytes held for a guild, not counting shared URLs"""
+        state = self.states.get(guild_id)
+        if state is None:
+            return 0
+
+        size = sys.getsizeof(state)
+        if (playlist := state.playlist) is not None:
+            size += sys.getsizeof(playlist) + sys.getsizeof(playlist.playlist)
+            keys = self.store._keys.get(guild_id)
+            if keys is not None:
+                size += sys.getsizeof(keys)
+        if state.progress is not None:
+            size += sys.getsizeof(state.progress)
+
+        return size
+
+    def memory_usage(self) -> dict[int, int]:
+        return {guild_id: self.memory(guild_id) for guild_id in list(self.states)}
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+from collections.abc import Awaitable, Callable
+from time import monotonic
+
+
+class IdleScheduler:
+    """Calls ``on_idle`` for a guild once it's been inactive for ``max_idle``
+
+    Deadlines sit in a heap, and the scheduler sleeps until the earliest one,
+    so its cost doesn't grow with the number of connected guilds. Recording
+    activity only updates a timestamp (and is safe from the voice threads);
+    a guild whose deadline has moved on is pushed back when its old one comes
+    up."""
+
+    def __init__(
+        self, max_idle: float, on_idle: Callable[[int, float], Awaitable[None]]
+    ):
+        self.max_idle = max_idle
+        self.on_idle = on_idle
+        # Guild -> monotonic time of its last activity
+        self.last_active: dict[int, float] = {}
+        self._heap: list[tuple[float, int]] = []
+        self._scheduled: set[int] = set()
+        self._wakeup = asyncio.Event()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._task = self._loop.create_task(self._run())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def touch(self, guild_id: int):
+        """Record activity in a guild. Can be called from any thread"""
+        self.last_active[guild_id] = monotonic()
+        if guild_id not in self._scheduled and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._schedule, guild_id)
+
+    def forget(self, guild_id: int):
+        """Stop tracking a guild; its heap entry is dropped when it comes up"""
+        self.last_active.pop(guild_id, None)
+
+    def idle_seconds(self, guild_id: int) -> float:
+        return monotonic() - self.last_active.get(guild_id, monotonic())
+
+    def _schedule(self, guild_id: int):
+        last_active = self.last_active.get(guild_id)
+        if last_active is None or guild_id in self._scheduled:
+            return
+
+        self._scheduled.add(guild_id)
+        heapq.heappush(self._heap, (last_active + self.max_idle, guild_id))
+        if self._heap[0][1] == guild_id:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            deadline, guild_id = self._heap[0]
+            delay = deadline - monotonic()
+            if delay > 0:
+                try:
+                    # Wakes early if a sooner deadline is scheduled meanwhile
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            self._scheduled.discard(guild_id)
+            last_active = self.last_active.get(guild_id)
+            if last_active is None:
+                continue
+
+            if last_active + self.max_idle > monotonic():
+                # Active since this deadline was set
+                self._schedule(guild_id)
+                continue
+
+            try:
+                await self.on_idle(guild_id, monotonic() - last_active)
+            except Exception as e:
+                print("Idle handler failed for guild", guild_id, e)
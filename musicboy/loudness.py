@@ -0,0 +1,72 @@
+import re
+import subprocess
+from pathlib import Path
+
+from asyncer import asyncify
+
+from musicboy.database import Database
+
+# Loudness every song is brought to before the guild's volume applies
+TARGET_LUFS = -16.0
+# Don't boost quiet tracks (or cut loud ones) by more than 12 dB
+MAX_GAIN_DB = 12.0
+
+_INTEGRATED = re.compile(r"I:\s+(-?[\d.]+|-inf) LUFS")
+
+
+def measure_loudness(path: str | Path) -> float | None:
+    """Measure a file's EBU R128 integrated loudness in LUFS
+
+    The analysis runs in an FFmpeg child process, so it never competes with
+    the voice threads for the GIL."""
+    result = subprocess.run(
+        [
+            "ffmpeg",
+            "-nostdin",
+            "-hide_banner",
+            "-i",
+            str(path),
+            "-vn",
+            "-filter:a",
+            "ebur128=framelog=quiet",
+            "-f",
+            "null",
+            "-",
+        ],
+        capture_output=True,
+    )
+    # The summary comes last; earlier matches are per-frame logs
+    matches = _INTEGRATED.findall(result.stderr.decode(errors="replace"))
+    if result.returncode != 0 or not matches or matches[-1] == "-inf":
+        return None
+
+    return float(matches[-1])
+
+
+analyze_loudness = asyncify(measure_loudness)
+
+
+def gain_for(loudness: float | None) -> float:
+    """Linear gain that brings a song to the target loudness"""
+    if loudness is None:
+        return 1.0
+
+    db = max(-MAX_GAIN_DB, min(MAX_GAIN_DB, TARGET_LUFS - loudness))
+    return 10 ** (db / 20)
+
+
+_measuring: set[str] = set()
+
+
+async def backfill_loudness(db: Database, song_id: str, path: Path):
+    """Measure a song cached before loudness analysis existed"""
+    if song_id in _measuring:
+        return
+
+    _measuring.add(song_id)
+    try:
+        loudness = await analyze_loudness(path)
+        if loudness is not None:
+            db.write_loudness(song_id, loudness)
+    finally:
+        _measuring.discard(song_id)
@@ -1,13 +1,111 @@
+import asyncio
+from collections.abc import Iterable
+from time import time
+
 from musicboy.database import Database
+from musicboy.metrics import counter
 from musicboy.playlist import Playlist
-from musicboy.sources.youtube.youtube import fetch_metadata
+from musicboy.sources.youtube.youtube import SongMetadata, fetch_metadata_entries
+
+# Stored metadata older than this is refreshed in the background
+METADATA_TTL = 7 * 24 * 60 * 60
+REFRESH_CONCURRENCY = 2
+
+# URL -> fetch of its metadata, shared by everyone asking for it meanwhile
+_in_flight: dict[str, asyncio.Task[list[SongMetadata]]] = {}
+_refresh_limit = asyncio.Semaphore(REFRESH_CONCURRENCY)
+
+
+def is_stale(meta: SongMetadata, ttl: float = METADATA_TTL) -> bool:
+    fetched_at = meta.get("fetched_at")
+    return fetched_at is None or time() - fetched_at > ttl
+
+
+def _fetch_done(url: str, task: asyncio.Task):
+    _in_flight.pop(url, None)
+    # Refreshes aren't awaited, so mark their failures as retrieved
+    task.cancelled() or task.exception()
+
+
+async def fetch_entries(
+    url: str, db: Database, limit: asyncio.Semaphore
+) -> list[SongMetadata]:
+    """Fetch and store a URL's metadata, joining any fetch already running"""
+    task = _in_flight.get(url)
+    if task is None:
+
+        async def fetch() -> list[SongMetadata]:
+            async with limit:
+                songs = await fetch_metadata_entries(url)
+            db.write_metadata_many(songs)
+            return songs
+
+        task = _in_flight[url] = asyncio.create_task(fetch())
+        task.add_done_callback(lambda t: _fetch_done(url, t))
+
+    return await asyncio.shield(task)
+
+
+async def _refresh(url: str, db: Database):
+    try:
+        await fetch_entries(url, db, _refresh_limit)
+    except Exception as e:
+        print("Could not refresh metadata for", url, e)
+
+
+def refresh_metadata(url: str, db: Database):
+    """Re-fetch a URL's metadata in the background, unless already underway"""
+    if url not in _in_flight:
+        asyncio.create_task(_refresh(url, db))
+
+
+async def resolve_metadata(
+    urls: Iterable[str], db: Database, limit: int = 8, ttl: float = METADATA_TTL
+) -> tuple[list[SongMetadata], dict[str, Exception]]:
+    """Look up metadata for many URLs, fetching what isn't stored yet
+
+    Stored rows are returned right away, and refreshed in the background if
+    they're older than ``ttl``. Playlist URLs are expanded into their videos.
+    Songs are returned in the order given, alongside the URLs that failed and
+    why."""
+    urls = list(urls)
+    stored = await db.aget_many(urls)
+    sem = asyncio.Semaphore(limit)
+
+    async def resolve(url: str) -> list[SongMetadata]:
+        meta = stored.get(url)
+        if meta is None:
+            songs = await fetch_entries(url, db, sem)
+            counter("metadata_lookups_total", result="fetched").inc()
+            return songs
+
+        if is_stale(meta, ttl):
+            counter("metadata_lookups_total", result="stale").inc()
+            refresh_metadata(url, db)
+        else:
+            counter("metadata_lookups_total", result="fresh").inc()
+        return [meta]
+
+    results = await asyncio.gather(*map(resolve, urls), return_exceptions=True)
+
+    songs: list[SongMetadata] = []
+    errors: dict[str, Exception] = {}
+    for url, result in zip(urls, results):
+        if isinstance(result, Exception):
+            counter("metadata_lookups_total", result="failed").inc()
+            errors[url] = result
+        elif isinstance(result, list):
+            songs.extend(result)
+
+    return songs, errors
 
 
 async def find_missing_metadata(playlist: Playlist, db: Database):
-    for url in set(playlist.playlist):
-        try:
-            db.get_metadata(url)
-        except ValueError:
-            print("Finding metadata for", url)
-            meta = await fetch_metadata(url)
-            db.write_metadata(meta)
+    missing = set(playlist.playlist) - (await db.aget_many(playlist.playlist)).keys()
+    if not missing:
+        return
+
+    print("Finding metadata for", len(missing), "songs")
+    _, errors = await resolve_metadata(missing, db)
+    for url, e in errors.items():
+        print("Could not find metadata for", url, e)
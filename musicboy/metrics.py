@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+from collections.abc import Callable, Sequence
+from itertools import accumulate
+from typing import Literal
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+LabelKey = tuple[tuple[str, str], ...]
+
+# Off, every metric is a shared no-op and hot paths skip their timing
+enabled = True
+
+
+def set_enabled(value: bool):
+    global enabled
+    enabled = value
+
+
+class NullMetric:
+    """Stands in for every metric while metrics are disabled"""
+
+    def observe(self, value: float):
+        pass
+
+    def inc(self, amount: float = 1):
+        pass
+
+
+NULL_METRIC = NullMetric()
+
+
+class Counter:
+    def __init__(self, name: str, labels: LabelKey = ()):
+        self.name = name
+        self.labels = labels
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        labels: LabelKey = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile as the upper bound of the bucket it falls in"""
+        if self.count == 0:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+
+        return float("inf")
+
+
+histograms: dict[tuple[str, LabelKey], Histogram] = {}
+counters: dict[tuple[str, LabelKey], Counter] = {}
+# Values read from elsewhere when scraped, so they cost nothing in between
+collectors: dict[
+    tuple[str, LabelKey], tuple[Literal["counter", "gauge"], Callable[[], float]]
+] = {}
+
+
+def histogram(
+    name: str, buckets: Sequence[float] = DEFAULT_BUCKETS, **labels: str
+) -> Histogram | NullMetric:
+    if not enabled:
+        return NULL_METRIC
+
+    key = (name, tuple(sorted(labels.items())))
+    h = histograms.get(key)
+    if h is None:
+        h = histograms[key] = Histogram(name, key[1], buckets)
+
+    return h
+
+
+def counter(name: str, **labels: str) -> Counter | NullMetric:
+    if not enabled:
+        return NULL_METRIC
+
+    key = (name, tuple(sorted(labels.items())))
+    c = counters.get(key)
+    if c is None:
+        c = counters[key] = Counter(name, key[1])
+
+    return c
+
+
+def collect(
+    name: str,
+    read: Callable[[], float],
+    type: Literal["counter", "gauge"] = "gauge",
+    **labels: str,
+):
+    """Report ``read()`` as a metric each time metrics are scraped"""
+    collectors[(name, tuple(sorted(labels.items())))] = (type, read)
+
+
+def collected() -> dict[tuple[str, LabelKey], tuple[str, float]]:
+    values = {}
+    for key, (type, read) in collectors.items():
+        try:
+            values[key] = (type, float(read()))
+        except Exception as e:
+            print("Could not collect metric", key[0], e)
+
+    return values
+
+
+def _labels(labels: LabelKey, *extra: tuple[str, str]) -> str:
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def render() -> str:
+    """Every metric in Prometheus' text exposition format"""
+    if not enabled:
+        return ""
+
+    lines = []
+    typed = set()
+
+    def declare(name: str, type: str):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {type}")
+
+    for (name, labels), c in sorted(counters.items()):
+        declare(name, "counter")
+        lines.append(f"{name}{_labels(labels)} {c.value}")
+
+    for (name, labels), (type, value) in sorted(collected().items()):
+        declare(name, type)
+        lines.append(f"{name}{_labels(labels)} {value}")
+
+    for (name, labels), h in sorted(histograms.items()):
+        declare(name, "histogram")
+        for bound, n in zip(h.buckets, accumulate(h.counts)):
+            lines.append(f"{name}_bucket{_labels(labels, ('le', str(bound)))} {n}")
+        lines.append(f"{name}_bucket{_labels(labels, ('le', '+Inf'))} {h.count}")
+        lines.append(f"{name}_sum{_labels(labels)} {h.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {h.count}")
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves :func:`render` at /metrics for Prometheus to scrape"""
+
+    def __init__(self, port: int, host: str = "127.0.0.1"):
+        self.host = host
+        self.port = port
+        self._runner: web.AppRunner | None = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        print(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=render().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
@@ -1,55 +1,13 @@
 from __future__ import annotations
 
-import json
 import random
-from functools import wraps
-from pathlib import Path
-from typing import TypedDict
+from typing import TYPE_CHECKING, NotRequired, TypedDict
 
-from asyncer import asyncify
+from musicboy.songqueue import SongQueue
+from musicboy.sources.youtube.urls import canonical_url
 
-from musicboy.database import Database
-from musicboy.sources.youtube.youtube import SongMetadata, download_audio
-
-
-def get_song_path(song_id: str, base_dir: str = "musicboy/data") -> Path | None:
-    try:
-        path = next(Path(base_dir).glob(f"{song_id}.*"))
-    except StopIteration:
-        return None
-
-    return path
-
-
-def cache_song(song: SongMetadata, path: Path):
-    return download_audio(song["url"], str(path))
-
-
-cache_song_async = asyncify(cache_song)
-
-
-def _cache_next_songs(playlist: Playlist, db: Database):
-    for url in playlist.playlist[playlist.idx + 1 : playlist.idx + 4]:
-        meta = db.get_metadata(url)
-        if meta is None:
-            continue
-
-        if get_song_path(meta["id"]) is None:
-            download_audio(meta["url"], str(Path(playlist.data_dir) / meta["id"]))
-
-
-cache_next_songs = asyncify(_cache_next_songs)
-
-
-def write_state_after(func):
-    @wraps(func)
-    def wrapper(self: Playlist, *args, **kwargs):
-        result = func(self, *args, **kwargs)
-        with self.state_path.open("w") as f:
-            json.dump(self.state, f)
-        return result
-
-    return wrapper
+if TYPE_CHECKING:
+    from musicboy.store import PlaylistStore
 
 
 class PlaylistExhausted(Exception):
@@ -61,70 +19,95 @@ class PlaylistState(TypedDict):
     playlist: list[str]
     idx: int
     volume: float
+    # Seconds into the current song playback last reached
+    elapsed: NotRequired[float]
 
 
 class Playlist:
-    playlist: list[str]
-    data_dir: str
+    __slots__ = (
+        "idx",
+        "elapsed",
+        "playlist",
+        "loop",
+        "guild_id",
+        "_volume",
+        "store",
+        "version",
+    )
+
+    playlist: SongQueue
     idx: int
 
     def __init__(
         self,
         guild_id: int,
-        data_dir: str = "musicboy/data",
         playlist: list[str] = [],
         idx: int = 0,
         loop=False,
         volume=0.05,
+        store: PlaylistStore | None = None,
+        elapsed: float = 0.0,
     ):
         self.idx = idx
-        self.data_dir = data_dir
-        self.playlist = playlist
+        self.elapsed = elapsed
+        self.playlist = SongQueue(playlist)
         self.loop = loop
         self.guild_id = guild_id
         self._volume = volume
+        self.store = store
+        # Bumped whenever the songs in the queue change, to invalidate views
+        self.version = 0
 
-        self.state_path = Path(data_dir) / f"state_{guild_id}.json"
-        try:
-            with self.state_path.open() as f:
-                self._load_state(json.load(f))
-        except FileNotFoundError:
-            with open(self.state_path, "w") as f:
-                json.dump(self.state, f)
-        except json.JSONDecodeError:
-            pass
-        else:
-            print("Loaded state from ", self.state_path)
+        if store is not None:
+            store.create(self.state)
 
     @property
     def volume(self):
         return self._volume
 
     @volume.setter
-    @write_state_after
     def volume(self, value: float):
         self._volume = value
-
-    def _load_state(self, state: PlaylistState):
-        self.playlist = state["playlist"]
-        self.idx = state["idx"]
-        self.guild_id = state["guild_id"]
-        self.volume = state["volume"]
+        self._save()
 
     @classmethod
-    def from_state(cls: type[Playlist], state: PlaylistState):
+    def from_state(
+        cls: type[Playlist], state: PlaylistState, store: PlaylistStore | None = None
+    ):
         self = cls(
             state["guild_id"],
             playlist=state["playlist"],
             idx=state["idx"],
             volume=state["volume"],
+            store=store,
+            elapsed=state.get("elapsed", 0.0),
         )
 
         return self
 
-    def _write_state(self):
-        with self.state_path.open("w") as f:
-            json.dump(self.state, f)
+    def _save(self):
+        if self.store is not None:
+            self.store.update(self.guild_id, self.idx, self._volume, self.elapsed)
+
+    def _insert(self, i: int, *urls: str):
+        self.version += 1
+        for n, url in enumerate(urls):
+            self.playlist.insert(i + n, url)
+        if self.store is not None:
+            self.store.insert(self.guild_id, i, self.playlist, len(urls))
+
+    def _pop(self, i: int) -> str:
+        self.version += 1
+        url = self.playlist.pop(i)
+        if self.store is not None:
+            self.store.pop(self.guild_id, i)
+        return url
+
+    def _replace(self, urls: list[str]):
+        self.version += 1
+        self.playlist = SongQueue(urls)
+        if self.store is not None:
+            self.store.replace(self.guild_id, urls)
 
     @property
     def has_next_song(self):
@@ -140,52 +123,66 @@ class Playlist:
     @property
     def state(self) -> PlaylistState:
         return PlaylistState(
-            playlist=self.playlist,
+            playlist=list(self.playlist),
             idx=self.idx,
             guild_id=self.guild_id,
             volume=self.volume,
+            elapsed=self.elapsed,
         )
 
     @property
     def current(self) -> str:
         return self.playlist[self.idx]
 
-    @write_state_after
     def shuffle(self):
         np, *rest = self.playlist
         random.shuffle(rest)
-        self.playlist = [np, *rest]
+        self._replace([np, *rest])
 
-    @write_state_after
     def move_song(self, song_position: int, new_pos: int):
         new_idx = self.idx + new_pos - 1
-        if 0 > new_idx > len(self.playlist) - 1:
-            raise ValueError("Position out of range")
-
         song_position = self.idx + song_position - 1
-        if 0 > song_position > len(self.playlist) - 1:
+        # Checked before popping, which writes through to the store
+        if not 0 <= new_idx < len(self.playlist):
+            raise ValueError("Position out of range")
+        if not 0 <= song_position < len(self.playlist):
             raise ValueError("Position out of range")
 
-        self.playlist.insert(new_idx, self.playlist.pop(song_position))
+        self._insert(new_idx, self._pop(song_position))
 
-    @write_state_after
     def prepend_song(self, url: str):
-        self.playlist.insert(0 if len(self.playlist) == 0 else self.idx + 1, url)
+        self.prepend_songs([url])
+
+    def prepend_songs(self, urls: list[str]):
+        """Queue songs to play next, in the order given"""
+        if not urls:
+            return
+
+        self._insert(
+            0 if len(self.playlist) == 0 else self.idx + 1,
+            *(canonical_url(url) for url in urls),
+        )
 
-    @write_state_after
     def append_song(self, url: str):
-        self.playlist.append(url)
+        self._insert(len(self.playlist), canonical_url(url))
+
+    def extend_songs(self, urls: list[str]):
+        urls = [canonical_url(url) for url in urls]
+        self.version += 1
+        self.playlist.extend(urls)
+        if self.store is not None:
+            self.store.extend(self.guild_id, urls)
 
-    @write_state_after
     def goto(self, idx: int):
-        if 0 > idx > len(self.playlist) - 1:
+        if not 0 <= idx < len(self.playlist):
             raise ValueError("Index out of range")
 
         self.idx = idx
+        self.elapsed = 0.0
+        self._save()
 
         return self.current
 
-    @write_state_after
     def next(self):
         new_idx = self.idx + 1
         if new_idx > len(self.playlist) - 1:
@@ -195,28 +192,44 @@ class Playlist:
                 raise PlaylistExhausted("No more songs in playlist")
 
         self.idx = new_idx
+        self.elapsed = 0.0
+        self._save()
         return self.current
 
-    @write_state_after
     def prev(self):
         new_idx = self.idx - 1
         new_idx = new_idx if new_idx >= 0 else len(self.playlist) - 1
         self.idx = new_idx
+        self.elapsed = 0.0
+        self._save()
 
         return self.current
 
-    @write_state_after
     def clear(self):
-        self.playlist = []
+        self._replace([])
         self.idx = 0
+        self.elapsed = 0.0
+        self._save()
+
+    def save_elapsed(self, seconds: float):
+        """Remember how far into the current song playback got"""
+        self.elapsed = seconds
+        self._save()
 
-    @write_state_after
     def remove_index(self, idx: int):
-        self.playlist.pop(self.idx + idx - 1)
+        i = self.idx + idx - 1
+        if not 0 <= i < len(self.playlist):
+            raise ValueError("Position out of range")
+
+        self._pop(i)
 
-    @write_state_after
     def remove_song(self, url: str, all=False):
-        if all:
-            self.playlist = [u for u in self.playlist if u != url]
-        else:
-            self.playlist.remove(url)
+        url = canonical_url(url)
+        if not all:
+            self._pop(self.playlist.index(url))
+            return
+
+        self.version += 1
+        positions = self.playlist.remove_all(url)
+        if self.store is not None:
+            self.store.remove_url(self.guild_id, url, positions)
@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import monotonic
+
+from musicboy.cache import AudioCache
+from musicboy.database import Database
+from musicboy.downloads import IMMEDIATE, DownloadProgress, DownloadService
+from musicboy.playlist import Playlist
+from musicboy.sources.youtube.youtube import SongMetadata
+
+# Songs are ranked by the monotonic time they'll be needed at, behind
+# IMMEDIATE ones that something is waiting on right now. BACKGROUND is for
+# guilds that aren't playing yet, like warm-up's, after every guild that is.
+BACKGROUND = float("inf")
+
+
+@dataclass
+class PrefetchJob:
+    song: SongMetadata
+    priority: float
+    guilds: set[int]
+    future: asyncio.Future[Path | None]
+    running: bool = False
+    progress: DownloadProgress | None = None
+
+
+@dataclass(order=True)
+class _QueueItem:
+    priority: float
+    seq: int
+    job: PrefetchJob = field(compare=False)
+
+
+class PrefetchScheduler:
+    """Downloads upcoming songs for every guild on a shared, bounded worker pool
+
+    Jobs are deduplicated by song id, so guilds queueing the same song share
+    one download. Songs needed soonest run first, whichever guild they're
+    for and however long ago they were queued."""
+
+    def __init__(
+        self,
+        cache: AudioCache,
+        db: Database,
+        downloads: DownloadService,
+        workers: int = 2,
+        lookahead: int = 3,
+    ):
+        self.cache = cache
+        self.db = db
+        self.downloads = downloads
+        self.workers = workers
+        self.lookahead = lookahead
+        self.jobs: dict[str, PrefetchJob] = {}
+        self._queue: list[_QueueItem] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+
+        for job in self.jobs.values():
+            job.future.cancel()
+
+    def _push(self, job: PrefetchJob):
+        heapq.heappush(self._queue, _QueueItem(job.priority, next(self._seq), job))
+        self._wakeup.set()
+
+    def submit(
+        self, song: SongMetadata, guild_id: int, priority: float
+    ) -> asyncio.Future[Path | None]:
+        job = self.jobs.get(song["id"])
+        if job is None:
+            future = asyncio.get_running_loop().create_future()
+            # Nobody awaits plain prefetches, so mark failures as retrieved
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            job = PrefetchJob(song, priority, {guild_id}, future)
+            self.jobs[song["id"]] = job
+            self._push(job)
+            return job.future
+
+        job.guilds.add(guild_id)
+        if priority < job.priority and not job.running:
+            # The old heap entry goes stale and is skipped by the workers
+            job.priority = priority
+            self._push(job)
+
+        return job.future
+
+    async def fetch(self, song: SongMetadata, guild_id: int) -> Path | None:
+        """Get a song's audio now, joining any in-flight download of it"""
+        if (path := self.cache.get(song["id"])) is not None:
+            return path
+
+        future = self.submit(song, guild_id, IMMEDIATE)
+        job = self.jobs[song["id"]]
+        if not job.running:
+            # Don't make a listener wait for a free worker slot
+            job.running = True
+            asyncio.create_task(self._run(job))
+        else:
+            # It may still be waiting for a process behind other prefetches
+            self.downloads.promote(song["id"], IMMEDIATE)
+
+        return await asyncio.shield(future)
+
+    async def schedule(self, playlist: Playlist, remaining: float | None = None):
+        """Queue the songs after the current one and pin them in the cache
+
+        ``remaining`` is how long the current song has left to play. Without
+        it the guild isn't playing, and its songs wait for everyone else's."""
+        window = playlist.playlist[playlist.idx : playlist.idx + self.lookahead + 1]
+        found = await self.db.aget_many(window)
+        songs = [found[url] for url in window if url in found]
+
+        self.cache.pin(playlist.guild_id, [s["id"] for s in songs])
+        # The current song is needed now, and each one after when the one
+        # before it ends
+        needed_at = monotonic()
+        for depth, url in enumerate(window):
+            song = found.get(url)
+            if song is not None and song["id"] not in self.cache:
+                priority = needed_at if remaining is not None else BACKGROUND
+                self.submit(song, playlist.guild_id, priority)
+            if depth == 0:
+                needed_at += remaining or 0.0
+            elif song is not None:
+                needed_at += song["duration"]
+
+    def cancel(self, guild_id: int):
+        """Drop a guild's interest in pending downloads and unpin its songs"""
+        self.cache.unpin(guild_id)
+        for song_id, job in list(self.jobs.items()):
+            job.guilds.discard(guild_id)
+            if not job.guilds and not job.running:
+                job.future.cancel()
+                del self.jobs[song_id]
+
+    async def _next_job(self) -> PrefetchJob:
+        while True:
+            while self._queue:
+                item = heapq.heappop(self._queue)
+                job = item.job
+                if (
+                    job.running
+                    or job.future.done()
+                    or item.priority != job.priority
+                    or self.jobs.get(job.song["id"]) is not job
+                ):
+                    continue
+
+                return job
+
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    async def _worker(self):
+        while True:
+            await self._run(await self._next_job())
+
+    async def _run(self, job: PrefetchJob):
+        job.running = True
+        try:
+            path, loudness = await self.downloads.download(
+                job.song,
+                on_progress=lambda p: setattr(job, "progress", p),
+                priority=job.priority,
+            )
+            path = self.cache.add(path)
+            if loudness is not None:
+                self.db.write_loudness(job.song["id"], loudness)
+        except Exception as e:
+            print("Failed to download", job.song["url"], e)
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(path)
+        finally:
+            self.jobs.pop(job.song["id"], None)
@@ -1,4 +1,9 @@
-from time import time
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from musicboy.audio import TrackedSource
 
 
 def seconds_to_duration(seconds: int):
@@ -10,29 +15,35 @@ def seconds_to_duration(seconds: int):
     return f"{hours_str}{minutes:02.0f}:{secs:02.0f}"
 
 
+def duration_to_seconds(duration: str) -> int:
+    """Parse ``[[hh:]mm:]ss`` into seconds"""
+    seconds = 0
+    for part in duration.split(":"):
+        if not part.isdigit():
+            raise ValueError(f"Not a timestamp: {duration}")
+        seconds = seconds * 60 + int(part)
+
+    return seconds
+
+
 class ProgressTracker:
-    _duration = 0
-    paused = False
+    """How far into its song a source is, counted from the frames it has sent
 
-    def start(self):
-        self.paused = False
-        self.start_time = int(time())
+    Pauses, stalls and seeks are accounted for without any bookkeeping."""
 
-    def stop(self):
-        self.stop_time = int(time())
-        self._duration += self.stop_time - self.start_time
-        self.paused = True
+    __slots__ = ("source",)
+
+    def __init__(self, source: TrackedSource | None = None):
+        self.source = source
 
     @property
-    def elapsed_seconds(self):
-        if self.paused:
-            return self._duration
+    def position(self) -> float:
+        return self.source.position if self.source is not None else 0.0
 
-        return int(time()) - self.start_time + self._duration
+    @property
+    def elapsed_seconds(self):
+        return int(self.position)
 
     @property
     def elapsed(self):
-        if self.paused:
-            return seconds_to_duration(self._duration)
-
         return seconds_to_duration(self.elapsed_seconds)
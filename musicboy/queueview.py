@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+from array import array
+from itertools import accumulate
+
+import discord
+
+from musicboy.database import Database
+from musicboy.playlist import Playlist
+from musicboy.progress import seconds_to_duration
+
+PAGE_SIZE = 10
+# Keeps ten lines well inside Discord's 4096 character description limit
+MAX_TITLE_LENGTH = 80
+
+
+class QueuePages:
+    """Renders the queue a page at a time, caching until the playlist changes
+
+    Only the visible page's metadata is fetched. The remaining duration comes
+    from a running total over the rest of the queue, recomputed once per
+    change to its songs, so moving to the next song costs nothing."""
+
+    def __init__(self, db: Database):
+        self.db = db
+        # Guild -> (playlist version, queue index the running total of
+        # durations starts at, running total)
+        self._totals: dict[int, tuple[int, int, array]] = {}
+        # Guild -> (playlist version, idx, whether it was playing, rendered pages)
+        self._pages: dict[int, tuple[int, int, bool, dict[int, discord.Embed]]] = {}
+
+    def forget(self, guild_id: int):
+        self._totals.pop(guild_id, None)
+        self._pages.pop(guild_id, None)
+
+    def page_count(self, playlist: Playlist) -> int:
+        upcoming = len(playlist.playlist) - playlist.idx - 1
+        return max(1, -(-upcoming // PAGE_SIZE))
+
+    async def remaining_seconds(self, playlist: Playlist) -> int:
+        """Total duration of the songs after the current one
+
+        Songs already played aren't looked up. Moving further on through the
+        queue reuses the running total until its songs change."""
+        start = playlist.idx + 1
+        version, first, totals = self._totals.get(
+            playlist.guild_id, (-1, 0, array("q"))
+        )
+        if version != playlist.version or start < first:
+            urls = playlist.playlist[start:]
+            songs = await self.db.aget_many(set(urls))
+            durations = (songs[u]["duration"] if u in songs else 0 for u in urls)
+            totals = array("q", accumulate(durations, initial=0))
+            first = start
+            self._totals[playlist.guild_id] = (playlist.version, first, totals)
+
+        return totals[-1] - totals[min(start - first, len(totals) - 1)]
+
+    async def render(
+        self, playlist: Playlist, page: int, playing: bool = False
+    ) -> discord.Embed:
+        version, idx, was_playing, pages = self._pages.get(
+            playlist.guild_id, (-1, -1, False, {})
+        )
+        if (version, idx, was_playing) != (playlist.version, playlist.idx, playing):
+            pages = {}
+            self._pages[playlist.guild_id] = (
+                playlist.version,
+                playlist.idx,
+                playing,
+                pages,
+            )
+
+        if page not in pages:
+            pages[page] = await self._render(playlist, page, playing)
+
+        return pages[page]
+
+    async def _render(
+        self, playlist: Playlist, page: int, playing: bool
+    ) -> discord.Embed:
+        start = playlist.idx + 1 + page * PAGE_SIZE
+        upcoming = playlist.playlist[start : start + PAGE_SIZE]
+        # The first page leads with the current song
+        first = start - 1 if page == 0 else start
+        urls = [playlist.current, *upcoming] if page == 0 else upcoming
+        songs = await self.db.aget_many(urls)
+
+        lines = []
+        for n, url in enumerate(urls, start=first - playlist.idx + 1):
+            song = songs.get(url)
+            if song is None:
+                line = f"**{n}.** <{url}>"
+            else:
+                title = song["title"]
+                if len(title) > MAX_TITLE_LENGTH:
+                    title = title[: MAX_TITLE_LENGTH - 1] + "…"
+                duration = seconds_to_duration(song["duration"])
+                line = f"**{n}.** [{title}]({song['url']}) ({duration})"
+            if n == 1 and playing:
+                line += " (Now playing)"
+            lines.append(line)
+        if not upcoming:
+            lines.append("No more songs in the queue")
+
+        em = discord.Embed(color=discord.Color(0x000000))
+        em.title = f"Playlist ({len(playlist.playlist) - playlist.idx})"
+        em.description = "\n".join(lines)
+        remaining = seconds_to_duration(await self.remaining_seconds(playlist))
+        em.set_footer(
+            text=f"Page {page + 1}/{self.page_count(playlist)} · {remaining} to go"
+        )
+
+        return em
+
+
+class QueueView(discord.ui.View):
+    """Buttons for paging through the queue"""
+
+    message: discord.Message | None = None
+
+    def __init__(
+        self,
+        pages: QueuePages,
+        playlist: Playlist,
+        page: int = 0,
+        voice_client: discord.VoiceClient | None = None,
+    ):
+        super().__init__(timeout=180)
+        self.pages = pages
+        self.playlist = playlist
+        self.page = page
+        self.voice_client = voice_client
+
+    def _clamp(self, page: int) -> int:
+        return max(0, min(page, self.pages.page_count(self.playlist) - 1))
+
+    async def render(self) -> discord.Embed:
+        self.page = self._clamp(self.page)
+        last = self.pages.page_count(self.playlist) - 1
+        self.first.disabled = self.previous.disabled = self.page == 0
+        self.next.disabled = self.last.disabled = self.page == last
+        playing = self.voice_client is not None and self.voice_client.is_playing()
+        return await self.pages.render(self.playlist, self.page, playing)
+
+    async def _show(self, interaction: discord.Interaction, page: int):
+        self.page = page
+        embed = await self.render()
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(emoji="⏮️", style=discord.ButtonStyle.secondary)
+    async def first(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, 0)
+
+    @discord.ui.button(emoji="◀️", style=discord.ButtonStyle.secondary)
+    async def previous(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(emoji="▶️", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page + 1)
+
+    @discord.ui.button(emoji="⏭️", style=discord.ButtonStyle.secondary)
+    async def last(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.pages.page_count(self.playlist) - 1)
+
+    async def on_timeout(self):
+        if self.message is not None:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
@@ -0,0 +1,313 @@
+from __future__ import annotations
+
+import sys
+from array import array
+from collections.abc import Iterable, Iterator, MutableSequence
+from itertools import islice
+from typing import overload
+
+# Entries per chunk when filling. Positional edits shift at most ~2x this
+CHUNK_SIZE = 512
+
+# URLs are interned process-wide, so each one is stored once however many
+# guilds queue it, and queues hold 4-byte ids instead of string pointers.
+# Each id counts the queues holding it, and is freed for reuse at zero.
+_ids: dict[str, int] = {}
+_urls: list[str] = []
+_refs = array("I")
+_free: list[int] = []
+
+
+def intern_url(url: str) -> int:
+    """Compact id for a URL, shared by every guild's queue"""
+    song_id = _ids.get(url)
+    if song_id is None:
+        if _free:
+            song_id = _free.pop()
+            _urls[song_id] = url
+        else:
+            song_id = len(_urls)
+            _urls.append(url)
+            _refs.append(0)
+        _ids[url] = song_id
+
+    return song_id
+
+
+def _release(song_id: int):
+    """A queue stopped holding ``song_id``; forget its URL if it was the last"""
+    _refs[song_id] -= 1
+    if not _refs[song_id]:
+        del _ids[_urls[song_id]]
+        _urls[song_id] = ""
+        _free.append(song_id)
+
+
+class SongQueue(MutableSequence[str]):
+    """A playlist's URLs, kept fast and small for queues of 100k+ songs
+
+    Songs are stored as interned ids in a list of array chunks, with a
+    Fenwick tree over the chunk sizes. Finding a position takes O(log n), and
+    an insert or removal only shifts the ids within one chunk. A count of
+    each id answers membership in O(1) and lets URL searches stop as soon as
+    every copy is found."""
+
+    def __init__(self, urls: Iterable[str] = ()):
+        self._chunks: list[array] = []
+        self._tree: list[int] = [0]
+        self._counts: dict[int, int] = {}
+        self._len = 0
+        self.extend(urls)
+
+    def __sizeof__(self) -> int:
+        """Bytes held by this queue, not counting the shared interned URLs"""
+        return (
+            object.__sizeof__(self)
+            + sys.getsizeof(self.__dict__)
+            + sys.getsizeof(self._chunks)
+            + sum(map(sys.getsizeof, self._chunks))
+            + sys.getsizeof(self._tree)
+            + sys.getsizeof(self._counts)
+        )
+
+    def _rebuild_tree(self):
+        """Recompute chunk offsets after chunks are added or removed"""
+        tree = [0, *map(len, self._chunks)]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+
+        self._tree = tree
+
+    def _resize(self, k: int, delta: int):
+        tree = self._tree
+        k += 1
+        while k < len(tree):
+            tree[k] += delta
+            k += k & -k
+
+    def _locate(self, i: int) -> tuple[int, int]:
+        """The chunk holding position ``i``, and the offset within it"""
+        tree = self._tree
+        k = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            if k + step < len(tree) and tree[k + step] <= i:
+                k += step
+                i -= tree[k]
+            step >>= 1
+
+        return k, i
+
+    def _normalize(self, i: int) -> int:
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError("queue index out of range")
+
+        return i
+
+    def __del__(self):
+        for song_id in self._counts:
+            _release(song_id)
+
+    def _count(self, song_id: int, n: int):
+        previous = self._counts.get(song_id, 0)
+        count = previous + n
+        if count:
+            self._counts[song_id] = count
+        else:
+            del self._counts[song_id]
+
+        if not previous:
+            _refs[song_id] += 1
+        elif not count:
+            _release(song_id)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[str]:
+        urls = _urls
+        for chunk in self._chunks:
+            for song_id in chunk:
+                yield urls[song_id]
+
+    def _iter_ids(self, start: int) -> Iterator[int]:
+        if start >= self._len:
+            return
+
+        k, j = self._locate(start)
+        yield from islice(self._chunks[k], j, None)
+        for chunk in self._chunks[k + 1 :]:
+            yield from chunk
+
+    def __contains__(self, url: object) -> bool:
+        return _ids.get(url) in self._counts  # type: ignore
+
+    @overload
+    def __getitem__(self, index: int) -> str: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[str]: ...
+
+    def __getitem__(self, index: int | slice) -> str | list[str]:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                return list(self)[index]
+
+            ids = islice(self._iter_ids(start), max(stop - start, 0))
+            return [_urls[song_id] for song_id in ids]
+
+        k, j = self._locate(self._normalize(index))
+        return _urls[self._chunks[k][j]]
+
+    def __setitem__(self, index: int, url: str):  # type: ignore[override]
+        k, j = self._locate(self._normalize(index))
+        song_id = intern_url(url)
+        # Counted before the old one is released, in case they're the same
+        self._count(song_id, 1)
+        self._count(self._chunks[k][j], -1)
+        self._chunks[k][j] = song_id
+
+    def __delitem__(self, index: int):  # type: ignore[override]
+        k, j = self._locate(self._normalize(index))
+        chunk = self._chunks[k]
+        self._count(chunk.pop(j), -1)
+        self._len -= 1
+        self._resize(k, -1)
+
+        if not chunk:
+            del self._chunks[k]
+            self._rebuild_tree()
+        elif (
+            len(chunk) < CHUNK_SIZE // 4
+            and k + 1 < len(self._chunks)
+            and len(chunk) + len(self._chunks[k + 1]) <= CHUNK_SIZE
+        ):
+            chunk.extend(self._chunks.pop(k + 1))
+            self._rebuild_tree()
+
+    def insert(self, index: int, url: str):
+        if index < 0:
+            index = max(index + self._len, 0)
+        index = min(index, self._len)
+
+        song_id = intern_url(url)
+        if index == self._len:
+            if not self._chunks or len(self._chunks[-1]) >= CHUNK_SIZE:
+                self._chunks.append(array("I"))
+                self._rebuild_tree()
+            k, j = len(self._chunks) - 1, len(self._chunks[-1])
+        else:
+            k, j = self._locate(index)
+
+        chunk = self._chunks[k]
+        chunk.insert(j, song_id)
+        self._count(song_id, 1)
+        self._len += 1
+        self._resize(k, 1)
+
+        if len(chunk) > 2 * CHUNK_SIZE:
+            half = len(chunk) // 2
+            self._chunks.insert(k + 1, chunk[half:])
+            del chunk[half:]
+            self._rebuild_tree()
+
+    def extend(self, urls: Iterable[str]):
+        ids = [intern_url(url) for url in urls]
+        if not ids:
+            return
+
+        for song_id in ids:
+            self._count(song_id, 1)
+
+        if self._chunks and len(self._chunks[-1]) < CHUNK_SIZE:
+            room = CHUNK_SIZE - len(self._chunks[-1])
+            self._chunks[-1].extend(ids[:room])
+            ids = ids[room:]
+
+        for start in range(0, len(ids), CHUNK_SIZE):
+            self._chunks.append(array("I", ids[start : start + CHUNK_SIZE]))
+
+        self._len = sum(map(len, self._chunks))
+        self._rebuild_tree()
+
+    def clear(self):
+        for song_id in self._counts:
+            _release(song_id)
+        self._chunks = []
+        self._counts = {}
+        self._len = 0
+        self._rebuild_tree()
+
+    def _find(self, song_id: int, start: int = 0) -> Iterator[int]:
+        """Positions of ``song_id`` from ``start`` onwards, in order
+
+        Searches each chunk's raw bytes, which runs at memchr speed instead
+        of comparing ids one by one in Python."""
+        remaining = self._counts.get(song_id, 0)
+        needle = array("I", (song_id,)).tobytes()
+        width = len(needle)
+        offset = 0
+        for chunk in self._chunks:
+            if not remaining:
+                return
+
+            data = chunk.tobytes()
+            at = data.find(needle)
+            while at != -1:
+                if at % width:
+                    # Straddles two ids, so not a real match
+                    at = data.find(needle, at + 1)
+                    continue
+
+                remaining -= 1
+                if offset + at // width >= start:
+                    yield offset + at // width
+                at = data.find(needle, at + width)
+
+            offset += len(chunk)
+
+    def index(self, url: str, start: int = 0, stop: int | None = None) -> int:
+        start, stop, _ = slice(start, stop).indices(self._len)
+        song_id = _ids.get(url)
+        if song_id is not None:
+            for i in self._find(song_id, start):
+                if i < stop:
+                    return i
+                break
+
+        raise ValueError(f"{url!r} is not in queue")
+
+    def count(self, url: str) -> int:
+        return self._counts.get(_ids.get(url), 0)  # type: ignore
+
+    def positions(self, url: str) -> list[int]:
+        """Every position ``url`` is queued at, in order"""
+        song_id = _ids.get(url)
+        return [] if song_id is None else list(self._find(song_id))
+
+    def remove_all(self, url: str) -> list[int]:
+        """Remove every copy of ``url``, returning the positions they were at"""
+        positions = self.positions(url)
+        if not positions:
+            return positions
+
+        # Back to front, so earlier positions stay valid
+        for position in reversed(positions):
+            k, j = self._locate(position)
+            del self._chunks[k][j]
+
+        song_id = _ids[url]
+        del self._counts[song_id]
+        _release(song_id)
+        self._chunks = [chunk for chunk in self._chunks if chunk]
+        self._len -= len(positions)
+        self._rebuild_tree()
+        return positions
+
+    def __repr__(self) -> str:
+        return f"SongQueue({list(self)!r})"
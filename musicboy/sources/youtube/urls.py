@@ -0,0 +1,59 @@
+import re
+from urllib.parse import parse_qs, urlsplit
+
+WATCH_URL = "https://www.youtube.com/watch?v="
+PLAYLIST_URL = "https://www.youtube.com/playlist?list="
+
+VIDEO_ID = re.compile(r"[A-Za-z0-9_-]{11}")
+YOUTUBE_HOSTS = {
+    "youtube.com",
+    "www.youtube.com",
+    "m.youtube.com",
+    "music.youtube.com",
+    "youtube-nocookie.com",
+    "www.youtube-nocookie.com",
+}
+# Paths whose next segment is the video id, as in /shorts/<id>
+ID_PATHS = {"shorts", "embed", "live", "v", "e"}
+
+
+def video_id(url: str) -> str | None:
+    """The id of the video a YouTube URL points at, in any of its forms"""
+    if url.startswith(WATCH_URL) and VIDEO_ID.fullmatch(url[len(WATCH_URL) :]):
+        return url[len(WATCH_URL) :]
+
+    parts = urlsplit(url if "://" in url else f"https://{url}")
+    host = (parts.hostname or "").lower()
+    segments = [s for s in parts.path.split("/") if s]
+    if host == "youtu.be":
+        candidate = segments[0] if segments else ""
+    elif host in YOUTUBE_HOSTS:
+        if segments == ["watch"]:
+            candidate = parse_qs(parts.query).get("v", [""])[0]
+        elif len(segments) >= 2 and segments[0] in ID_PATHS:
+            candidate = segments[1]
+        else:
+            return None
+    else:
+        return None
+
+    return candidate if VIDEO_ID.fullmatch(candidate) else None
+
+
+def canonical_url(url: str) -> str:
+    """One spelling for every URL of the same video or playlist
+
+    youtu.be, music.youtube.com, /shorts/ and the like become a plain watch
+    URL, without timestamps or the playlist it was opened from. URLs that
+    aren't recognised only lose their extra query parameters."""
+    url = url.strip().strip("<>")
+    if (song_id := video_id(url)) is not None:
+        return WATCH_URL + song_id
+
+    parts = urlsplit(url)
+    if (parts.hostname or "").lower() in YOUTUBE_HOSTS and parts.path == "/playlist":
+        playlist_id = parse_qs(parts.query).get("list", [""])[0]
+        if playlist_id:
+            return PLAYLIST_URL + playlist_id
+
+    return url.split("&")[0]
@@ -1,48 +1,143 @@
-from typing import TypedDict
+import threading
+from collections.abc import Callable
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, NotRequired, TypedDict
 
 import yt_dlp
 from asyncer import asyncify
 
+from musicboy.metrics import histogram
+
+AUDIO_FORMAT = "m4a/bestaudio/best"
+
 
 class SongMetadata(TypedDict):
     id: str
     title: str
     duration: int
     url: str
+    # Integrated loudness (LUFS) of the cached audio, once it's been measured
+    loudness: NotRequired[float | None]
+    # Unix time the metadata was last fetched from YouTube
+    fetched_at: NotRequired[float | None]
 
 
-def _fetch_metadata(url: str) -> SongMetadata:
-    """Get metadata from YouTube URL."""
-    with yt_dlp.YoutubeDL(params={"quiet": True}) as ydl:
-        meta = ydl.extract_info(url, download=False, process=False)
-        if meta is None:
-            raise ValueError("Could not get metadata from YouTube URL")
-
-        return SongMetadata(
-            id=meta["id"],
-            title=meta["title"],
-            duration=meta["duration"],
-            url=url,
-        )
-
-
-fetch_metadata = asyncify(_fetch_metadata)
+_local = threading.local()
 
-
-def download_audio(url: str, filename: str) -> str:
-    """Download best audio from YouTube URL to specified filename."""
-    opts = {
-        "format": "m4a/bestaudio/best",
-        "outtmpl": filename,
+# Options for each kind of long-lived extractor
+EXTRACTOR_PARAMS: dict[str, dict[str, Any]] = {
+    "metadata": {"quiet": True},
+    "stream": {"quiet": True, "format": AUDIO_FORMAT},
+    "download": {
         "quiet": True,
+        "format": AUDIO_FORMAT,
         "postprocessors": [
             {
                 "key": "FFmpegExtractAudio",
                 "preferredcodec": "m4a",
             }
         ],
-    }
+    },
+}
+
+
+def _extractor(kind: str = "metadata") -> yt_dlp.YoutubeDL:
+    """Extractor reused by every call of a kind on the current thread.
+
+    Reusing one skips option parsing and extractor setup on each call, and
+    keeps its HTTP connections open between calls."""
+    extractors = _local.__dict__.setdefault("extractors", {})
+    ydl = extractors.get(kind)
+    if ydl is None:
+        ydl = extractors[kind] = yt_dlp.YoutubeDL(params=dict(EXTRACTOR_PARAMS[kind]))
+        if kind == "download":
+            ydl.add_progress_hook(_report_progress)
+
+    return ydl
+
+
+def warm_extractors():
+    """Build this thread's extractors ahead of their first use."""
+    for kind in EXTRACTOR_PARAMS:
+        _extractor(kind).get_info_extractor("Youtube")
+
+
+@contextmanager
+def _timed(kind: str):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        histogram("extraction_seconds", kind=kind).observe(perf_counter() - start)
+
+
+def _fetch_metadata_entries(url: str) -> list[SongMetadata]:
+    """Get metadata for a YouTube URL, expanding playlists into their videos."""
+    with _timed("metadata"):
+        meta = _extractor().extract_info(url, download=False, process=False)
+    if meta is None:
+        raise ValueError("Could not get metadata from YouTube URL")
+
+    if meta.get("_type") != "playlist":
+        return [
+            SongMetadata(
+                id=meta["id"],
+                title=meta["title"],
+                duration=meta["duration"],
+                url=url,
+            )
+        ]
+
+    # Unprocessed playlist entries are flat, so this is a single extraction
+    return [
+        SongMetadata(
+            id=entry["id"],
+            title=entry.get("title") or entry["id"],
+            duration=int(entry.get("duration") or 0),
+            url=f"https://www.youtube.com/watch?v={entry['id']}",
+        )
+        for entry in meta["entries"]
+        if entry and entry.get("id")
+    ]
+
+
+fetch_metadata_entries = asyncify(_fetch_metadata_entries)
+
+
+def resolve_stream_url(url: str) -> str:
+    """Get a direct URL to the best audio stream for a YouTube URL."""
+    with _timed("stream"):
+        meta = _extractor("stream").extract_info(url, download=False)
+    if meta is None or "url" not in meta:
+        raise ValueError("Could not resolve audio stream from YouTube URL")
+
+    return meta["url"]
+
+
+def _report_progress(status: dict[str, Any]):
+    for hook in getattr(_local, "progress_hooks", ()):
+        hook(status)
+
+
+def download_audio(
+    url: str,
+    filename: str,
+    progress_hooks: list[Callable[[dict[str, Any]], None]] | None = None,
+) -> str:
+    """Download best audio from YouTube URL to specified filename.
+
+    Returns the path of the final file, including the extension added by
+    postprocessing."""
+    ydl = _extractor("download")
+    ydl.params["outtmpl"]["default"] = filename
+    _local.progress_hooks = progress_hooks or []
+    try:
+        info = ydl.extract_info(url, download=True)
+    finally:
+        _local.progress_hooks = []
+
+    if info is None or not info.get("requested_downloads"):
+        return filename
 
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        ydl.download([url])
-    return filename
+    return info["requested_downloads"][-1]["filepath"]
@@ -0,0 +1,228 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+from array import array
+from collections.abc import Collection, Sequence
+from itertools import groupby
+from pathlib import Path
+
+from musicboy.database import Database, Write, timed
+from musicboy.playlist import Playlist, PlaylistState
+from musicboy.sources.youtube.urls import canonical_url
+
+# Keys closer than this get renumbered rather than split further
+MIN_KEY_GAP = 1e-9
+
+
+class PlaylistStore:
+    """Persists playlists as ordered rows, touching only the rows that change
+
+    Each entry is keyed by a float position, so inserting between two songs
+    takes a key between theirs instead of renumbering the rest of the queue.
+    Writes go through the database's writer thread and return immediately."""
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._keys: dict[int, array] = {}
+
+    def _submit(self, op: str, write: Write):
+        def timed_write(c: sqlite3.Connection):
+            with timed(f"playlist_{op}"):
+                return write(c)
+
+        self.db.writer.submit(timed_write)
+
+    @staticmethod
+    def _shard_filter(
+        shard_ids: Collection[int] | None, shard_count: int
+    ) -> tuple[str, list[int]]:
+        if shard_ids is None:
+            return "", []
+
+        # Discord's shard formula: (guild_id >> 22) % shard_count
+        return (
+            f" WHERE (p.guild_id >> 22) % ? IN ({', '.join('?' * len(shard_ids))})",
+            [shard_count, *shard_ids],
+        )
+
+    def guild_ids(
+        self, shard_ids: Collection[int] | None = None, shard_count: int = 1
+    ) -> list[int]:
+        """Guilds with a saved playlist, or only those on ``shard_ids``"""
+        where, params = self._shard_filter(shard_ids, shard_count)
+        rows = self.db.connection.execute(
+            "SELECT p.guild_id FROM playlists p" + where, params
+        ).fetchall()
+        return [r["guild_id"] for r in rows]
+
+    def _load(self, where: str, params: list[int]) -> list[PlaylistState]:
+        rows = self.db.connection.execute(
+            "SELECT p.guild_id, p.idx, p.volume, p.elapsed, e.position, e.url"
+            " FROM playlists p LEFT JOIN playlist_entries e USING (guild_id)"
+            + where
+            + " ORDER BY p.guild_id, e.position",
+            params,
+        ).fetchall()
+
+        states = []
+        for guild_id, group in groupby(rows, key=lambda r: r["guild_id"]):
+            group = list(group)
+            entries = [r for r in group if r["url"] is not None]
+            self._keys[guild_id] = array("d", (r["position"] for r in entries))
+            states.append(
+                PlaylistState(
+                    guild_id=guild_id,
+                    playlist=[r["url"] for r in entries],
+                    idx=group[0]["idx"],
+                    volume=group[0]["volume"],
+                    elapsed=group[0]["elapsed"],
+                )
+            )
+
+        return states
+
+    def load(self, guild_id: int) -> PlaylistState | None:
+        states = self._load(" WHERE p.guild_id = ?", [guild_id])
+        return states[0] if states else None
+
+    async def aload(self, guild_id: int) -> PlaylistState | None:
+        return await self.db._read(self.load, guild_id)
+
+    def forget(self, guild_id: int):
+        """Drop what's kept in memory for a playlist that's been unloaded"""
+        self._keys.pop(guild_id, None)
+
+    def create(self, state: PlaylistState):
+        guild_id = state["guild_id"]
+        row = (guild_id, state["idx"], state["volume"], state.get("elapsed", 0.0))
+
+        def write(c: sqlite3.Connection):
+            c.execute(
+                "INSERT OR IGNORE INTO playlists(guild_id, idx, volume, elapsed)"
+                " VALUES (?, ?, ?, ?)",
+                row,
+            )
+
+        self._submit("create", write)
+        if guild_id not in self._keys:
+            self.replace(guild_id, state["playlist"])
+
+    def update(self, guild_id: int, idx: int, volume: float, elapsed: float = 0.0):
+        row = (idx, volume, elapsed, guild_id)
+        self._submit(
+            "update",
+            lambda c: c.execute(
+                "UPDATE playlists SET idx = ?, volume = ?, elapsed = ?"
+                " WHERE guild_id = ?",
+                row,
+            ),
+        )
+
+    def insert(self, guild_id: int, i: int, playlist: Sequence[str], count: int = 1):
+        """Persist ``playlist[i:i + count]``, which were just inserted at ``i``"""
+        keys = self._keys[guild_id]
+        # Clamped like list.insert, which is where the queue put them
+        if i < 0:
+            i = max(i + len(keys), 0)
+        i = min(i, len(keys))
+        urls = playlist[i : i + count]
+        before = keys[i - 1] if i > 0 else None
+        after = keys[i] if i < len(keys) else None
+        if before is None:
+            first = after - count if after is not None else 0.0
+            new_keys = [first + n for n in range(count)]
+        elif after is None:
+            new_keys = [before + 1 + n for n in range(count)]
+        else:
+            step = (after - before) / (count + 1)
+            if step < MIN_KEY_GAP:
+                self.replace(guild_id, playlist)
+                return
+            new_keys = [before + step * (n + 1) for n in range(count)]
+
+        keys[i:i] = array("d", new_keys)
+        rows = [(guild_id, key, url) for key, url in zip(new_keys, urls)]
+        self._submit(
+            "insert",
+            lambda c: c.executemany(
+                "INSERT INTO playlist_entries(guild_id, position, url) VALUES (?, ?, ?)",
+                rows,
+            ),
+        )
+
+    def extend(self, guild_id: int, urls: list[str]):
+        keys = self._keys[guild_id]
+        start = keys[-1] + 1 if keys else 0.0
+        new_keys = [start + n for n in range(len(urls))]
+        keys.extend(new_keys)
+        rows = [(guild_id, key, url) for key, url in zip(new_keys, urls)]
+        self._submit(
+            "extend",
+            lambda c: c.executemany(
+                "INSERT INTO playlist_entries(guild_id, position, url) VALUES (?, ?, ?)",
+                rows,
+            ),
+        )
+
+    def pop(self, guild_id: int, i: int):
+        row = (guild_id, self._keys[guild_id].pop(i))
+        self._submit(
+            "pop",
+            lambda c: c.execute(
+                "DELETE FROM playlist_entries WHERE guild_id = ? AND position = ?", row
+            ),
+        )
+
+    def remove_url(self, guild_id: int, url: str, positions: list[int]):
+        """Delete every entry for ``url``, found at ``positions`` in the queue"""
+        keys = self._keys[guild_id]
+        for i in reversed(positions):
+            keys.pop(i)
+
+        row = (guild_id, url)
+        self._submit(
+            "remove_url",
+            lambda c: c.execute(
+                "DELETE FROM playlist_entries WHERE guild_id = ? AND url = ?", row
+            ),
+        )
+
+    def replace(self, guild_id: int, urls: Sequence[str]):
+        self._keys[guild_id] = array("d", range(len(urls)))
+        rows = [(guild_id, float(n), url) for n, url in enumerate(urls)]
+
+        def write(c: sqlite3.Connection):
+            c.execute("DELETE FROM playlist_entries WHERE guild_id = ?", (guild_id,))
+            c.executemany(
+                "INSERT INTO playlist_entries(guild_id, position, url) VALUES (?, ?, ?)",
+                rows,
+            )
+
+        self._submit("replace", write)
+
+
+def _read_json_playlist(state_path: Path) -> PlaylistState | None:
+    """Read a playlist from its JSON snapshot"""
+    try:
+        with state_path.open() as f:
+            return Playlist.from_state(json.load(f)).state
+    except json.JSONDecodeError:
+        return None
+
+
+def migrate_json_playlists(data_dir: Path, store: PlaylistStore):
+    """Move state_*.json playlists into the database, once"""
+    for state_path in data_dir.glob("state_*.json"):
+        state = _read_json_playlist(state_path)
+        if state is not None:
+            # Saved before URLs were canonicalised, like the rows
+            # canonicalize_urls has already rewritten
+            state["playlist"] = [canonical_url(url) for url in state["playlist"]]
+            store.create(state)
+            store.update(state["guild_id"], state["idx"], state["volume"])
+
+        # Wait for the rows to land before retiring the files
+        store.db.writer.submit(lambda c: None).result()
+        state_path.rename(state_path.with_name(state_path.name + ".migrated"))
+        print("Migrated playlist from", state_path)
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import multiprocessing
+import signal
+import time
+from collections.abc import Callable
+from multiprocessing.process import BaseProcess
+
+# A worker that stays up this long is considered healthy again
+HEALTHY_SECONDS = 300
+MAX_BACKOFF_SECONDS = 60
+
+
+def shard_groups(shard_count: int, workers: int) -> list[list[int]]:
+    """Split shards between workers as evenly as possible"""
+    return [list(range(w, shard_count, workers)) for w in range(workers)]
+
+
+class Worker:
+    def __init__(self, shard_ids: list[int]):
+        self.shard_ids = shard_ids
+        self.process: BaseProcess | None = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.backoff = 1.0
+        self.restart_at = 0.0
+
+
+class Supervisor:
+    """Runs the bot as several processes, each owning a share of the shards
+
+    Crashed workers are restarted with exponential backoff. The workers run
+    ``target(shard_ids, shard_count)`` in a fresh interpreter each, so they
+    scale across cores instead of sharing one GIL."""
+
+    def __init__(
+        self,
+        target: Callable[[list[int], int], None],
+        workers: int,
+        shard_count: int | None = None,
+    ):
+        self.target = target
+        self.shard_count = shard_count or workers
+        self.workers = [
+            Worker(shards)
+            for shards in shard_groups(self.shard_count, workers)
+            if shards
+        ]
+        self._mp = multiprocessing.get_context("spawn")
+        self._stopping = False
+
+    def _start(self, worker: Worker):
+        worker.process = self._mp.Process(
+            target=self.target,
+            args=(worker.shard_ids, self.shard_count),
+            name=f"musicboy-shards-{'-'.join(map(str, worker.shard_ids))}",
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        print(f"Started worker {worker.process.pid} for shards {worker.shard_ids}")
+
+    def _check(self, worker: Worker):
+        process = worker.process
+        if process is None:
+            return
+
+        now = time.monotonic()
+        if process.is_alive():
+            if now - worker.started_at > HEALTHY_SECONDS:
+                worker.backoff = 1.0
+            return
+
+        if not worker.restart_at:
+            print(
+                f"Worker for shards {worker.shard_ids} exited with code"
+                f" {process.exitcode}, restarting in {worker.backoff:.0f}s"
+            )
+            worker.restart_at = now + worker.backoff
+            worker.backoff = min(worker.backoff * 2, MAX_BACKOFF_SECONDS)
+        elif now >= worker.restart_at:
+            worker.restart_at = 0.0
+            worker.restarts += 1
+            self._start(worker)
+
+    def stop(self, *args):
+        self._stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for worker in self.workers:
+            self._start(worker)
+
+        while not self._stopping:
+            for worker in self.workers:
+                self._check(worker)
+            time.sleep(1)
+
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(timeout=10)
+                if worker.process.is_alive():
+                    worker.process.kill()
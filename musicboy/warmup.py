@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Awaitable, Callable, Iterable
+from time import monotonic
+from typing import TypedDict
+
+from musicboy.database import Database
+from musicboy.metadata import find_missing_metadata
+from musicboy.playlist import Playlist
+from musicboy.prefetch import PrefetchScheduler
+
+
+class WarmupProgress(TypedDict):
+    queued: int
+    warmed: int
+    failed: int
+    running: int
+
+
+class Warmup:
+    """Fills in missing metadata and prefetches audio for loaded playlists
+
+    Runs in the background so the bot can take commands right away. A guild
+    that runs a command before its turn is warmed immediately instead."""
+
+    def __init__(
+        self,
+        load_playlist: Callable[[int], Awaitable[Playlist | None]],
+        db: Database,
+        prefetch: PrefetchScheduler,
+        concurrency: int = 4,
+        per_second: float = 2,
+    ):
+        self.load_playlist = load_playlist
+        self.db = db
+        self.prefetch = prefetch
+        self.concurrency = concurrency
+        self.per_second = per_second
+        self.queued = 0
+        self.warmed: set[int] = set()
+        self.failed: set[int] = set()
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._started: set[int] = set()
+        self._sem = asyncio.Semaphore(concurrency)
+        self._next_start = 0.0
+
+    async def _warm(self, guild_id: int, throttle: bool):
+        playlist = await self.load_playlist(guild_id)
+        if playlist is None:
+            # New playlists are built from resolved metadata, so start warm
+            self.warmed.add(guild_id)
+            return
+
+        if throttle:
+            async with self._sem:
+                now = monotonic()
+                wait = self._next_start - now
+                self._next_start = max(now, self._next_start) + 1 / self.per_second
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+                await self._run(playlist)
+        else:
+            await self._run(playlist)
+
+    async def _run(self, playlist: Playlist):
+        self._started.add(playlist.guild_id)
+        try:
+            await find_missing_metadata(playlist, self.db)
+            await self.prefetch.schedule(playlist)
+        except Exception as e:
+            print("Warm-up failed for guild", playlist.guild_id, e)
+            self.failed.add(playlist.guild_id)
+        else:
+            self.warmed.add(playlist.guild_id)
+
+        done = len(self.warmed) + len(self.failed)
+        if self.queued and (done % 50 == 0 or done == self.queued):
+            print(f"Warmed {done}/{self.queued} playlists")
+
+    def _start(self, guild_id: int, throttle: bool) -> asyncio.Task:
+        task = self._tasks[guild_id] = asyncio.create_task(
+            self._warm(guild_id, throttle)
+        )
+        return task
+
+    async def ensure(self, guild_id: int):
+        """Wait until a guild is warm, jumping the background queue if need be"""
+        if guild_id in self.warmed or guild_id in self.failed:
+            return
+
+        task = self._tasks.get(guild_id)
+        if task is None or guild_id not in self._started:
+            # Still waiting for its turn, so take it out of line
+            if task is not None:
+                task.cancel()
+            task = self._start(guild_id, throttle=False)
+
+        await asyncio.shield(task)
+
+    def start(self, guild_ids: Iterable[int]):
+        """Warm the given guilds in order, in the background"""
+        for guild_id in guild_ids:
+            if guild_id not in self._tasks:
+                self.queued += 1
+                self._start(guild_id, throttle=True)
+
+    def cancel(self):
+        for task in self._tasks.values():
+            task.cancel()
+
+    @property
+    def progress(self) -> WarmupProgress:
+        return WarmupProgress(
+            queued=self.queued,
+            warmed=len(self.warmed),
+            failed=len(self.failed),
+            running=sum(not t.done() for t in self._tasks.values()),
+        )
@@ -0,0 +1,99 @@
+import re
+
+import discord
+import pytest
+
+from musicboy.audio import (
+    MAX_PCM_SCALE,
+    OPUS_BASE_VOLUME,
+    GaplessSource,
+    MusicSource,
+    OpusSource,
+)
+
+
+class FakeSource(discord.AudioSource):
+    def __init__(self, frames: list[bytes], opus: bool = False):
+        self.frames = list(frames)
+        self.opus = opus
+        self.cleaned_up = False
+
+    def read(self) -> bytes:
+        return self.frames.pop(0) if self.frames else b""
+
+    def is_opus(self) -> bool:
+        return self.opus
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+@pytest.fixture
+def ffmpeg_opus_args(monkeypatch):
+    """Arguments OpusSource gives FFmpeg, without starting it"""
+    calls = []
+
+    def init(self, source, **kwargs):
+        calls.append(kwargs)
+
+    monkeypatch.setattr(discord.FFmpegOpusAudio, "__init__", init)
+    monkeypatch.setattr(discord.FFmpegOpusAudio, "cleanup", lambda self: None)
+    return calls
+
+
+def opus_scale(kwargs: dict, gain: float) -> float:
+    """Overall scale of an Opus file played with these FFmpeg arguments"""
+    baked = OPUS_BASE_VOLUME * gain
+    if kwargs.get("codec") == "copy":
+        return baked
+
+    match = re.search(r"volume=([\d.]+)", kwargs["options"])
+    assert match is not None
+    return baked * float(match[1])
+
+
+@pytest.mark.parametrize("volume", [0.01, 0.05, 0.3, 1.0])
+@pytest.mark.parametrize("gain", [0.25, 1.0, 3.98])
+def test_volume_matches_on_both_paths(ffmpeg_opus_args, volume, gain):
+    pcm = MusicSource(FakeSource([]), volume=volume, gain=gain)  # type: ignore
+    OpusSource("song.opus", volume=volume, gain=gain)
+
+    # What PCMVolumeTransformer multiplies samples by
+    pcm_scale = min(pcm._volume, MAX_PCM_SCALE)
+    assert opus_scale(ffmpeg_opus_args[-1], gain) == pytest.approx(pcm_scale, rel=1e-3)
+
+
+def test_default_volume_is_passthrough(ffmpeg_opus_args):
+    OpusSource("song.opus", volume=OPUS_BASE_VOLUME, gain=2.0)
+    assert ffmpeg_opus_args[-1]["codec"] == "copy"
+
+
+def test_volume_change_keeps_gain():
+    pcm = MusicSource(FakeSource([]), volume=0.05, gain=2.0)  # type: ignore
+    pcm.volume = 0.2
+    assert pcm.volume == 0.2
+    assert pcm._volume == pytest.approx(0.4)
+
+
+@pytest.mark.parametrize("opus", [False, True])
+def test_gapless_plays_same_kind_back_to_back(opus):
+    started = []
+    source = GaplessSource(FakeSource([b"a"], opus=opus))
+    assert source.queue(
+        FakeSource([b"b"], opus=opus), lambda: True, lambda: started.append(1)
+    )
+
+    assert [source.read(), source.read(), source.read()] == [b"a", b"b", b""]
+    assert started == [1]
+
+
+@pytest.mark.parametrize("opus", [False, True])
+def test_gapless_refuses_other_kind(opus):
+    source = GaplessSource(FakeSource([b"a"], opus=opus))
+    other = FakeSource([b"b"], opus=not opus)
+
+    assert not source.queue(other, lambda: True, lambda: None)
+    assert other.cleaned_up
+    assert [source.read(), source.read()] == [b"a", b""]
+    # discord.py decided whether to encode when playback started
+    assert source.is_opus() is opus
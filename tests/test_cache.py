@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+from musicboy import cache
+from musicboy.cache import AudioCache
+from musicboy.database import Database
+from musicboy.sources.youtube.youtube import SongMetadata
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "database.sqlite"))
+    db.initialize_db()
+    yield db
+    db.close()
+
+
+def write_song(cache: AudioCache, song_id: str, played_at: float):
+    path = cache.data_dir / f"{song_id}.webm"
+    path.write_bytes(os.urandom(100))
+    os.utime(path, (played_at, played_at))
+    return path
+
+
+def test_workers_share_pins_and_budget(tmp_path, db, monkeypatch):
+    # As if each add came long enough after the last rescan
+    monkeypatch.setattr(cache, "SHARED_SYNC_SECONDS", 0)
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    # Two workers sharing the data dir and database
+    first = AudioCache(data_dir, max_bytes=250, db=db)
+    second = AudioCache(data_dir, max_bytes=250, db=db)
+    first.rebuild()
+    second.rebuild()
+
+    # The oldest song, but the second worker is about to play it
+    second.add(write_song(second, "pinned00000", played_at=1))
+    second.pin(1 << 22, ["pinned00000"])
+    db.writer.submit(lambda c: None).result()
+    second.add(write_song(second, "older000000", played_at=2))
+
+    first.add(write_song(first, "newer000000", played_at=3))
+
+    assert sorted(p.stem for p in data_dir.glob("*.webm")) == [
+        "newer000000",
+        "pinned00000",
+    ]
+
+
+def test_lfu_counts_plays_from_earlier_runs(tmp_path, db):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    db.write_metadata_many(
+        SongMetadata(id=song_id, url=f"{song_id}", title=song_id, duration=60)
+        for song_id in ("favourite00", "once0000000")
+    )
+    before_restart = AudioCache(data_dir, db=db)
+    before_restart.add(write_song(before_restart, "favourite00", played_at=1))
+    before_restart.add(write_song(before_restart, "once0000000", played_at=2))
+    for _ in range(3):
+        before_restart.touch("favourite00")
+    before_restart.touch("once0000000")
+    db.writer.submit(lambda c: None).result()
+
+    cache = AudioCache(data_dir, max_bytes=150, policy="lfu", db=db)
+    cache.rebuild()
+
+    assert [p.stem for p in data_dir.glob("*.webm")] == ["favourite00"]
@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+from musicboy.database import Database, MetadataCache
+from musicboy.sources.youtube.youtube import SongMetadata
+
+SONG = SongMetadata(
+    id="dQw4w9WgXcQ",
+    url="https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    title="Song",
+    duration=212,
+)
+SPELLINGS = [
+    "https://youtu.be/dQw4w9WgXcQ?t=42",
+    "https://music.youtube.com/watch?v=dQw4w9WgXcQ&list=RD",
+    SONG["url"],
+]
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "database.sqlite"))
+    db.initialize_db()
+    db.write_metadata(SONG).result()
+    yield db
+    db.close()
+
+
+@pytest.mark.parametrize("cached", [True, False])
+def test_get_many_keys_by_requested_url(db, cached):
+    if not cached:
+        db.cache = MetadataCache()
+
+    found = db.get_many([*SPELLINGS, "https://www.youtube.com/watch?v=xxxxxxxxxxx"])
+
+    assert found.keys() == set(SPELLINGS)
+    assert all(meta["id"] == SONG["id"] for meta in found.values())
+
+
+def test_aget_many_keys_by_requested_url(db):
+    db.cache = MetadataCache()
+
+    found = asyncio.run(db.aget_many(SPELLINGS))
+
+    assert found.keys() == set(SPELLINGS)
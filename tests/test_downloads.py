@@ -0,0 +1,166 @@
+import asyncio
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from musicboy import downloads
+from musicboy.downloads import DownloadService, DownloadTimeout
+from musicboy.sources.youtube.youtube import SongMetadata
+
+SONG = SongMetadata(
+    id="dQw4w9WgXcQ",
+    url="https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    title="Song",
+    duration=212,
+)
+
+
+@pytest.fixture
+def service(tmp_path):
+    service = DownloadService(tmp_path, retries=2, backoff=0)
+    # Jobs run on threads here; spawning pool processes would re-import the
+    # bot without the test's patches
+    service._pool = ThreadPoolExecutor(max_workers=2)  # type: ignore
+    yield service
+    service._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def fake_jobs(monkeypatch, *results):
+    """Make pool jobs return or raise ``results`` in turn, counting calls"""
+    calls = []
+
+    def run_job(song, data_dir, opus, timeout):
+        calls.append(song["id"])
+        result = results[min(len(calls), len(results)) - 1]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(downloads, "_run_job", run_job)
+    return calls
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGALRM"), reason="needs SIGALRM")
+def test_stalled_job_times_out(monkeypatch, tmp_path):
+    monkeypatch.setattr(downloads, "download_song", lambda *args: time.sleep(5))
+
+    start = time.monotonic()
+    with pytest.raises(DownloadTimeout):
+        downloads._run_job(SONG, str(tmp_path), False, timeout=1)
+
+    assert time.monotonic() - start < 4
+    # The alarm is cleared, so it can't go off in a later job
+    assert signal.alarm(0) == 0
+
+
+def test_timeout_is_retried(monkeypatch, service, tmp_path):
+    path = str(tmp_path / f"{SONG['id']}.webm")
+    calls = fake_jobs(monkeypatch, DownloadTimeout("stalled"), (path, -14.0))
+
+    assert asyncio.run(service.download(SONG)) == (Path(path), -14.0)
+    assert len(calls) == 2
+
+
+def test_timeout_raised_after_retries(monkeypatch, service):
+    calls = fake_jobs(monkeypatch, DownloadTimeout("stalled"))
+
+    with pytest.raises(DownloadTimeout):
+        asyncio.run(service.download(SONG, on_progress=lambda progress: None))
+
+    assert len(calls) == service.retries + 1
+    assert service._callbacks == {}
+
+
+def test_cancelled_download_forgets_callbacks(monkeypatch, service):
+    release = threading.Event()
+
+    def run_job(song, data_dir, opus, timeout):
+        release.wait(5)
+        return str(service.data_dir / f"{song['id']}.webm"), None
+
+    monkeypatch.setattr(downloads, "_run_job", run_job)
+
+    async def cancel():
+        task = asyncio.create_task(
+            service.download(SONG, on_progress=lambda progress: None)
+        )
+        await asyncio.sleep(0.05)
+        assert SONG["id"] in service._callbacks
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    try:
+        asyncio.run(cancel())
+    finally:
+        release.set()
+
+    assert service._callbacks == {}
+    assert service.progress == {}
+
+
+def test_urgent_jobs_skip_the_line(monkeypatch, service):
+    started: list[str] = []
+    finish = {name: threading.Event() for name in ("slow", "late", "soon", "now")}
+
+    def run_job(song, data_dir, opus, timeout):
+        started.append(song["title"])
+        finish[song["title"]].wait(5)
+        return str(service.data_dir / f"{song['id']}.webm"), None
+
+    monkeypatch.setattr(downloads, "_run_job", run_job)
+
+    async def until(condition):
+        for _ in range(200):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        raise AssertionError("timed out")
+
+    async def run():
+        def start(title: str, priority: float) -> asyncio.Task:
+            song = SongMetadata(**{**SONG, "id": title.ljust(11, "0"), "title": title})
+            return asyncio.create_task(service.download(song, priority=priority))
+
+        tasks = [start("slow", 1.0)]
+        await until(lambda: started == ["slow"])
+        # Prefetches leave the last process for urgent jobs
+        tasks += [start("late", 20.0), start("soon", 10.0)]
+        tasks.append(start("now", downloads.IMMEDIATE))
+        await until(lambda: started == ["slow", "now"])
+
+        finish["now"].set()
+        finish["slow"].set()
+        await until(lambda: started == ["slow", "now", "soon"])
+        finish["soon"].set()
+        finish["late"].set()
+        await asyncio.gather(*tasks)
+
+    try:
+        asyncio.run(run())
+    finally:
+        for event in finish.values():
+            event.set()
+
+    assert started == ["slow", "now", "soon", "late"]
+    assert service._running == 0
+
+
+def test_stream_urls_resolve_in_the_pool(monkeypatch, service):
+    threads = []
+
+    def resolve(url):
+        threads.append(threading.current_thread())
+        raise RuntimeError(f"no formats for {url}")
+
+    monkeypatch.setattr(downloads, "resolve_stream_url", resolve)
+
+    with pytest.raises(downloads.DownloadFailed, match="RuntimeError: no formats"):
+        asyncio.run(service.resolve_stream(SONG))
+
+    assert threads and threading.main_thread() not in threads
+    assert service._running == 0
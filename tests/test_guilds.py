@@ -0,0 +1,55 @@
+import asyncio
+import threading
+
+import pytest
+
+from musicboy.database import Database
+from musicboy.guilds import GuildRegistry
+from musicboy.store import PlaylistStore
+
+GUILD = 1 << 22
+
+
+@pytest.fixture
+def registry(tmp_path):
+    db = Database(str(tmp_path / "database.sqlite"))
+    db.initialize_db()
+    yield GuildRegistry(PlaylistStore(db))
+    db.close()
+
+
+def test_evicted_playlist_loads_off_the_loop(registry, monkeypatch):
+    load = registry.store.load
+    threads = []
+
+    def record_thread(guild_id):
+        threads.append(threading.current_thread())
+        return load(guild_id)
+
+    monkeypatch.setattr(registry.store, "load", record_thread)
+
+    async def reload():
+        playlist = await registry.load(GUILD, create=True)
+        assert playlist is not None
+        playlist.extend_songs(["a", "b", "c"])
+        playlist.next()
+        assert registry.evict(max_idle=-1) == [GUILD]
+        assert registry.playlist(GUILD) is None
+
+        # Both wait on the same load
+        return await asyncio.gather(registry.load(GUILD), registry.load(GUILD))
+
+    first, second = asyncio.run(reload())
+
+    assert first is second
+    assert first is not None
+    assert (list(first.playlist), first.idx) == (["a", "b", "c"], 1)
+    assert threads and threading.main_thread() not in threads
+    assert registry.loads == 1
+
+
+def test_load_only_creates_when_asked(registry):
+    assert asyncio.run(registry.load(GUILD)) is None
+    assert not registry.has_playlist(GUILD)
+    assert asyncio.run(registry.load(GUILD, create=True)) is not None
+    assert registry.has_playlist(GUILD)
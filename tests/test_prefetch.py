@@ -0,0 +1,62 @@
+import asyncio
+import heapq
+
+import pytest
+
+from musicboy import prefetch
+from musicboy.cache import AudioCache
+from musicboy.database import Database
+from musicboy.playlist import Playlist
+from musicboy.prefetch import BACKGROUND, PrefetchScheduler
+from musicboy.sources.youtube.youtube import SongMetadata
+
+
+def song(name: str, duration: int) -> SongMetadata:
+    song_id = name.ljust(11, "0")
+    return SongMetadata(
+        id=song_id,
+        url=f"https://www.youtube.com/watch?v={song_id}",
+        title=name,
+        duration=duration,
+    )
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    db = Database(str(tmp_path / "database.sqlite"))
+    db.initialize_db()
+    # Not started, so jobs stay queued for the test to inspect
+    yield PrefetchScheduler(AudioCache(tmp_path / "data"), db, downloads=None)  # type: ignore
+    db.close()
+
+
+def queued(scheduler: PrefetchScheduler) -> list[str]:
+    items = list(scheduler._queue)
+    return [heapq.heappop(items).job.song["title"] for _ in range(len(items))]
+
+
+def test_songs_run_in_the_order_they_are_needed(scheduler, monkeypatch):
+    songs = [song(name, 30) for name in ("a", "a2", "b", "b2", "c", "c2")]
+    scheduler.db.write_metadata_many(songs).result()
+    playlists = {
+        name: Playlist(n, [s["url"] for s in songs if s["title"][0] == name])
+        for n, name in enumerate("abc")
+    }
+    clock = [1000.0]
+    monkeypatch.setattr(prefetch, "monotonic", lambda: clock[0])
+    # Pretend the current songs are already cached
+    monkeypatch.setattr(
+        AudioCache, "__contains__", lambda self, song_id: len(song_id.strip("0")) == 1
+    )
+
+    async def schedule():
+        # a's song started 170s ago with 180s to go, so it ends in 10s
+        await scheduler.schedule(playlists["a"], remaining=180)
+        clock[0] += 170
+        await scheduler.schedule(playlists["b"], remaining=30)
+        await scheduler.schedule(playlists["c"])
+
+    asyncio.run(schedule())
+
+    assert queued(scheduler) == ["a2", "b2", "c2"]
+    assert scheduler.jobs["c2".ljust(11, "0")].priority == BACKGROUND
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from musicboy.database import Database
+from musicboy.playlist import Playlist
+from musicboy.queueview import PAGE_SIZE, QueuePages
+from musicboy.sources.youtube.youtube import SongMetadata
+
+GUILD = 1 << 22
+URLS = [f"https://www.youtube.com/watch?v=song{n:07d}" for n in range(15)]
+
+
+@pytest.fixture
+def pages(tmp_path):
+    db = Database(str(tmp_path / "database.sqlite"))
+    db.initialize_db()
+    db.write_metadata_many(
+        SongMetadata(id=url[-11:], url=url, title=f"Song {n}", duration=60)
+        for n, url in enumerate(URLS)
+    ).result()
+    yield QueuePages(db)
+    db.close()
+
+
+def lines(pages: QueuePages, playlist: Playlist, page: int, playing=False):
+    embed = asyncio.run(pages.render(playlist, page, playing))
+    assert embed.description is not None
+    return embed.description.split("\n")
+
+
+def test_first_page_leads_with_current_song(pages):
+    playlist = Playlist(GUILD, URLS, idx=2)
+
+    first = lines(pages, playlist, 0, playing=True)
+    assert first[0].startswith("**1.** [Song 2]")
+    assert first[0].endswith("(Now playing)")
+    assert first[1].startswith("**2.** [Song 3]")
+    assert len(first) == PAGE_SIZE + 1
+
+    second = lines(pages, playlist, 1)
+    assert second[0].startswith(f"**{PAGE_SIZE + 2}.** [Song {PAGE_SIZE + 3}]")
+
+
+def test_last_song(pages):
+    playlist = Playlist(GUILD, URLS, idx=len(URLS) - 1)
+
+    assert lines(pages, playlist, 0) == [
+        f"**1.** [Song 14]({URLS[-1]}) (01:00)",
+        "No more songs in the queue",
+    ]
@@ -0,0 +1,46 @@
+import gc
+
+from musicboy import songqueue
+from musicboy.songqueue import SongQueue
+
+
+def interned(*urls: str) -> list[bool]:
+    return [url in songqueue._ids for url in urls]
+
+
+def urls(test: str) -> tuple[str, str, str]:
+    """URLs no other test's queues hold"""
+    a, b, c = (f"{test}/{name}" for name in "abc")
+    return a, b, c
+
+
+def test_urls_are_released_with_the_last_queue():
+    a, b, c = urls("release")
+    first = SongQueue([a, b, a])
+    second = SongQueue([b, c])
+
+    first.remove_all(a)
+    assert interned(a, b, c) == [False, True, True]
+
+    first.clear()
+    assert interned(b, c) == [True, True]
+
+    del second
+    gc.collect()
+    assert interned(b, c) == [False, False]
+
+
+def test_released_ids_are_reused():
+    a, b, c = urls("reuse")
+    queue = SongQueue([a])
+    queue.pop()
+    size = len(songqueue._urls)
+
+    queue.append(b)
+    queue[0] = b
+    queue.insert(0, c)
+    del queue[0]
+
+    assert list(queue) == [b]
+    assert interned(a, b, c) == [False, True, False]
+    assert len(songqueue._urls) == size
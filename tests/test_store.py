@@ -0,0 +1,144 @@
+import json
+
+import pytest
+
+from musicboy.database import Database
+from musicboy.playlist import Playlist
+from musicboy.store import PlaylistStore, migrate_json_playlists
+
+GUILD = 1 << 22
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "database.sqlite"))
+    db.initialize_db()
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def store(db):
+    return PlaylistStore(db)
+
+
+def saved(db: Database) -> list[str]:
+    """The playlist as a restart would load it"""
+    db.writer.submit(lambda c: None).result()
+    state = PlaylistStore(db).load(GUILD)
+    assert state is not None
+    return state["playlist"]
+
+
+def test_round_trip(db, store):
+    playlist = Playlist(GUILD, store=store)
+    playlist.extend_songs(["a", "b", "c", "d"])
+    playlist.prepend_song("e")
+    playlist.append_song("f")
+    playlist.move_song(2, 4)
+    playlist.remove_index(3)
+    playlist.remove_song("d")
+
+    assert saved(db) == list(playlist.playlist)
+
+
+def test_remove_every_copy(db, store):
+    playlist = Playlist(GUILD, store=store)
+    playlist.extend_songs(["a", "b", "a", "c", "a"])
+    playlist.remove_song("a", all=True)
+
+    assert list(playlist.playlist) == ["b", "c"]
+    assert saved(db) == ["b", "c"]
+
+
+@pytest.mark.parametrize("move", [(2, 10), (10, 2), (0, 2)])
+def test_move_out_of_range_changes_nothing(db, store, move):
+    playlist = Playlist(GUILD, store=store)
+    playlist.extend_songs(["a", "b", "c"])
+
+    with pytest.raises(ValueError):
+        playlist.move_song(*move)
+
+    assert list(playlist.playlist) == ["a", "b", "c"]
+    assert saved(db) == ["a", "b", "c"]
+
+
+def test_remove_out_of_range_changes_nothing(db, store):
+    playlist = Playlist(GUILD, store=store)
+    playlist.extend_songs(["a", "b"])
+
+    with pytest.raises(ValueError):
+        playlist.remove_index(5)
+    with pytest.raises(ValueError):
+        playlist.remove_index(0)
+
+    assert saved(db) == ["a", "b"]
+
+
+def test_prepend_after_current_song_removed(db, store):
+    playlist = Playlist(GUILD, store=store)
+    playlist.extend_songs(["a", "b", "c"])
+    playlist.goto(2)
+    playlist.remove_index(1)
+    playlist.prepend_song("d")
+
+    assert list(playlist.playlist) == ["a", "b", "d"]
+    assert saved(db) == ["a", "b", "d"]
+
+
+def test_repeated_inserts_between_two_songs(db, store):
+    playlist = Playlist(GUILD, store=store)
+    playlist.extend_songs(["first", "last"])
+    # Halving the gap each time runs out of float precision and renumbers
+    for n in range(80):
+        playlist.prepend_song(str(n))
+
+    assert saved(db) == list(playlist.playlist)
+    assert list(playlist.playlist)[:2] == ["first", "79"]
+
+
+@pytest.mark.parametrize(
+    "queued, expected",
+    [
+        ([], ["a", "b", "c", "d"]),
+        (["x", "y"], ["x", "a", "b", "c", "d", "y"]),
+        (["x"], ["x", "a", "b", "c", "d"]),
+    ],
+)
+def test_prepend_songs_keeps_their_order(db, store, queued, expected):
+    playlist = Playlist(GUILD, store=store)
+    playlist.extend_songs(queued)
+    playlist.prepend_songs(["a", "b", "c", "d"])
+
+    assert list(playlist.playlist) == expected
+    assert saved(db) == expected
+
+
+def test_position_and_volume(db, store):
+    playlist = Playlist(GUILD, store=store)
+    playlist.extend_songs(["a", "b", "c"])
+    playlist.next()
+    playlist.volume = 0.5
+    playlist.save_elapsed(12.5)
+    db.writer.submit(lambda c: None).result()
+
+    state = PlaylistStore(db).load(GUILD)
+    assert state is not None
+    assert (state["idx"], state["volume"], state["elapsed"]) == (1, 0.5, 12.5)
+
+
+def test_migrated_json_playlist_is_canonical(tmp_path, db, store):
+    state = {
+        "guild_id": GUILD,
+        "playlist": ["https://youtu.be/dQw4w9WgXcQ", "https://example.com/a&b=c"],
+        "idx": 0,
+        "volume": 0.5,
+    }
+    (tmp_path / f"state_{GUILD}.json").write_text(json.dumps(state))
+
+    migrate_json_playlists(tmp_path, store)
+
+    assert saved(db) == [
+        "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+        "https://example.com/a",
+    ]